@@ -9,7 +9,12 @@ from netCDF4 import Dataset #.nc file handling
 import os #path/file management
 import shutil #file/path deletion
 import datetime as dt #date management
-import numpy.ma as ma #masked array management, common with .nc files
+from grid_tools import get_grid_index,box_weight_matrix,weighted_box_means #box handling
+from instrumentation import instrumented,count,save_report #stage timing and memory reports
+import harmonics as hc #smoothed climatology
+import chunked #out of core box values
+from ingest import input_file #reads from the chunked store when there is one
+import dtype_policy as dp #field dtype
 
 # Paths Go Here
 root = os.getcwd()
@@ -21,6 +26,32 @@ OLR_file = 'olr.day.mean.nc'
 OLR_clim = 'olr.day.ltm.1981-2010.nc'
 ttt_index_file = 'TTT_Index.csv'
 
+# define the boxes for the OLR data
+#boxes are defined as left,bottom,right,top
+olr_domain = [0,-40,80,10]
+# box E1 has bounds of 37E-42E, 17S-12S due to resolution of the OLR data
+# it will be 37.5E-42.5E,17.5S-12.5S
+E1_box = [37.5,-17.5,42.5,-12.5]
+# box E2 has bounds of 45E-50E, 23S-15S due to resolution of the OLR data
+# it will be 45E-50E, 22.5S-15S
+E2_box = [45,-22.5,50,-15]
+# box W1 has bounds of 22E-32E, 24S-18S due to resolution of the OLR data
+# it will be 22.5E-32.5E,25S-17.5S
+W1_box = [22.5,-25,32.5,-17.5]
+# box W2 has bounds of 32E-42E, 36S-28S due to resolution of the OLR data
+# it will be 32.5E-42.5E, 35S-27.5S
+W2_box = [32.5,-35,42.5,-27.5]
+#whether the box means weight each grid cell by cos(latitude), off by
+#default so the index and features match the unweighted box means
+area_weight_boxes = False
+#'memory' reads the OLR whole, 'chunked' streams it in time blocks sized to
+#chunked.memory_budget_mb (same results, for domains that don't fit)
+processing_backend = 'memory'
+#'daily' uses the 1981-2010 LTM file as is, 'harmonic' smooths it to its
+#first n_harmonics annual harmonics
+climatology_mode = 'daily'
+n_harmonics = 3
+
 # Functions Go Here
 '''
     Functions to handle folder validation, creation, and deletion
@@ -65,6 +96,7 @@ def delete_folder(folder_path:str,folder_name:str) -> None:
     Functions to open up the OLR data and get anomalies and then means of it within the boxes
     specified in Ratna et al. 2013
 '''
+@instrumented()
 def retrieve_OLR_data() -> tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
     '''
         Open up the NOAA Interpolated Daily OLR from PSL and return the lat,
@@ -78,23 +110,21 @@ def retrieve_OLR_data() -> tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
     #navigate to the folder where the OLR data is stored
     os.chdir(data_path)
     #check if the file isn't located where it is suppposed to be
-    if not os.path.isfile(OLR_file):
+    if not os.path.isfile(input_file(OLR_file)):
         raise FileNotFoundError("The OLR File was not found in the data folder.")
     
     #open the file
-    nc_data = Dataset(OLR_file)
+    nc_data = Dataset(input_file(OLR_file))
     #get the lats, and lons
     lats = nc_data.variables['lat'][:]
     lons = nc_data.variables['lon'][:]
-    #get the indices needed to refine them
-    lat_ei = np.where(lats == -40)[0][0]
-    lat_si = np.where(lats == 10)[0][0]
-    lon_si = np.where(lons == 0)[0][0]
-    lon_ei = np.where(lons == 80)[0][0]
+    #get the slices needed to refine them
+    lat_slice,lon_slice = get_grid_index(lats,lons).box_slices(olr_domain)
     #now refine everything and tet the OLR
-    lats = lats[lat_si:lat_ei]
-    lons = lons[lon_si:lon_ei]
-    olr = ma.getdata(nc_data.variables['olr'][:,lat_si:lat_ei,lon_si:lon_ei])
+    lats = lats[lat_slice]
+    lons = lons[lon_slice]
+    olr = dp.as_field(nc_data.variables['olr'][:,lat_slice,lon_slice])
+    count('netcdf_bytes',olr.nbytes)
     time = nc_data.variables['time'][:] #hours since 1,1,1800
     #convert the time to a useable data
     ref_date = dt.datetime(1800,1,1)
@@ -108,6 +138,7 @@ def retrieve_OLR_data() -> tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
 
     return dates,lats,lons,olr
 
+@instrumented()
 def retrieve_OLR_clim() -> tuple[np.ndarray,np.ndarray,np.ndarray]:
     '''
         Open up the NOAA Interpolated daily OLR climatology from 1981-2010
@@ -121,23 +152,21 @@ def retrieve_OLR_clim() -> tuple[np.ndarray,np.ndarray,np.ndarray]:
     #navigate to the folder where the OLR data is stored
     os.chdir(data_path)
     #check if the file isn't located where it is suppposed to be
-    if not os.path.isfile(OLR_clim):
+    if not os.path.isfile(input_file(OLR_clim)):
         raise FileNotFoundError("The OLR Climatology File was not found in the data folder.")
     
     #open the file
-    nc_data = Dataset(OLR_clim)
+    nc_data = Dataset(input_file(OLR_clim))
     #get the lats/lons
     lats = nc_data.variables['lat'][:]
     lons = nc_data.variables['lon'][:]
-    #get the indices needed to refine them
-    lat_ei = np.where(lats == -40)[0][0]
-    lat_si = np.where(lats == 10)[0][0]
-    lon_si = np.where(lons == 0)[0][0]
-    lon_ei = np.where(lons == 80)[0][0]
+    #get the slices needed to refine them
+    lat_slice,lon_slice = get_grid_index(lats,lons).box_slices(olr_domain)
     #now refine everything and tet the OLR
-    lats = lats[lat_si:lat_ei]
-    lons = lons[lon_si:lon_ei]
-    olr = ma.getdata(nc_data.variables['olr'][:,lat_si:lat_ei,lon_si:lon_ei])
+    lats = lats[lat_slice]
+    lons = lons[lon_slice]
+    olr = dp.as_field(nc_data.variables['olr'][:,lat_slice,lon_slice])
+    count('netcdf_bytes',olr.nbytes)
     #replace bad OLR values with nan's
     olr[np.where(olr < -9999)] = np.nan
     #close the .nc file
@@ -147,6 +176,19 @@ def retrieve_OLR_clim() -> tuple[np.ndarray,np.ndarray,np.ndarray]:
 
     return lats,lons,olr
 
+def get_OLR_climatology():
+    '''
+        The OLR climatology the anomalies are taken from, the daily values
+        of the 1981-2010 file or, for climatology_mode 'harmonic', their
+        mean and first n_harmonics annual harmonics (a HarmonicClimatology)
+    '''
+    _,_,olr_clim = retrieve_OLR_clim()
+    if climatology_mode == 'harmonic':
+        return hc.fit_harmonics(olr_clim,n_harmonics)
+
+    return olr_clim
+
+@instrumented()
 def get_OLR_anomalies(olr_data:np.ndarray,olr_clim:np.ndarray,olr_dates:np.ndarray) -> np.ndarray:
     '''
         Calculate the OLR anomalies relative to the 1981-2010 mean and return
@@ -154,6 +196,13 @@ def get_OLR_anomalies(olr_data:np.ndarray,olr_clim:np.ndarray,olr_dates:np.ndarr
 
         Returns the olr anomalies with shape (time,lat,lon)
     '''
+    if isinstance(olr_clim,hc.HarmonicClimatology):
+        #evaluate the harmonics a year of days at a time, leap days in place
+        days = hc.day_positions(olr_dates)
+        olr_anoms = olr_data[:]
+        for ts in range(0,len(olr_dates),365):
+            olr_anoms[ts:ts+365] = olr_data[ts:ts+365] - olr_clim[days[ts:ts+365]]
+        return olr_anoms
 
     #make a ref date for the anomaly calculation
     ref_date = dt.datetime(2001,1,1)
@@ -172,6 +221,20 @@ def get_OLR_anomalies(olr_data:np.ndarray,olr_clim:np.ndarray,olr_dates:np.ndarr
 
     return olr_anoms
 
+@instrumented()
+def get_box_values(olr_anoms:np.ndarray,lats:np.ndarray,lons:np.ndarray,boxes:list) -> np.ndarray:
+    '''
+        Get the mean OLR anomalies within each of the boxes. The means of all
+        the boxes are computed together, weighted by cos(latitude) when
+        area_weight_boxes is True.
+
+        Returns the box means with shape (box,time)
+    '''
+
+    weights = box_weight_matrix(get_grid_index(lats,lons),boxes,weighted = area_weight_boxes)
+
+    return weighted_box_means(olr_anoms,weights).T
+
 def get_Ebox_values(olr_anoms:np.ndarray,lats:np.ndarray,lons:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
     '''
         Get the mean OLR anomalies within the eastern boxes of the index E1
@@ -182,28 +245,8 @@ def get_Ebox_values(olr_anoms:np.ndarray,lats:np.ndarray,lons:np.ndarray) -> tup
         Return order is boxE1_mean, boxE2_mean
     '''
 
-    # box E1 has bounds of 37E-42E, 17S-12S due to resolution of the OLR data
-    # it will be 37.5E-42.5E,17.5S-12.5S
-    # box E2 has bounds of 45E-50E, 23S-15S due to resolution of the OLR data
-    # it will be 45E-50E, 22.5S-15S
-
-    #use the lats/lons to refine the OLR anomalies
-    E1_lat_ei = np.where(lats == -17.5)[0][0]
-    E1_lat_si = np.where(lats == -12.5)[0][0]
-    E2_lat_ei = np.where(lats == -22.5)[0][0]
-    E2_lat_si = np.where(lats == -15)[0][0]
-    E1_lon_si = np.where(lons == 37.5)[0][0]
-    E1_lon_ei = np.where(lons == 42.5)[0][0]
-    E2_lon_si = np.where(lons == 45)[0][0]
-    E2_lon_ei = np.where(lons == 50)[0][0]
-
-    #refine the anomalies to the boxes
-    E1_olr_anoms = olr_anoms[:,E1_lat_si:E1_lat_ei,E1_lon_si:E1_lon_ei]
-    E2_olr_anoms = olr_anoms[:,E2_lat_si:E2_lat_ei,E2_lon_si:E2_lon_ei]
-
-    #take the mean
-    E1_olr_anoms = np.nanmean(E1_olr_anoms,axis = (1,2))
-    E2_olr_anoms = np.nanmean(E2_olr_anoms,axis = (1,2))
+    #take the mean within both boxes at once
+    E1_olr_anoms,E2_olr_anoms = get_box_values(olr_anoms,lats,lons,[E1_box,E2_box])
 
     return E1_olr_anoms,E2_olr_anoms
 
@@ -217,31 +260,40 @@ def get_Wbox_values(olr_anoms:np.ndarray,lats:np.ndarray,lons:np.ndarray) -> tup
         Return order is boxW1_mean, boxW2_mean
     '''
 
-    # box E1 has bounds of 22E-32E, 24S-18S due to resolution of the OLR data
-    # it will be 22.5E-32.5E,25S-17.5S
-    # box E2 has bounds of 32E-42E, 36S-28S due to resolution of the OLR data
-    # it will be 32.5E-42.5E, 35S-27.5S
-
-    #use the lats/lons to refine the OLR anomalies
-    W1_lat_ei = np.where(lats == -25)[0][0]
-    W1_lat_si = np.where(lats == -17.5)[0][0]
-    W2_lat_ei = np.where(lats == -35)[0][0]
-    W2_lat_si = np.where(lats == -27.5)[0][0]
-    W1_lon_si = np.where(lons == 22.5)[0][0]
-    W1_lon_ei = np.where(lons == 32.5)[0][0]
-    W2_lon_si = np.where(lons == 32.5)[0][0]
-    W2_lon_ei = np.where(lons == 42.5)[0][0]
-
-    #refine the anomalies to the boxes
-    W1_olr_anoms = olr_anoms[:,W1_lat_si:W1_lat_ei,W1_lon_si:W1_lon_ei]
-    W2_olr_anoms = olr_anoms[:,W2_lat_si:W2_lat_ei,W2_lon_si:W2_lon_ei]
-
-    #take the mean
-    W1_olr_anoms = np.nanmean(W1_olr_anoms,axis = (1,2))
-    W2_olr_anoms = np.nanmean(W2_olr_anoms,axis = (1,2))
+    #take the mean within both boxes at once
+    W1_olr_anoms,W2_olr_anoms = get_box_values(olr_anoms,lats,lons,[W1_box,W2_box])
 
     return W1_olr_anoms,W2_olr_anoms
 
+@instrumented()
+def get_box_values_chunked(boxes:list) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        Gets the mean OLR anomalies within each of the boxes by streaming the
+        OLR file in time blocks, so only one block of OLR is in memory at a
+        time. Same results as retrieve_OLR_data, get_OLR_anomalies, and
+        get_box_values together.
+
+        Returns the dates and the box means with shape (box,time)
+    '''
+    olr_clim = get_OLR_climatology()
+    os.chdir(data_path)
+    if not os.path.isfile(input_file(OLR_file)):
+        raise FileNotFoundError("The OLR File was not found in the data folder.")
+    with Dataset(input_file(OLR_file)) as nc_data:
+        lats = nc_data.variables['lat'][:]
+        lons = nc_data.variables['lon'][:]
+        lat_slice,lon_slice = get_grid_index(lats,lons).box_slices(olr_domain)
+        time = nc_data.variables['time'][:] #hours since 1,1,1800
+        ref_date = dt.datetime(1800,1,1)
+        dates = np.array([ref_date + dt.timedelta(hours = hr) for hr in time])
+        weights = box_weight_matrix(get_grid_index(lats[lat_slice],lons[lon_slice]),boxes,weighted = area_weight_boxes)
+        box_values = chunked.box_anomalies(nc_data.variables['olr'],hc.climatology_days(dates,olr_clim),olr_clim,weights,
+                                           lat_slice,lon_slice,fill_below = -9999)
+    os.chdir(root)
+
+    return dates,box_values.T
+
+@instrumented()
 def calculate_index(E1_vals:np.ndarray,E2_vals:np.ndarray,W1_vals:np.ndarray,W2_vals:np.ndarray) -> np.ndarray:
     '''
         Given the values within E1,E2,W1, and W2 calculate the value of my TTT
@@ -282,6 +334,7 @@ def index_std_and_mean(TTT_index:np.ndarray,TTT_dates:np.ndarray) -> tuple[np.nd
 
     return TTT_index_mean,TTT_index_std
 
+@instrumented()
 def determine_ttt_days(TTT_index:np.ndarray,TTT_dates:np.ndarray) -> np.ndarray:
     '''
         Determine which days are TTT days by seeing which days are more than
@@ -319,6 +372,7 @@ def determine_ttt_days(TTT_index:np.ndarray,TTT_dates:np.ndarray) -> np.ndarray:
     
     return ttt_peak_days
                 
+@instrumented()
 def make_ttt_file(file_name:str,TTT_index:np.ndarray,dates:np.ndarray,ttt_days:np.ndarray) -> None:
     '''
         Make a text file containing the value of my index, corresponding dates,
@@ -336,6 +390,7 @@ def make_ttt_file(file_name:str,TTT_index:np.ndarray,dates:np.ndarray,ttt_days:n
         ttt_file.write(f'{dates[i].year},{dates[i].month},{dates[i].day},{TTT_index[i]:.3f},{ttt_days[i]}\n')
     #close the file
     ttt_file.close()
+    count('rows_written',len(TTT_index))
 
     return None
 
@@ -346,20 +401,25 @@ def main() -> None:
         either on an error or after creating the TTT index file
     '''
 
-    #bring in the OLR data and climatology
-    olr_dates,olr_lats,olr_lons,olr = retrieve_OLR_data()
-    _,_,olr_clim = retrieve_OLR_clim()
-    #get the OLR anomalies
-    olr_anoms = get_OLR_anomalies(olr,olr_clim,olr_dates)
-    #get the values in the boxes
-    E1,E2 = get_Ebox_values(olr_anoms,olr_lats,olr_lons)
-    W1,W2 = get_Wbox_values(olr_anoms,olr_lats,olr_lons)
+    if processing_backend == 'chunked':
+        #stream the OLR through the anomalies and boxes a block at a time
+        olr_dates,(E1,E2,W1,W2) = get_box_values_chunked([E1_box,E2_box,W1_box,W2_box])
+    else:
+        #bring in the OLR data and climatology
+        olr_dates,olr_lats,olr_lons,olr = retrieve_OLR_data()
+        olr_clim = get_OLR_climatology()
+        #get the OLR anomalies
+        olr_anoms = get_OLR_anomalies(olr,olr_clim,olr_dates)
+        #get the values in all the boxes in one pass
+        E1,E2,W1,W2 = get_box_values(olr_anoms,olr_lats,olr_lons,[E1_box,E2_box,W1_box,W2_box])
     #calculate the index
     ttt_index = calculate_index(E1,E2,W1,W2)
     #get the ttt_day array
     ttt_days = determine_ttt_days(ttt_index,olr_dates)
     #write the data/index to a file
     make_ttt_file(ttt_index_file,ttt_index,olr_dates,ttt_days)
+    #where the time and memory went
+    save_report()
 
     return None
 
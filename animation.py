@@ -0,0 +1,131 @@
+# Animations of the lagged composites, e.g. the OLR and 850 hPa wind
+# anomalies from 10 days before to 5 days after the TTT events. The frames
+# are drawn in parallel with the same map setup as figures.py, encoded in
+# memory (no temporary PNGs), put on one shared palette so colors don't
+# flicker between frames, and written as a GIF or an animated PNG.
+#
+# Usage:
+#   python animation.py --lags -10 5
+#   python animation.py --variable q850 --winds u850 v850 --format apng
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import argparse #command line interface
+import io #in memory frames
+import os #path/file management
+from concurrent.futures import ProcessPoolExecutor #parallel frames
+from PIL import Image #GIF/APNG creation
+import composites as cp #saved composites
+import figures as fg #map drawing and styles
+
+# settings
+frame_dpi = 100
+frames_per_second = 3
+animation_lags = range(-10,6)
+
+# Functions go here
+def animation_frame_specs(composites:dict,variable:str = 'olr',winds:tuple = ('u850','v850'),
+                          lags:list = animation_lags) -> list:
+    '''
+        One figure spec per lag of a lagged composite, the variable is
+        contoured and the optional (u,v) composites are drawn as arrows
+    '''
+    style = fg.FIGURE_STYLES[variable]
+    all_lags = np.asarray(composites['lags'])
+    missing = [lag for lag in lags if lag not in all_lags]
+    if missing:
+        raise ValueError(f'The composites have no lags {missing}, they cover {all_lags.min()} to {all_lags.max()}.')
+    specs = []
+    for lag in lags:
+        lag_index = int(np.flatnonzero(all_lags == lag)[0])
+        composite = composites[variable]
+        title = f'TTT Composite {style["label"]} Anomalies, day {lag:+d}'
+        spec = {'field':composite['mean'][lag_index] * style['scale'],
+                'lats':composite['lats'],
+                'lons':composite['lons'],
+                'levels':style['levels'],
+                'cmap':style['cmap'],
+                'center':style.get('center'),
+                'title':title if winds is None else f'{title}, {winds[0][1:]} hPa Winds',
+                'colorbar_label':f'Composite {style["label"]} Anomalies [{style["units"]}]'}
+        if winds is not None:
+            u_name,v_name = winds
+            spec['winds'] = (composites[u_name]['mean'][lag_index],composites[v_name]['mean'][lag_index],
+                             composites[u_name]['lats'],composites[u_name]['lons'])
+        specs.append(spec)
+
+    return specs
+
+def render_frame(spec:dict) -> bytes:
+    '''
+        Draws a spec and encodes it as PNG bytes in memory (runs in a worker)
+    '''
+    import matplotlib.pyplot as plt
+
+    fig = fg.draw_figure(spec)
+    buffer = io.BytesIO()
+    fig.savefig(buffer,format = 'png',dpi = frame_dpi)
+    plt.close(fig)
+
+    return buffer.getvalue()
+
+def shared_palette_frames(frames:list) -> list:
+    '''
+        Puts every frame on one 256 color palette made from all of the frames
+        together, frames are cropped to the smallest frame size first
+        (a tight bounding box can differ by a pixel between frames)
+    '''
+    width = min(frame.width for frame in frames)
+    height = min(frame.height for frame in frames)
+    frames = [frame.convert('RGB').crop((0,0,width,height)) for frame in frames]
+    #the frames stacked into one image so the palette covers all of them
+    sheet = Image.new('RGB',(width,height * len(frames)))
+    for f,frame in enumerate(frames):
+        sheet.paste(frame,(0,height * f))
+    palette = sheet.quantize(colors = 256,method = Image.Quantize.MEDIANCUT)
+
+    return [frame.quantize(palette = palette,dither = Image.Dither.NONE) for frame in frames]
+
+def write_animation(specs:list,out_file:str,fps:float = frames_per_second,workers:int = None) -> str:
+    '''
+        Renders the frames in parallel and writes them as a GIF or, for a
+        .png/.apng out_file, an animated PNG that loops forever.
+
+        Returns out_file
+    '''
+    with ProcessPoolExecutor(max_workers = workers,initializer = fg.init_render_worker) as pool:
+        frames = [Image.open(io.BytesIO(frame)) for frame in pool.map(render_frame,specs)]
+    frames = shared_palette_frames(frames)
+    duration = int(round(1000 / fps))
+    image_format = 'PNG' if os.path.splitext(out_file)[1].lower() in ('.png','.apng') else 'GIF'
+    frames[0].save(out_file,format = image_format,save_all = True,append_images = frames[1:],
+                   duration = duration,loop = 0)
+
+    return out_file
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Animate the lagged TTT composites.')
+    parser.add_argument('--composites',default = cp.composite_file,help = 'saved lagged composites in the data folder')
+    parser.add_argument('--variable',choices = list(fg.FIGURE_STYLES),default = 'olr')
+    parser.add_argument('--winds',nargs = 2,default = ['u850','v850'],help = 'u and v composites drawn as arrows')
+    parser.add_argument('--no-winds',action = 'store_true',help = 'leave out the wind arrows')
+    parser.add_argument('--lags',type = int,nargs = 2,default = [animation_lags[0],animation_lags[-1]],
+                        help = 'first and last lag in days')
+    parser.add_argument('--format',choices = ['gif','apng'],default = 'gif')
+    parser.add_argument('--fps',type = float,default = frames_per_second)
+    parser.add_argument('--workers',type = int,default = None,help = 'processes to use, all cores by default')
+    args = parser.parse_args()
+
+    composites = cp.load_composites(os.path.join(cp.data_path,args.composites))
+    winds = None if args.no_winds else tuple(args.winds)
+    specs = animation_frame_specs(composites,args.variable,winds,range(args.lags[0],args.lags[1] + 1))
+    os.makedirs(fg.figure_path,exist_ok = True)
+    extension = 'gif' if args.format == 'gif' else 'png'
+    out_file = os.path.join(fg.figure_path,f'TTT_{args.variable.upper()}_LAG_COMP_ANIMATION.{extension}')
+    print(f'Wrote {write_animation(specs,out_file,args.fps,args.workers)}')
+
+    return None
+
+if __name__ == "__main__":
+    main()
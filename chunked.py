@@ -0,0 +1,127 @@
+# Out-of-core versions of the climatology, anomaly, and box mean steps. A
+# variable is read from its .nc file in time blocks whose working arrays fit
+# in memory_budget_mb, so only the (365,lat,lon) climatology and one block
+# are ever in memory instead of the whole (time,lat,lon) variable.
+#
+# ERA5 takes two passes over the file, the first sums the climatology and
+# the second removes it from each block and reduces the block to the box
+# means. OLR has its climatology in a separate file so it takes one. The
+# sums and subtractions are done in the same order and dtype as the in
+# memory code in TTT_index and make_ml_dataset, so the results match it.
+#
+# The composites (composites.accumulate) size their time chunks with
+# block_length as well.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import numpy.ma as ma #masked array management, common with .nc files
+from grid_tools import weighted_box_means #box reduction of each block
+from instrumentation import count #NetCDF bytes read
+import dtype_policy as dp #field and accumulator dtypes
+
+# settings
+#memory the working arrays of a block may use
+memory_budget_mb = 1024
+#rough bytes per grid cell and time step that a block needs (the data
+#as read, its anomalies, and the float64 temporaries of the box means)
+climatology_bytes_per_cell = 24
+anomaly_bytes_per_cell = 32
+
+# Functions go here
+def block_length(n_cells:int,bytes_per_cell:int,fixed_bytes:int = 0,budget_mb:float = None,
+                 max_length:int = None) -> int:
+    '''
+        The number of time steps per block so a block fits in the memory
+        budget after fixed_bytes (e.g. the climatology) are set aside.
+
+        n_cells (int): Grid cells per time step
+        bytes_per_cell (int): Working bytes per cell and time step
+        fixed_bytes (int): Memory that is in use for the whole pass
+        budget_mb (float): The budget, memory_budget_mb if None
+        max_length (int): Upper limit, e.g. the length of the record
+
+        Returns at least 1, even when the fixed memory alone is over budget
+    '''
+    budget = (memory_budget_mb if budget_mb is None else budget_mb) * 2**20
+    length = int((budget - fixed_bytes) // (n_cells * bytes_per_cell))
+    if max_length is not None:
+        length = min(length,max_length)
+
+    return max(length,1)
+
+def slice_length(dim_slice:slice,size:int) -> int:
+    '''
+        The number of points a slice selects from an axis of length size
+    '''
+
+    return len(range(*dim_slice.indices(size)))
+
+def read_blocks(variable,lat_slice:slice,lon_slice:slice,block:int,fill_below:float = None):
+    '''
+        Reads a (time,lat,lon) .nc variable one block of times at a time.
+
+        fill_below (float): Values below this are set to NaN (the NOAA
+            missing values), nothing is replaced if None
+
+        Yields the start of each block and the block as read
+    '''
+    for ts in range(0,variable.shape[0],block):
+        chunk = ma.getdata(variable[ts:ts+block,lat_slice,lon_slice])
+        count('netcdf_bytes',chunk.nbytes)
+        if fill_below is not None:
+            chunk[chunk < fill_below] = np.nan
+        yield ts,chunk
+
+def climatology(variable,doy_index:np.ndarray,lat_slice:slice = slice(None),lon_slice:slice = slice(None),
+                block:int = None) -> np.ndarray:
+    '''
+        The 365 day mean of a .nc variable from one pass over it in time
+        blocks, the same sums in the same order as make_era5_climatology so
+        the result is identical to it.
+
+        variable: The netCDF4 variable with shape (time,lat,lon)
+        doy_index (np.ndarray): The 0-364 climatology day of every time
+        block (int): Times per block, sized to memory_budget_mb if None
+
+        Returns the climatology in the field dtype with shape (365,lat,lon),
+        the sums are kept in the accumulator dtype
+    '''
+    n_lat = slice_length(lat_slice,variable.shape[1])
+    n_lon = slice_length(lon_slice,variable.shape[2])
+    clim_sum = np.zeros((365,n_lat,n_lon),dtype = dp.accumulator_dtype)
+    clim_count = np.zeros(365)
+    if block is None:
+        block = block_length(n_lat * n_lon,climatology_bytes_per_cell,clim_sum.nbytes,max_length = variable.shape[0])
+    for ts,chunk in read_blocks(variable,lat_slice,lon_slice,block):
+        chunk_doys = doy_index[ts:ts+len(chunk)]
+        #np.add.at adds repeated days in time order, like adding one day at a time
+        np.add.at(clim_sum,chunk_doys,chunk.astype(dp.accumulator_dtype))
+        np.add.at(clim_count,chunk_doys,1)
+
+    return (clim_sum / clim_count[:,None,None]).astype(dp.field_dtype)
+
+def box_anomalies(variable,doy_index:np.ndarray,clim:np.ndarray,weights:np.ndarray,lat_slice:slice = slice(None),
+                  lon_slice:slice = slice(None),block:int = None,fill_below:float = None) -> np.ndarray:
+    '''
+        The box means of the anomalies of a .nc variable from one pass over
+        it in time blocks. Each block has the climatology of its days
+        removed and is reduced to the box means before the next is read.
+
+        variable: The netCDF4 variable with shape (time,lat,lon)
+        doy_index (np.ndarray): The 0-364 climatology day of every time
+        clim (np.ndarray): The (365,lat,lon) climatology
+        weights (np.ndarray): The (lat*lon,box) matrix from box_weight_matrix
+        block (int): Times per block, sized to memory_budget_mb if None
+        fill_below (float): Values below this are set to NaN first
+
+        Returns the box means with shape (time,box)
+    '''
+    n_cells = weights.shape[0]
+    box_means = np.empty((variable.shape[0],weights.shape[1]))
+    if block is None:
+        block = block_length(n_cells,anomaly_bytes_per_cell,clim.nbytes,max_length = variable.shape[0])
+    for ts,chunk in read_blocks(variable,lat_slice,lon_slice,block,fill_below):
+        anoms = dp.as_field(chunk) - clim[doy_index[ts:ts+len(chunk)]]
+        box_means[ts:ts+len(chunk)] = weighted_box_means(anoms,weights,time_chunk = len(anoms))
+
+    return box_means
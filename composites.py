@@ -0,0 +1,370 @@
+# Lagged composites of the anomaly fields around TTT events. Every variable
+# is streamed a time chunk at a time and each chunk is reduced with a sparse
+# selection matrix (group x time), so the running sum, sum of squares, and
+# count of every lag come out of one pass over the data and the memory used
+# doesn't depend on how many events there are.
+#
+# The same pass gives composites grouped by any integer label per day (MJO
+# phase, month, ...), every group is a row of the selection matrix so all
+# of the groups come out of one read of each variable.
+#
+# The anomalies can be cached as a (time,lat,lon) float32 .npy per variable
+# so later passes skip the climatology and the .nc decoding.
+#
+# Usage:
+#   python composites.py --lags -10 10 --variables olr q850 u850 v850
+#   python composites.py --group-by mjo_phase
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+from netCDF4 import Dataset #.nc file handling
+from scipy import sparse #selection matrices
+import argparse #command line interface
+import os #path/file management
+from date_tools import ymd_to_datetime64,date_lookup,hours_to_dates,austral_summer_mask,date_months
+from mjo_tools import omi_phase,load_mjo_index #MJO phase groups
+from grid_tools import get_grid_index #grid lookups
+from gridded_export import CHANNELS,OLR_clim_file,read_coords,stream_climatology
+import chunked #time chunks sized to a memory budget
+from ingest import input_file #reads from the chunked store when there is one
+import dtype_policy as dp #field and accumulator dtypes
+from harmonics import fit_harmonics,climatology_days #smoothed climatology
+
+# Paths go here
+root = os.getcwd()
+data_path = root + '/DATA'
+anomaly_path = data_path + '/ANOMALIES'
+
+# the variables that can be composited, name -> (file,key,time reference date)
+COMPOSITE_VARIABLES = dict(CHANNELS,
+                           u500 = ('ERA5_u500.nc','u','1900-01-01'),
+                           v500 = ('ERA5_v500.nc','v','1900-01-01'))
+#OLR is cut down to this box (left,bottom,right,top), the ERA5 files already are
+olr_domain = [0,-40,80,10]
+ttt_index_file = 'TTT_Index.csv'
+composite_file = 'TTT_LAG_COMPOSITES.npz'
+grouped_file = 'TTT_GROUPED_COMPOSITES.npz'
+omi_file = 'MJO_OMI.txt'
+
+# default settings
+default_lags = range(-10,11)
+time_chunk = 365
+#keep a float32 (dtype_policy.field_dtype) anomaly cube per variable in anomaly_path
+cache_anomalies = True
+#'daily' or 'harmonic' (the climatology smoothed to its first n_harmonics annual harmonics)
+climatology_mode = 'daily'
+n_harmonics = 3
+#OMI amplitude below which a day is grouped as phase 0 (weak MJO)
+mjo_weak_threshold = 1.0
+
+# Functions go here
+def variable_grid(name:str) -> tuple[np.ndarray,np.ndarray,np.ndarray,slice,slice]:
+    '''
+        Gets the dates and the (cut down) grid of a variable.
+
+        Returns the dates (datetime64[D]), lats, lons, and the lat and lon
+        slices into the file
+    '''
+    file,_,ref_date = COMPOSITE_VARIABLES[name]
+    with Dataset(input_file(file,data_path)) as nc_data:
+        lats,lons = read_coords(nc_data)
+        dates = hours_to_dates(nc_data.variables['time'][:],ref_date)
+    if name == 'olr':
+        lat_slice,lon_slice = get_grid_index(lats,lons).box_slices(olr_domain)
+    else:
+        lat_slice,lon_slice = slice(None),slice(None)
+
+    return dates,lats[lat_slice],lons[lon_slice],lat_slice,lon_slice
+
+def read_anomaly_chunks(name:str,chunk_size:int = time_chunk,starts:np.ndarray = None):
+    '''
+        Reads a variable from its .nc file a time chunk at a time and removes
+        the daily climatology (the 1981-2010 file for OLR, a climatology of
+        the whole file for ERA5), or its harmonic fit for climatology_mode
+        'harmonic'.
+
+        starts (np.ndarray): Only the chunks starting at these times, all of
+            them if None
+
+        Yields the start of each chunk and its float32 anomalies
+    '''
+    file,key,_ = COMPOSITE_VARIABLES[name]
+    dates,_,_,lat_slice,lon_slice = variable_grid(name)
+    with Dataset(input_file(file,data_path)) as nc_data:
+        variable = nc_data.variables[key]
+        if name == 'olr':
+            with Dataset(input_file(OLR_clim_file,data_path)) as clim_data:
+                clim = dp.as_field(clim_data.variables['olr'][:,lat_slice,lon_slice])
+        else:
+            clim = stream_climatology(variable,dates,lat_slice,lon_slice,chunk_size)
+        if climatology_mode == 'harmonic':
+            clim = fit_harmonics(clim,n_harmonics)
+        starts = range(0,len(dates),chunk_size) if starts is None else starts
+        for ts in starts:
+            chunk = dp.as_field(variable[ts:ts+chunk_size,lat_slice,lon_slice])
+            chunk[chunk < -9999] = np.nan
+            chunk -= clim[climatology_days(dates[ts:ts+chunk_size],clim)]
+            yield ts,chunk
+
+def anomaly_cube(name:str,chunk_size:int = time_chunk) -> np.ndarray:
+    '''
+        The cached (time,lat,lon) float32 anomalies of a variable, built the
+        first time and rebuilt whenever the .nc file is newer.
+
+        Returns the cube as a read-only memory map
+    '''
+    file,_,_ = COMPOSITE_VARIABLES[name]
+    cube_name = name if climatology_mode == 'daily' else f'{name}_H{n_harmonics}'
+    cube_file = os.path.join(anomaly_path,cube_name + '.npy')
+    if os.path.isfile(cube_file) and os.path.getmtime(cube_file) >= os.path.getmtime(input_file(file,data_path)):
+        return np.load(cube_file,mmap_mode = 'r')
+
+    print(f'Caching {name} anomalies')
+    os.makedirs(anomaly_path,exist_ok = True)
+    dates,lats,lons,_,_ = variable_grid(name)
+    #written under a temporary name so an interrupted build isn't picked up
+    cube = np.lib.format.open_memmap(cube_file + '.tmp',mode = 'w+',dtype = dp.field_dtype,
+                                     shape = (len(dates),len(lats),len(lons)))
+    for ts,chunk in read_anomaly_chunks(name,chunk_size):
+        cube[ts:ts+len(chunk)] = chunk
+    cube.flush()
+    del cube
+    os.replace(cube_file + '.tmp',cube_file)
+
+    return np.load(cube_file,mmap_mode = 'r')
+
+def anomaly_chunks(name:str,chunk_size:int = time_chunk,times:np.ndarray = None):
+    '''
+        Streams the anomalies of a variable a time chunk at a time, from the
+        cache if cache_anomalies is True.
+
+        times (np.ndarray): Time indices that are needed, chunks without any
+            of them are skipped. All chunks if None.
+
+        Yields the start of each chunk and its float32 anomalies
+    '''
+    starts = None if times is None else np.unique(np.asarray(times) // chunk_size) * chunk_size
+    if not cache_anomalies:
+        yield from read_anomaly_chunks(name,chunk_size,starts)
+        return
+    cube = anomaly_cube(name,chunk_size)
+    starts = range(0,cube.shape[0],chunk_size) if starts is None else starts
+    for ts in starts:
+        yield int(ts),np.asarray(cube[ts:ts+chunk_size])
+
+def selection_matrix(file_dates:np.ndarray,date_sets:list) -> sparse.csr_matrix:
+    '''
+        Builds the sparse (set,time) matrix counting how many times each
+        day of the file is in each set of dates. Dates the file doesn't have
+        are left out.
+    '''
+    rows = []
+    cols = []
+    for s,dates in enumerate(date_sets):
+        index,found = date_lookup(file_dates,dates)
+        cols.append(index[found])
+        rows.append(np.full(int(found.sum()),s))
+    rows = np.concatenate(rows) if rows else np.zeros(0,dtype = np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0,dtype = np.int64)
+
+    #repeated (set,time) pairs are summed when the matrix is built
+    return sparse.csr_matrix((np.ones(len(rows)),(rows,cols)),shape = (len(date_sets),len(file_dates)))
+
+def label_selection(file_dates:np.ndarray,dates:np.ndarray,labels:np.ndarray) -> tuple[np.ndarray,sparse.csr_matrix]:
+    '''
+        Builds a (group,time) selection matrix with a row for each distinct
+        label, so applying it scatter adds every day into its group's sums
+        (a bincount over the labels for every grid cell at once). Dates the
+        file doesn't have are left out.
+
+        Returns the groups (sorted labels) and the selection matrix
+    '''
+    groups,group_index = np.unique(np.asarray(labels),return_inverse = True)
+    index,found = date_lookup(file_dates,dates)
+    selection = sparse.csr_matrix((np.ones(int(found.sum())),(group_index[found],index[found])),
+                                  shape = (len(groups),len(file_dates)))
+
+    return groups,selection
+
+def accumulate(name:str,selection:sparse.spmatrix,chunk_size:int = time_chunk,squares:bool = True) -> dict:
+    '''
+        Reduces a variable with a (group,time) selection matrix in one pass,
+        only reading the chunks some group needs. NaNs are skipped. Sums are
+        kept in float64. With chunk_size None the chunks are sized so they
+        fit in chunked.memory_budget_mb next to the sums.
+
+        squares (bool): Whether to sum the squares too (for the std. dev.),
+            means alone don't need them
+
+        Returns the sum, the sum of squares (None without squares), and the
+        count of every group and grid cell with shape (group,lat,lon), plus
+        the lats and lons
+    '''
+    _,lats,lons,_,_ = variable_grid(name)
+    selection = sparse.csc_matrix(selection)
+    n_cells = len(lats) * len(lons)
+    sums = np.zeros((selection.shape[0],n_cells))
+    sum_squares = np.zeros((selection.shape[0],n_cells)) if squares else None
+    counts = np.zeros((selection.shape[0],n_cells))
+    if chunk_size is None:
+        chunk_size = chunked.block_length(n_cells,chunked.anomaly_bytes_per_cell,(3 if squares else 2) * sums.nbytes,
+                                          max_length = selection.shape[1])
+    needed = np.flatnonzero(np.diff(selection.indptr))
+    for ts,chunk in anomaly_chunks(name,chunk_size,needed):
+        weights = selection[:,ts:ts+len(chunk)].tocsr()
+        block = chunk.reshape(len(chunk),n_cells).astype(dp.accumulator_dtype)
+        valid = ~np.isnan(block)
+        block[~valid] = 0.0
+        sums += weights @ block
+        if squares:
+            sum_squares += weights @ (block * block)
+        counts += weights @ valid.astype(np.float64)
+    shape = (selection.shape[0],len(lats),len(lons))
+
+    return {'sum':sums.reshape(shape),'sum_sq':None if sum_squares is None else sum_squares.reshape(shape),
+            'count':counts.reshape(shape),'lats':lats,'lons':lons}
+
+def composite_stats(sums:dict) -> dict:
+    '''
+        Turns the sums from accumulate into the mean and std. dev.
+        composites (float32), cells without any data are NaN
+    '''
+    with np.errstate(invalid = 'ignore',divide = 'ignore'):
+        mean = sums['sum'] / sums['count']
+        variance = np.maximum(sums['sum_sq'] / sums['count'] - mean * mean,0.0)
+
+    return {'mean':mean.astype(np.float32),'std':np.sqrt(variance).astype(np.float32),
+            'count':sums['count'].astype(np.int32),'lats':sums['lats'],'lons':sums['lons']}
+
+def load_event_dates(start:str = '1979-01-01') -> np.ndarray:
+    '''
+        The TTT event days in austral summer (Oct - May) from TTT_Index.csv
+    '''
+    ttt_file_data = np.loadtxt(os.path.join(data_path,ttt_index_file),skiprows = 1,delimiter = ',',ndmin = 2)
+    dates = ymd_to_datetime64(ttt_file_data[:,0],ttt_file_data[:,1],ttt_file_data[:,2])
+    events = (ttt_file_data[:,4] == 1) & austral_summer_mask(dates) & (dates >= np.datetime64(start))
+
+    return dates[events]
+
+def lagged_composites(event_dates:np.ndarray,lags:list = default_lags,variables:list = None,
+                      chunk_size:int = time_chunk) -> dict:
+    '''
+        Mean and std. dev. composites of every variable at every lag around
+        the event dates, from one pass over each variable.
+
+        event_dates (np.ndarray): The event days (lag 0)
+        lags (list): Days relative to the events, negative lags come before
+        variables (list): Names from COMPOSITE_VARIABLES, all of them if None
+
+        Returns the lags and, for each variable, the mean, std, and count
+        with shape (lag,lat,lon) and its lats and lons
+    '''
+    lags = np.asarray(list(lags))
+    variables = list(COMPOSITE_VARIABLES) if variables is None else list(variables)
+    event_dates = np.asarray(event_dates,dtype = 'datetime64[D]')
+    composites = {'lags':lags}
+    for name in variables:
+        print(f'Compositing {name}')
+        file_dates = variable_grid(name)[0]
+        selection = selection_matrix(file_dates,[event_dates + np.timedelta64(int(lag),'D') for lag in lags])
+        composites[name] = composite_stats(accumulate(name,selection,chunk_size))
+
+    return composites
+
+def grouped_composites(dates:np.ndarray,labels:np.ndarray,variables:list = None,
+                       chunk_size:int = time_chunk) -> dict:
+    '''
+        Mean and std. dev. composites of every variable for each distinct
+        label, from one pass over each variable.
+
+        dates (np.ndarray): The days to composite (e.g. the event days)
+        labels (np.ndarray): An integer label for each day, e.g. the MJO
+            phase from omi_phase_check or the month
+        variables (list): Names from COMPOSITE_VARIABLES, all of them if None
+
+        Returns the groups and, for each variable, the mean, std, and count
+        with shape (group,lat,lon) and its lats and lons
+    '''
+    variables = list(COMPOSITE_VARIABLES) if variables is None else list(variables)
+    dates = np.asarray(dates,dtype = 'datetime64[D]')
+    composites = {}
+    for name in variables:
+        print(f'Compositing {name}')
+        groups,selection = label_selection(variable_grid(name)[0],dates,labels)
+        composites[name] = composite_stats(accumulate(name,selection,chunk_size))
+    composites['groups'] = np.unique(np.asarray(labels))
+
+    return composites
+
+def mjo_phase_labels(dates:np.ndarray,weak_threshold:float = mjo_weak_threshold) -> np.ndarray:
+    '''
+        The OMI phase (1-8) of each day, 0 for weak MJO days and -1 for days
+        the index doesn't cover
+    '''
+    omi_index = load_mjo_index(os.path.join(data_path,omi_file))
+    phases = omi_phase(omi_index['pc1'],omi_index['pc2'],omi_index['amp'],weak_threshold)
+    index,found = date_lookup(omi_index['dates'],dates)
+
+    return np.where(found,phases[index],-1)
+
+def save_composites(composites:dict,file_name:str) -> None:
+    '''
+        Saves composites to a .npz, arrays are stored as <variable>_<field>
+    '''
+    arrays = {}
+    for name,value in composites.items():
+        if isinstance(value,dict):
+            arrays.update({f'{name}_{field}':array for field,array in value.items()})
+        else:
+            arrays[name] = value
+    np.savez_compressed(file_name,**arrays)
+
+    return None
+
+def load_composites(file_name:str) -> dict:
+    '''
+        Loads composites saved by save_composites back into the nested
+        variable -> field layout
+    '''
+    composites = {}
+    with np.load(file_name) as saved:
+        for key in saved.files:
+            name = next((name for name in COMPOSITE_VARIABLES if key.startswith(name + '_')),None)
+            if name is None:
+                composites[key] = saved[key]
+            else:
+                composites.setdefault(name,{})[key[len(name) + 1:]] = saved[key]
+
+    return composites
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Lagged composites of the anomaly fields around TTT events.')
+    parser.add_argument('--lags',type = int,nargs = 2,default = [default_lags[0],default_lags[-1]],
+                        help = 'first and last lag in days')
+    parser.add_argument('--variables',nargs = '+',choices = list(COMPOSITE_VARIABLES),default = None)
+    parser.add_argument('--group-by',choices = ['month','mjo_phase'],default = None,
+                        help = 'composite the events by group instead of by lag')
+    parser.add_argument('--out',default = None,help = 'file in the data folder to write to')
+    parser.add_argument('--memory-mb',type = float,default = None,
+                        help = 'size the time chunks to this memory budget instead of time_chunk days')
+    args = parser.parse_args()
+
+    chunk_size = time_chunk
+    if args.memory_mb is not None:
+        chunked.memory_budget_mb = args.memory_mb
+        chunk_size = None
+    event_dates = load_event_dates()
+    print(f'{len(event_dates)} TTT events')
+    if args.group_by is None:
+        composites = lagged_composites(event_dates,range(args.lags[0],args.lags[1] + 1),args.variables,chunk_size)
+    else:
+        labels = date_months(event_dates) if args.group_by == 'month' else mjo_phase_labels(event_dates)
+        composites = grouped_composites(event_dates,labels,args.variables,chunk_size)
+    out_file = args.out if args.out is not None else (composite_file if args.group_by is None else grouped_file)
+    save_composites(composites,os.path.join(data_path,out_file))
+
+    return None
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# Vectorized date handling shared by the processing scripts. Dates are kept
+# as numpy datetime64[D] so they can be compared, sorted and searched
+# without building datetime objects one row at a time.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+
+# Functions Go Here
+def ymd_to_datetime64(year:np.ndarray,month:np.ndarray,day:np.ndarray) -> np.ndarray:
+    '''
+        Converts arrays of year, month, and day (as read from a text file, so
+        floats are fine) into a datetime64[D] array.
+    '''
+    year = np.asarray(year).astype(np.int64)
+    month = np.asarray(month).astype(np.int64)
+    day = np.asarray(day).astype(np.int64)
+    months = (year - 1970) * 12 + (month - 1)
+
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (day - 1)
+
+def to_datetime64(dates:np.ndarray) -> np.ndarray:
+    '''
+        Converts an array of datetime objects (or any datetime64) to
+        datetime64[D]. Times within the day are dropped, so ERA5 12:00 times
+        and OLR 00:00 times end up on the same daily key.
+    '''
+    dates = np.asarray(dates)
+    if not np.issubdtype(dates.dtype,np.datetime64):
+        dates = dates.astype('datetime64[us]')
+
+    return dates.astype('datetime64[D]')
+
+'''
+    Date keyed alignment. Every source is matched to the target dates through
+    a sort + binary search (O(n log n)) instead of assuming that all of the
+    sources start on the same day and have no gaps.
+'''
+def date_lookup(source_dates:np.ndarray,target_dates:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        Finds where each of the target dates is in source_dates.
+
+        Returns the indices into source_dates and a boolean array that is
+        False where a target date isn't in source_dates (the index there is
+        meaningless and set to 0)
+    '''
+    source_dates = to_datetime64(source_dates)
+    target_dates = to_datetime64(target_dates)
+    if len(source_dates) == 0:
+        return np.zeros(len(target_dates),dtype = np.int64),np.zeros(len(target_dates),dtype = bool)
+
+    order = np.argsort(source_dates,kind = 'stable')
+    sorted_dates = source_dates[order]
+    pos = np.searchsorted(sorted_dates,target_dates)
+    pos[pos == len(sorted_dates)] = len(sorted_dates) - 1
+    found = sorted_dates[pos] == target_dates
+    indices = np.where(found,order[pos],0)
+
+    return indices,found
+
+def align_series(target_dates:np.ndarray,series:dict,verbose:bool = True) -> tuple[dict,dict]:
+    '''
+        Joins any number of series onto target_dates.
+
+        target_dates (np.ndarray): The dates every series is aligned to
+        series (dict): name -> (dates,values) where values has time as its
+            first axis
+        verbose (bool): Whether or not to print how many dates each series
+            is missing
+
+        Missing dates are filled with NaN (values are cast to float).
+
+        Returns the aligned values (name -> array) and the missing dates
+        (name -> datetime64 array)
+    '''
+    target_dates = to_datetime64(target_dates)
+    aligned = {}
+    missing = {}
+    #series that share a dates array (e.g. every box of an ERA5 file) share a lookup
+    lookups = {}
+    for name,(dates,values) in series.items():
+        values = np.asarray(values)
+        if len(dates) != len(values):
+            raise ValueError(f'{name} has {len(dates)} dates but {len(values)} values.')
+        if id(dates) not in lookups:
+            lookups[id(dates)] = date_lookup(dates,target_dates)
+        indices,found = lookups[id(dates)]
+        gathered = values[indices]
+        if not np.all(found):
+            gathered = gathered.astype(np.result_type(gathered.dtype,np.float32))
+            gathered[~found] = np.nan
+        aligned[name] = gathered
+        missing[name] = target_dates[~found]
+        if verbose and len(missing[name]) > 0:
+            print(f'{name} is missing {len(missing[name])} of {len(target_dates)} dates '
+                  f'(first missing {missing[name][0]})')
+
+    return aligned,missing
+
+def date_months(dates:np.ndarray) -> np.ndarray:
+    '''
+        Returns the month (1-12) of each date
+    '''
+
+    return (to_datetime64(dates).astype('datetime64[M]').astype(np.int64) % 12) + 1
+
+def austral_summer_mask(dates:np.ndarray) -> np.ndarray:
+    '''
+        Returns True for dates in austral summer (Oct - May)
+    '''
+    months = date_months(dates)
+
+    return (months >= 10) | (months <= 5)
+
+def noleap_doy(dates:np.ndarray) -> np.ndarray:
+    '''
+        Gets the day of year (1-365) for each date. On leap years Feb 29th
+        and March 1st are considered the same day so the maximum DOY is 365,
+        the same as doy_calc in make_ml_dataset.
+    '''
+    dates = to_datetime64(dates)
+    years = dates.astype('datetime64[Y]')
+    doy = (dates - years.astype('datetime64[D]')).astype(np.int64) + 1
+    year_numbers = years.astype(np.int64) + 1970
+    leap = (year_numbers % 4 == 0) & ((year_numbers % 100 != 0) | (year_numbers % 400 == 0))
+    #everything from March 1st (doy 61) on shifts back a day in leap years
+    #so Feb 29th and March 1st are both 60
+    doy[leap & (doy >= 61)] -= 1
+
+    return doy
+
+def hours_to_dates(hours:np.ndarray,ref_date:str) -> np.ndarray:
+    '''
+        Converts a .nc time axis in hours since ref_date (e.g. '1900-01-01'
+        for ERA5, '1800-01-01' for the NOAA OLR) to datetime64[D]
+    '''
+    hours = np.rint(np.asarray(hours,dtype = np.float64)).astype(np.int64)
+
+    return (np.datetime64(ref_date,'h') + hours.astype('timedelta64[h]')).astype('datetime64[D]')
+
+def austral_season(dates:np.ndarray) -> np.ndarray:
+    '''
+        Labels each date with the year its austral summer season starts in,
+        Oct - Dec 1990 and Jan - Sep 1991 are both season 1990
+    '''
+    dates = to_datetime64(dates)
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+
+    return np.where(date_months(dates) >= 10,years,years - 1)
@@ -0,0 +1,148 @@
+# The dtype policy for the gridded fields. Fields (the data as read, the
+# climatologies, and the anomalies) are kept in field_dtype, float32 by
+# default, which halves their memory and the memory traffic of the loops
+# over them. Sums over many values (climatologies, box means, composites)
+# are accumulated in accumulator_dtype (float64) and only the result is
+# cast back to field_dtype. Setting field_dtype to np.float64 gives the
+# old all float64 behavior.
+#
+# check_policy runs the TTT index and the ERA5 box features with both
+# dtypes and reports how far apart they are.
+#
+# Usage:
+#   python dtype_policy.py
+#   python dtype_policy.py --rtol 1e-5
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import numpy.ma as ma #masked array management, common with .nc files
+import argparse #command line interface
+import sys #exit code of the check
+
+# settings
+field_dtype = np.float32
+accumulator_dtype = np.float64
+#largest difference allowed by the check, as a fraction of the std. dev. of the series
+check_rtol = 1e-4
+
+# Functions go here
+def as_field(array) -> np.ndarray:
+    '''
+        The data of an array (or masked array) in field_dtype, not copied if
+        it already is
+    '''
+
+    return np.asarray(ma.getdata(array),dtype = field_dtype)
+
+def as_accumulator(array) -> np.ndarray:
+    '''
+        The data of an array (or masked array) in accumulator_dtype, not
+        copied if it already is
+    '''
+
+    return np.asarray(ma.getdata(array),dtype = accumulator_dtype)
+
+def compare_series(reference:np.ndarray,candidate:np.ndarray,rtol:float = check_rtol) -> dict:
+    '''
+        How far candidate is from reference, the largest absolute difference
+        and that difference as a fraction of the std. dev. of reference.
+        NaNs have to be in the same places.
+
+        Returns a dict with max_abs, max_rel, and passed
+    '''
+    reference = np.asarray(reference,dtype = np.float64)
+    candidate = np.asarray(candidate,dtype = np.float64)
+    same_nans = np.array_equal(np.isnan(reference),np.isnan(candidate))
+    valid = ~np.isnan(reference) & ~np.isnan(candidate)
+    max_abs = float(np.max(np.abs(reference[valid] - candidate[valid]))) if valid.any() else 0.0
+    scale = float(np.std(reference[valid])) if valid.any() else 0.0
+    max_rel = max_abs / scale if scale > 0 else max_abs
+
+    return {'max_abs':max_abs,'max_rel':max_rel,'passed':bool(same_nans and max_rel <= rtol)}
+
+def policy_outputs() -> dict:
+    '''
+        The TTT index, its event days, and the ERA5 box features made with
+        the current field_dtype
+    '''
+    import TTT_index as ti
+    #make_ml_dataset changes directory and fetches the OMI file when imported
+    import make_ml_dataset as mm
+
+    outputs = {}
+    olr_dates,olr_lats,olr_lons,olr = ti.retrieve_OLR_data()
+    _,_,olr_clim = ti.retrieve_OLR_clim()
+    olr_anoms = ti.get_OLR_anomalies(olr,olr_clim,olr_dates)
+    E1,E2,W1,W2 = ti.get_box_values(olr_anoms,olr_lats,olr_lons,[ti.E1_box,ti.E2_box,ti.W1_box,ti.W2_box])
+    outputs['TTT_INDEX'] = ti.calculate_index(E1,E2,W1,W2)
+    outputs['TTT_DAYS'] = ti.determine_ttt_days(outputs['TTT_INDEX'],olr_dates)
+    era5_boxes = {'Q850':('ERA5_q850.nc','q',[mm.q850_box]),
+                  'Z200':('ERA5_z200.nc','z',[mm.z200_box1,mm.z200_box2]),
+                  'U850':('ERA5_u850.nc','u',[mm.u850_box]),
+                  'V850':('ERA5_v850.nc','v',[mm.v850_box1,mm.v850_box2]),
+                  'SURF_PRES':('ERA5_surfP.nc','sp',[mm.surfp_box1,mm.surfp_box2]),
+                  'W500':('ERA5_w500.nc','w',[mm.w500_box])}
+    for name,(file,key,boxes) in era5_boxes.items():
+        values,_ = mm.process_era5_data(file,key,boxes)
+        for b,box_values in enumerate(values):
+            outputs[name if len(values) == 1 else f'{name}_B{b + 1}'] = box_values
+
+    return outputs
+
+def check_policy(dtype = np.float32,rtol:float = check_rtol) -> dict:
+    '''
+        Makes the TTT index and the ERA5 box features with float64 fields
+        and again with dtype fields and compares them.
+
+        Returns name -> compare_series result, the event days are compared
+        by the number of days that differ
+    '''
+    #the module the processing code reads the policy from, also when this file runs as a script
+    import dtype_policy as policy
+
+    saved_dtype = policy.field_dtype
+    try:
+        policy.field_dtype = np.float64
+        reference = policy_outputs()
+        policy.field_dtype = dtype
+        candidate = policy_outputs()
+    finally:
+        policy.field_dtype = saved_dtype
+    results = {}
+    for name in reference:
+        if name == 'TTT_DAYS':
+            differing = int(np.sum(reference[name] != candidate[name]))
+            results[name] = {'days_differing':differing,'passed':differing == 0}
+        else:
+            results[name] = compare_series(reference[name],candidate[name],rtol)
+
+    return results
+
+def print_check(results:dict) -> None:
+    '''
+        Prints the results of check_policy
+    '''
+    for name,result in results.items():
+        status = 'ok' if result['passed'] else 'FAILED'
+        if 'days_differing' in result:
+            print(f'{name:<15} {result["days_differing"]} event days differ{"":<22} {status}')
+        else:
+            print(f'{name:<15} max diff {result["max_abs"]:.3e} ({result["max_rel"]:.2e} of the std. dev.)  {status}')
+
+    return None
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Check the float32 fields against float64 ones.')
+    parser.add_argument('--rtol',type = float,default = check_rtol,help = 'largest difference as a fraction of the std. dev.')
+    args = parser.parse_args()
+
+    results = check_policy(np.float32,args.rtol)
+    print_check(results)
+    if not all(result['passed'] for result in results.values()):
+        sys.exit(1)
+
+    return None
+
+if __name__ == "__main__":
+    main()
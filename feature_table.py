@@ -0,0 +1,127 @@
+# Reading and writing the feature table used by the random forest. The table
+# is stored as a typed, compressed columnar file (Parquet or Feather) with a
+# fixed schema, with CSV kept as an optional export.
+#
+# Parquet and Feather need pyarrow installed alongside pandas.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import pandas as pd #table handling and the columnar file formats
+import os #path/file management
+from instrumentation import count #rows written
+
+# the schema of the feature table, columns are written in this order
+#sklearn works in float32 internally so the predictors are stored that way
+FEATURE_SCHEMA = {
+    'DOY':np.int16,
+    'YEAR':np.int16,
+    'MONTH':np.int8,
+    'DAY':np.int8,
+    'TTT_INDEX_VAL':np.float32,
+    'TTT_INDEX_VAL_1D':np.float32,
+    'TTT_INDEX_CLIM':np.float32,
+    'TTT_DAY_BOOL':np.int8,
+    'OMI_AMP':np.float32,
+    'OMI_PHASE':np.int8,
+    'Q850':np.float32,
+    'Z200_B1':np.float32,
+    'Z200_B2':np.float32,
+    'U850':np.float32,
+    'V850_B1':np.float32,
+    'V850_B2':np.float32,
+    'SURF_PRES_B1':np.float32,
+    'SURF_PRES_B2':np.float32,
+    'W500':np.float32,
+    'RAND_VAR':np.int8,
+}
+#any column that isn't in the schema is stored with this dtype
+EXTRA_COLUMN_DTYPE = np.float32
+
+#file extension -> format
+TABLE_FORMATS = {'.parquet':'parquet','.feather':'feather','.csv':'csv'}
+
+# Functions Go Here
+def make_feature_table(columns:dict) -> pd.DataFrame:
+    '''
+        Puts the feature columns into a DataFrame with the schema dtypes.
+        Schema columns come first in schema order, any other columns follow
+        in the order they were given.
+
+        columns (dict): column name -> 1D array, all the same length
+    '''
+    missing = [name for name in FEATURE_SCHEMA if name not in columns]
+    if missing:
+        raise KeyError(f'The feature table is missing the columns {missing}')
+
+    names = list(FEATURE_SCHEMA) + [name for name in columns if name not in FEATURE_SCHEMA]
+    table = {name:np.asarray(columns[name]).astype(FEATURE_SCHEMA.get(name,EXTRA_COLUMN_DTYPE)) for name in names}
+
+    return pd.DataFrame(table,columns = names)
+
+def table_format(file_name:str) -> str:
+    '''
+        Works out the format of a feature table file from its extension
+    '''
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in TABLE_FORMATS:
+        raise ValueError(f'Unknown feature table format {extension}, use one of {list(TABLE_FORMATS)}')
+
+    return TABLE_FORMATS[extension]
+
+def write_feature_table(table:pd.DataFrame,file_name:str) -> None:
+    '''
+        Writes the feature table to file_name, the format is chosen from the
+        extension (.parquet, .feather, or .csv)
+    '''
+    file_format = table_format(file_name)
+    if file_format == 'parquet':
+        table.to_parquet(file_name,compression = 'zstd',index = False)
+    elif file_format == 'feather':
+        table.to_feather(file_name,compression = 'zstd')
+    else:
+        table.to_csv(file_name,index = False)
+    count('rows_written',len(table))
+
+    return None
+
+def load_feature_table(file_name:str) -> pd.DataFrame:
+    '''
+        Loads a feature table written by write_feature_table. CSV files are
+        cast back to the schema dtypes so every format loads the same.
+    '''
+    if not os.path.isfile(file_name):
+        raise FileNotFoundError(f'The feature table {file_name} was not found.')
+    file_format = table_format(file_name)
+    if file_format == 'parquet':
+        return pd.read_parquet(file_name)
+    elif file_format == 'feather':
+        return pd.read_feather(file_name)
+
+    table = pd.read_csv(file_name)
+    dtypes = {name:FEATURE_SCHEMA.get(name,EXTRA_COLUMN_DTYPE) for name in table.columns}
+
+    return table.astype(dtypes)
+
+def iter_feature_table(file_name:str,batch_size:int = 50000):
+    '''
+        Reads a feature table batch_size rows at a time so tables of every
+        day in the record can be used without holding them in memory.
+        Parquet and CSV are streamed, Feather is memory mapped and sliced.
+
+        Yields DataFrames with the same dtypes load_feature_table gives
+    '''
+    if not os.path.isfile(file_name):
+        raise FileNotFoundError(f'The feature table {file_name} was not found.')
+    file_format = table_format(file_name)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(file_name).iter_batches(batch_size = batch_size):
+            yield batch.to_pandas()
+    elif file_format == 'feather':
+        import pyarrow.feather as pf
+        table = pf.read_table(file_name,memory_map = True)
+        for start in range(0,table.num_rows,batch_size):
+            yield table.slice(start,batch_size).to_pandas()
+    else:
+        for table in pd.read_csv(file_name,chunksize = batch_size):
+            yield table.astype({name:FEATURE_SCHEMA.get(name,EXTRA_COLUMN_DTYPE) for name in table.columns})
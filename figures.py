@@ -0,0 +1,182 @@
+# Headless rendering of the composite map figures. Each figure is described
+# by a spec (a dict with the field, contour levels, colormap, optional wind
+# overlay, title, and output file) and the specs are rendered across a
+# process pool with the Agg backend. Every worker sets up matplotlib and
+# cartopy once and keeps the coastline geometry it has already cut to a
+# map extent, so only the first figure of a worker pays for reading it.
+#
+# Usage:
+#   python figures.py --lag 0
+#   python figures.py --composites TTT_LAG_COMPOSITES.npz --lag -5 --workers 8
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import argparse #command line interface
+import functools #cached map features
+import os #path/file management
+from concurrent.futures import ProcessPoolExecutor #parallel rendering
+import composites as cp #saved composites
+
+# Paths go here
+root = os.getcwd()
+figure_path = root + '/FIGURES/'
+
+# settings from the notebooks
+figure_dpi = 350
+quiver_step = 10
+#how each composite variable is drawn (file names as in the notebook), the
+#field is multiplied by scale
+FIGURE_STYLES = {
+    'olr':{'file':'TTT_OLR_COMP','label':'OLR','units':'W/m$^2$','levels':np.arange(-50,51,5),'cmap':'PuOr_r','scale':1},
+    'q850':{'file':'TTT_Q850_COMP','label':'q850','units':'g/kg','levels':np.arange(-3,3.1,0.2),'cmap':'PuOr','scale':1000},
+    'z200':{'file':'TTT_Z200_COMP','label':'z200','units':'m','levels':np.arange(-600,610,50),'cmap':'PuOr_r','scale':1},
+    'u850':{'file':'TTT_U850_COMP','label':'u850','units':'m/s','levels':np.arange(-4,4.1,0.2),'cmap':'PuOr_r','scale':1,'center':0},
+    'v850':{'file':'TTT_V850_COMP','label':'v850','units':'m/s','levels':np.arange(-4,4.1,0.2),'cmap':'PuOr_r','scale':1,'center':0},
+    'sp':{'file':'TTT_SURFP_COMP','label':'Surface Pressure','units':'Pa','levels':np.arange(-250,251,10),'cmap':'PuOr_r','scale':1},
+    'w500':{'file':'TTT_500_WIND_ANOMALIES','label':'500 hPa Vertical Velocity','units':'Pa s$^{-1}$','levels':np.arange(-0.25,0.26,0.01),
+            'cmap':'PuOr_r','scale':1,'winds':('u500','v500')},
+}
+
+# Functions go here
+def init_render_worker() -> None:
+    '''
+        Pool initializer, every worker renders with the non-interactive Agg
+        backend and the notebook's savefig settings
+    '''
+    import matplotlib as mpl
+    mpl.use('Agg')
+    mpl.rcParams['savefig.dpi'] = figure_dpi
+    mpl.rcParams['savefig.facecolor'] = 'white'
+    mpl.rcParams['savefig.bbox'] = 'tight'
+
+    return None
+
+@functools.lru_cache(maxsize = None)
+def coastline_geometries(extent:tuple) -> list:
+    '''
+        The Natural Earth coastlines that fall in a (left,right,bottom,top)
+        extent, read and clipped once per worker
+    '''
+    import cartopy.feature as cfeature
+    from shapely.geometry import box
+
+    clip = box(extent[0],extent[2],extent[1],extent[3])
+
+    return [geometry.intersection(clip) for geometry in cfeature.COASTLINE.geometries() if geometry.intersects(clip)]
+
+def draw_figure(spec:dict):
+    '''
+        Draws one map from a spec and returns the matplotlib figure.
+
+        spec (dict):
+            field (np.ndarray): The (lat,lon) field that is contoured
+            lats,lons (np.ndarray): The grid of the field
+            levels (np.ndarray): Contour levels
+            cmap (str): Colormap name
+            center (float): Optional center of a two slope color norm
+            winds (tuple): Optional (u,v,lats,lons) overlaid as arrows
+            title (str): The title
+            colorbar_label (str): The colorbar label
+    '''
+    import matplotlib.pyplot as plt
+    from matplotlib import colors
+    import cartopy.crs as ccrs
+
+    lats = spec['lats']
+    lons = spec['lons']
+    extent = (float(lons.min()),float(lons.max()),float(lats.min()),float(lats.max()))
+    fig,ax = plt.subplots(subplot_kw = {'projection':ccrs.PlateCarree()})
+    cax = fig.add_axes([0.95,0.15,0.02,0.7])
+    ax.add_geometries(coastline_geometries(extent),crs = ccrs.PlateCarree(),facecolor = 'none',edgecolor = 'k')
+    ax.set_extent(extent,crs = ccrs.PlateCarree())
+    levels = spec['levels']
+    norm = None
+    if spec.get('center') is not None:
+        norm = colors.TwoSlopeNorm(vmin = levels[0],vcenter = spec['center'],vmax = levels[-1])
+    cf = ax.contourf(lons,lats,spec['field'],levels = levels,cmap = spec['cmap'],extend = 'both',norm = norm)
+    if spec.get('winds') is not None:
+        u,v,wind_lats,wind_lons = spec['winds']
+        step = spec.get('quiver_step',quiver_step)
+        q = ax.quiver(wind_lons[::step],wind_lats[::step],u[::step,::step],v[::step,::step],units = 'width')
+        ax.quiverkey(q,0.85,0.85,5,'5 m s$^{-1}$',labelpos = 'E',coordinates = 'figure',color = 'k')
+    plt.colorbar(cf,cax = cax,label = spec.get('colorbar_label',''))
+    ax.set_title(spec.get('title',''))
+    gl = ax.gridlines(draw_labels = True,linewidth = 0.6,alpha = 0.3,color = 'k',linestyle = '--')
+    gl.top_labels = False
+    gl.right_labels = False
+
+    return fig
+
+def render_figure(spec:dict) -> str:
+    '''
+        Draws a spec and saves it to spec['out_file'] (runs in a worker)
+    '''
+    import matplotlib.pyplot as plt
+
+    fig = draw_figure(spec)
+    fig.savefig(spec['out_file'])
+    plt.close(fig)
+
+    return spec['out_file']
+
+def render_figures(specs:list,workers:int = None) -> list:
+    '''
+        Renders the specs across a process pool.
+
+        Returns the files written, in the order of the specs
+    '''
+    with ProcessPoolExecutor(max_workers = workers,initializer = init_render_worker) as pool:
+        return list(pool.map(render_figure,specs))
+
+def composite_figure_specs(composites:dict,lag:int = 0,variables:list = None,out_folder:str = figure_path) -> list:
+    '''
+        Specs for the notebook's composite figures at one lag of a lagged
+        composite (composites.lagged_composites or load_composites)
+
+        Returns a list of specs, one per variable that has a style
+    '''
+    lag_index = int(np.flatnonzero(np.asarray(composites['lags']) == lag)[0])
+    variables = [name for name in FIGURE_STYLES if name in composites] if variables is None else variables
+    lag_name = '' if lag == 0 else f'_LAG{lag:+d}'
+    specs = []
+    for name in variables:
+        style = FIGURE_STYLES[name]
+        composite = composites[name]
+        n_days = int(composite['count'][lag_index].max())
+        lag_title = '' if lag == 0 else f', day {lag:+d}'
+        spec = {'field':composite['mean'][lag_index] * style['scale'],
+                'lats':composite['lats'],
+                'lons':composite['lons'],
+                'levels':style['levels'],
+                'cmap':style['cmap'],
+                'center':style.get('center'),
+                'title':f'TTT Composite {style["label"]} Anomalies{lag_title}, n = {n_days} days',
+                'colorbar_label':f'Composite {style["label"]} Anomalies [{style["units"]}]',
+                'out_file':os.path.join(out_folder,f'{style["file"]}{lag_name}.png')}
+        if 'winds' in style and all(wind in composites for wind in style['winds']):
+            u_name,v_name = style['winds']
+            spec['winds'] = (composites[u_name]['mean'][lag_index],composites[v_name]['mean'][lag_index],
+                             composites[u_name]['lats'],composites[u_name]['lons'])
+        specs.append(spec)
+
+    return specs
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Render the composite figures headless and in parallel.')
+    parser.add_argument('--composites',default = cp.composite_file,help = 'saved lagged composites in the data folder')
+    parser.add_argument('--lag',type = int,nargs = '+',default = [0],help = 'lags to draw')
+    parser.add_argument('--variables',nargs = '+',choices = list(FIGURE_STYLES),default = None)
+    parser.add_argument('--workers',type = int,default = None,help = 'processes to use, all cores by default')
+    args = parser.parse_args()
+
+    composites = cp.load_composites(os.path.join(cp.data_path,args.composites))
+    os.makedirs(figure_path,exist_ok = True)
+    specs = [spec for lag in args.lag for spec in composite_figure_specs(composites,lag,args.variables)]
+    for out_file in render_figures(specs,args.workers):
+        print(f'Wrote {out_file}')
+
+    return None
+
+if __name__ == "__main__":
+    main()
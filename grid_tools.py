@@ -0,0 +1,254 @@
+# Tools for working with the regular lat/lon grids used in this project
+# (NOAA OLR 2.5 deg, ERA5 0.25 deg, NOAA OISST 0.25 deg). Boxes throughout
+# the project are defined as left,bottom,right,top.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import numpy.ma as ma #masked array management, common with .nc files
+import dtype_policy as dp #accumulator dtype
+
+# settings
+#size of the working chunk weighted_box_means reduces at once
+box_chunk_bytes = 64 * 2**20
+
+# Functions/Classes Go Here
+'''
+    Coordinate index objects. These sort a coordinate array once and then
+    resolve box edges to slice ranges with a binary search instead of
+    rescanning the coordinates with np.where(coords == edge) for every box.
+'''
+class CoordinateIndex:
+    '''
+        Index for a single 1D coordinate (lat or lon) that may be stored in
+        ascending (ERA5/OLR lon, OISST lat) or descending (ERA5/OLR lat) order.
+
+        Edges are resolved to the NEAREST grid point, so a box edge doesn't
+        need to fall exactly on the grid. When an edge is exactly halfway
+        between two grid points the point nearer the start of the array wins.
+
+        Slices follow the convention the original np.where lookups used:
+            - the first edge in array order (top for descending lats, left
+              for ascending lons) is INCLUSIVE
+            - the second edge in array order (bottom/right) is EXCLUSIVE
+        so an edge that sits on the grid gives exactly the slice the old
+        exact-equality lookups did.
+
+        coords (np.ndarray): The coordinate values as read from the .nc file
+    '''
+
+    def __init__(self,coords:np.ndarray) -> None:
+        coords = np.asarray(ma.getdata(coords),dtype = np.float64)
+        if coords.ndim != 1 or len(coords) == 0:
+            raise ValueError('Coordinates must be a non-empty 1D array.')
+        self.size = len(coords)
+        self.descending = len(coords) > 1 and coords[0] > coords[-1]
+        #keep an ascending copy for searchsorted
+        self._ascending = coords[::-1].copy() if self.descending else coords.copy()
+        if np.any(np.diff(self._ascending) <= 0):
+            raise ValueError('Coordinates must be strictly monotonic.')
+
+    def nearest(self,value:float) -> int:
+        '''
+            Returns the index (in the original array order) of the grid
+            point nearest to value. O(log n).
+        '''
+        asc = self._ascending
+        pos = int(np.searchsorted(asc,value))
+        if pos == 0:
+            ind = 0
+        elif pos == self.size:
+            ind = self.size - 1
+        else:
+            left_dist = value - asc[pos-1]
+            right_dist = asc[pos] - value
+            if self.descending:
+                #in descending order the larger value comes first
+                ind = pos if right_dist <= left_dist else pos - 1
+            else:
+                ind = pos - 1 if left_dist <= right_dist else pos
+        if self.descending:
+            ind = self.size - 1 - ind
+
+        return ind
+
+    def nearest_indices(self,values:np.ndarray) -> np.ndarray:
+        '''
+            Vectorized nearest for an array of values, used to map one grid
+            onto another (e.g. the 2.5 deg OLR onto the 0.25 deg ERA5 grid)
+        '''
+        asc = self._ascending
+        values = np.asarray(values,dtype = np.float64)
+        pos = np.clip(np.searchsorted(asc,values),1,self.size - 1) if self.size > 1 else np.zeros(values.shape,dtype = np.int64)
+        if self.size > 1:
+            left_dist = values - asc[pos-1]
+            right_dist = asc[pos] - values
+            if self.descending:
+                ind = np.where(right_dist <= left_dist,pos,pos - 1)
+            else:
+                ind = np.where(left_dist <= right_dist,pos - 1,pos)
+        else:
+            ind = pos
+        if self.descending:
+            ind = self.size - 1 - ind
+
+        return ind
+
+    def edge_slice(self,lower:float,upper:float) -> slice:
+        '''
+            Returns the slice covering lower -> upper in the original array
+            order with the first edge inclusive and the second exclusive
+            (see the class docstring).
+
+            lower (float): The smaller coordinate value of the range
+            upper (float): The larger coordinate value of the range
+        '''
+        if lower > upper:
+            raise ValueError(f'Lower edge {lower} is above upper edge {upper}.')
+        if self.descending:
+            return slice(self.nearest(upper),self.nearest(lower))
+
+        return slice(self.nearest(lower),self.nearest(upper))
+
+class GridIndex:
+    '''
+        Pair of coordinate indices for a lat/lon grid that resolves boxes
+        (left,bottom,right,top) to (lat_slice,lon_slice).
+
+        lats (np.ndarray): The latitudes of the grid
+        lons (np.ndarray): The longitudes of the grid
+    '''
+
+    def __init__(self,lats:np.ndarray,lons:np.ndarray) -> None:
+        self.lat_index = CoordinateIndex(lats)
+        self.lon_index = CoordinateIndex(lons)
+        self.lats = np.asarray(ma.getdata(lats),dtype = np.float64)
+        self.lons = np.asarray(ma.getdata(lons),dtype = np.float64)
+        self._box_cache = {}
+        self._weight_cache = {}
+
+    @property
+    def shape(self) -> tuple[int,int]:
+        return (self.lat_index.size,self.lon_index.size)
+
+    def box_slices(self,box:list) -> tuple[slice,slice]:
+        '''
+            Resolves a box given as left,bottom,right,top to the lat and lon
+            slices that select it from a (...,lat,lon) array.
+        '''
+        key = tuple(float(b) for b in box)
+        if key not in self._box_cache:
+            left,bottom,right,top = key
+            self._box_cache[key] = (self.lat_index.edge_slice(bottom,top),
+                                    self.lon_index.edge_slice(left,right))
+
+        return self._box_cache[key]
+
+    def subset(self,box:list) -> tuple[np.ndarray,np.ndarray]:
+        '''
+            Returns the lats and lons that fall within the box
+        '''
+        lat_slice,lon_slice = self.box_slices(box)
+
+        return self.lats[lat_slice],self.lons[lon_slice]
+
+#grid indices are built once per grid and reused
+_grid_cache = {}
+
+def get_grid_index(lats:np.ndarray,lons:np.ndarray) -> GridIndex:
+    '''
+        Returns the GridIndex for the given coordinates, building it only the
+        first time a grid is seen. Grids are identified by their coordinate
+        values so the OLR, ERA5 and OISST grids each get a single index.
+    '''
+    lats = np.asarray(ma.getdata(lats),dtype = np.float64)
+    lons = np.asarray(ma.getdata(lons),dtype = np.float64)
+    key = (lats.tobytes(),lons.tobytes())
+    if key not in _grid_cache:
+        _grid_cache[key] = GridIndex(lats,lons)
+
+    return _grid_cache[key]
+
+'''
+    Area weighted box means. The weights for every box on a grid are built
+    once as a (lat*lon,box) matrix so the means of all the boxes for a file
+    come out of a single matrix product per time chunk rather than one
+    np.nanmean call per box.
+'''
+def box_weight_matrix(grid:GridIndex,boxes:list,weighted:bool = True) -> np.ndarray:
+    '''
+        Makes the (lat*lon,box) weight matrix for a list of boxes. Cells
+        outside a box have a weight of 0, cells inside have a weight of
+        cos(latitude) if weighted is True, otherwise 1 (equal weighting
+        like np.nanmean).
+
+        grid (GridIndex): The grid the boxes are defined on
+        boxes (list): List of boxes given as left,bottom,right,top
+        weighted (bool): Whether or not to weight the cells by cos(latitude)
+
+        The matrix is cached on the grid so it's only built once per set of
+        boxes.
+    '''
+    key = (tuple(tuple(float(b) for b in box) for box in boxes),weighted)
+    if key in grid._weight_cache:
+        return grid._weight_cache[key]
+
+    n_lat,n_lon = grid.shape
+    if weighted:
+        lat_weights = np.cos(np.deg2rad(grid.lats))
+        #cells at the poles have a weight of ~0 but never negative
+        lat_weights = np.clip(lat_weights,0,None)
+    else:
+        lat_weights = np.ones(n_lat)
+
+    weights = np.zeros((len(boxes),n_lat,n_lon))
+    for b,box in enumerate(boxes):
+        lat_slice,lon_slice = grid.box_slices(box)
+        weights[b,lat_slice,lon_slice] = lat_weights[lat_slice,np.newaxis]
+        if not np.any(weights[b]):
+            raise ValueError(f'Box {box} does not contain any grid cells.')
+
+    weights = np.ascontiguousarray(weights.reshape(len(boxes),n_lat*n_lon).T)
+    grid._weight_cache[key] = weights
+
+    return weights
+
+def weighted_box_means(data:np.ndarray,weights:np.ndarray,time_chunk:int = None) -> np.ndarray:
+    '''
+        Computes the weighted mean of data within every box at once.
+
+        NaN cells are dropped and the remaining weights renormalised, so with
+        equal weights this gives the same answer as np.nanmean over each box.
+        A box that is entirely NaN on a given time gets NaN.
+
+        data (np.ndarray): Data with the shape (time,lat,lon)
+        weights (np.ndarray): The (lat*lon,box) matrix from box_weight_matrix
+        time_chunk (int): The number of times to reduce per matrix product,
+            sized so a chunk is about box_chunk_bytes if None
+
+        Returns the box means with shape (time,box)
+    '''
+    n_time = data.shape[0]
+    n_cells = weights.shape[0]
+    box_means = np.empty((n_time,weights.shape[1]))
+    full_weight = weights.sum(axis = 0)
+    if time_chunk is None:
+        time_chunk = box_chunk_bytes // (n_cells * np.dtype(dp.accumulator_dtype).itemsize)
+    time_chunk = max(min(time_chunk,n_time),1)
+    #one buffer for every chunk, the NaNs are zeroed in place
+    buffer = np.empty((time_chunk,n_cells),dtype = dp.accumulator_dtype)
+    for ts in range(0,n_time,time_chunk):
+        stop = min(ts + time_chunk,n_time)
+        chunk = buffer[:stop - ts]
+        np.copyto(chunk,ma.getdata(data[ts:stop]).reshape(-1,n_cells))
+        nan_cells = np.isnan(chunk)
+        if np.any(nan_cells):
+            #zero the NaNs and only count the weight of the valid cells
+            chunk[nan_cells] = 0.0
+            weight_sum = (~nan_cells).astype(np.float64) @ weights
+        else:
+            weight_sum = full_weight
+        with np.errstate(invalid = 'ignore',divide = 'ignore'):
+            box_means[ts:stop] = (chunk @ weights) / weight_sum
+    box_means[np.isinf(box_means)] = np.nan
+
+    return box_means
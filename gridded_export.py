@@ -0,0 +1,188 @@
+# Export of full-domain gridded anomaly fields for the sampled days so that
+# spatial models (CNNs) can be trained on the same samples as the random
+# forest. The fields are written as one (sample,channel,lat,lon) float32
+# memory mapped .npy file alongside a JSON manifest describing the channels.
+#
+# Each variable is streamed from its .nc file a time chunk at a time, so at
+# most one chunk per variable is in memory. All channels are put on the ERA5
+# 0.25 deg grid, OLR is mapped onto it with nearest neighbour lookups.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import numpy.ma as ma #masked array management, common with .nc files
+from netCDF4 import Dataset #.nc file handling
+import json #manifest file
+import os #path/file management
+from date_tools import to_datetime64,date_lookup,noleap_doy,hours_to_dates #vectorized date handling
+from grid_tools import get_grid_index #grid lookups
+from ingest import input_file #reads from the chunked store when there is one
+import dtype_policy as dp #field and accumulator dtypes
+
+# Paths go here
+root = os.getcwd()
+data_path = root + '/DATA'
+
+# the channels that can be exported, name -> (file,key,time reference date)
+CHANNELS = {
+    'q850':('ERA5_q850.nc','q','1900-01-01'),
+    'z200':('ERA5_z200.nc','z','1900-01-01'),
+    'u850':('ERA5_u850.nc','u','1900-01-01'),
+    'v850':('ERA5_v850.nc','v','1900-01-01'),
+    'sp':('ERA5_surfP.nc','sp','1900-01-01'),
+    'w500':('ERA5_w500.nc','w','1900-01-01'),
+    'olr':('olr.day.mean.nc','olr','1800-01-01'),
+}
+OLR_clim_file = 'olr.day.ltm.1981-2010.nc'
+#the grid every channel is put on
+grid_file = 'ERA5_q850.nc'
+
+# Functions go here
+def read_coords(nc_data:Dataset) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        Gets the lats and lons from an open ERA5 or NOAA .nc file
+    '''
+    lat_key = 'latitude' if 'latitude' in nc_data.variables else 'lat'
+    lon_key = 'longitude' if 'longitude' in nc_data.variables else 'lon'
+
+    return ma.getdata(nc_data.variables[lat_key][:]),ma.getdata(nc_data.variables[lon_key][:])
+
+def stream_climatology(variable,dates:np.ndarray,lat_slice:slice,lon_slice:slice,time_chunk:int = 100) -> np.ndarray:
+    '''
+        Makes a 365 day climatology of a .nc variable one time chunk at a
+        time, Feb 29th is folded into March 1st. Sums are kept in the
+        accumulator dtype.
+
+        variable: The netCDF4 variable with shape (time,lat,lon)
+        dates (np.ndarray): The datetime64 dates of the variable
+        time_chunk (int): The number of times read per chunk, at most 365
+
+        Returns the climatology in the field dtype with shape (365,lat,lon)
+    '''
+    time_chunk = min(time_chunk,365)
+    doy_index = noleap_doy(dates) - 1
+    n_lat = len(range(*lat_slice.indices(variable.shape[1])))
+    n_lon = len(range(*lon_slice.indices(variable.shape[2])))
+    clim_sum = np.zeros((365,n_lat,n_lon),dtype = dp.accumulator_dtype)
+    clim_count = np.zeros((365,n_lat,n_lon),dtype = np.int32)
+    for ts in range(0,len(dates),time_chunk):
+        chunk = dp.as_accumulator(variable[ts:ts+time_chunk,lat_slice,lon_slice])
+        chunk_doys = doy_index[ts:ts+time_chunk]
+        valid = ~np.isnan(chunk)
+        #np.add.at handles a chunk landing on the same doy twice (Feb 29th/Mar 1st)
+        np.add.at(clim_sum,chunk_doys,np.where(valid,chunk,0.0))
+        np.add.at(clim_count,chunk_doys,valid)
+    with np.errstate(invalid = 'ignore',divide = 'ignore'):
+        clim = clim_sum / clim_count
+
+    return clim.astype(dp.field_dtype)
+
+def export_gridded_features(sample_dates:np.ndarray,out_file:str,channels:list = None,labels:np.ndarray = None,
+                            time_chunk:int = 100) -> dict:
+    '''
+        Writes the anomaly fields of every channel for the sampled days to a
+        (sample,channel,lat,lon) float32 .npy file in the data folder, and a
+        JSON manifest with the same name.
+
+        sample_dates (np.ndarray): The days to export, in the order they
+            should appear along the sample axis
+        out_file (str): The name of the .npy file
+        channels (list): Names from CHANNELS, all of them if None
+        labels (np.ndarray): Optional label for each sample (e.g. the TTT
+            day bool) stored in the manifest for the batch generator
+        time_chunk (int): The number of times read from a file at once
+
+        Days a channel doesn't have are NaN. Returns the manifest.
+    '''
+    channels = list(CHANNELS) if channels is None else list(channels)
+    sample_dates = to_datetime64(sample_dates)
+    os.chdir(data_path)
+    with Dataset(input_file(grid_file)) as grid_data:
+        target_lats,target_lons = read_coords(grid_data)
+    out_shape = (len(sample_dates),len(channels),len(target_lats),len(target_lons))
+    tensor = np.lib.format.open_memmap(out_file,mode = 'w+',dtype = np.float32,shape = out_shape)
+
+    for c,channel in enumerate(channels):
+        file,key,ref_date = CHANNELS[channel]
+        print(f'Exporting {channel}')
+        nc_data = Dataset(input_file(file))
+        variable = nc_data.variables[key]
+        lats,lons = read_coords(nc_data)
+        file_dates = hours_to_dates(nc_data.variables['time'][:],ref_date)
+        #map the target grid onto this file's grid
+        grid = get_grid_index(lats,lons)
+        lat_map = grid.lat_index.nearest_indices(target_lats)
+        lon_map = grid.lon_index.nearest_indices(target_lons)
+        lat_slice = slice(int(lat_map.min()),int(lat_map.max()) + 1)
+        lon_slice = slice(int(lon_map.min()),int(lon_map.max()) + 1)
+        lat_map = lat_map - lat_slice.start
+        lon_map = lon_map - lon_slice.start
+
+        if channel == 'olr':
+            with Dataset(input_file(OLR_clim_file)) as clim_data:
+                clim = ma.getdata(clim_data.variables['olr'][:,lat_slice,lon_slice]).astype(np.float32)
+        else:
+            clim = stream_climatology(variable,file_dates,lat_slice,lon_slice,time_chunk)
+
+        file_index,found = date_lookup(file_dates,sample_dates)
+        tensor[~found,c] = np.nan
+        sample_rows = np.flatnonzero(found)
+        #read the needed times in file order, a chunk of times at a time
+        sample_rows = sample_rows[np.argsort(file_index[sample_rows],kind = 'stable')]
+        for cs in range(0,len(sample_rows),time_chunk):
+            rows = sample_rows[cs:cs+time_chunk]
+            times,inverse = np.unique(file_index[rows],return_inverse = True)
+            chunk = ma.getdata(variable[times,lat_slice,lon_slice]).astype(np.float32)
+            chunk[chunk < -9999] = np.nan
+            chunk -= clim[noleap_doy(file_dates[times]) - 1]
+            tensor[rows,c] = chunk[inverse][:,lat_map][:,:,lon_map]
+        nc_data.close()
+    tensor.flush()
+    del tensor
+
+    manifest = {'file':out_file,
+                'shape':list(out_shape),
+                'dtype':'float32',
+                'layout':['sample','channel','lat','lon'],
+                'channels':channels,
+                'dates':[str(d) for d in sample_dates],
+                'lats':[float(lat) for lat in target_lats],
+                'lons':[float(lon) for lon in target_lons],
+                'labels':None if labels is None else [int(label) for label in labels]}
+    with open(os.path.splitext(out_file)[0] + '.json','w') as manifest_file:
+        json.dump(manifest,manifest_file)
+    os.chdir(root)
+
+    return manifest
+
+def batch_generator(manifest_file:str,batch_size:int = 32,shuffle:bool = True,seed:int = 144,
+                    sample_indices:np.ndarray = None,channels:list = None):
+    '''
+        Yields (features,labels) batches from an exported tensor. The .npy
+        file is memory mapped so only the batch being yielded is read.
+
+        manifest_file (str): Path to the JSON manifest from
+            export_gridded_features (the .npy is expected next to it)
+        batch_size (int): The number of samples per batch
+        shuffle (bool): Whether to shuffle the samples each pass
+        seed (int): The seed for the shuffle
+        sample_indices (np.ndarray): Optional subset of samples to use (e.g.
+            the training split)
+        channels (list): Optional subset of the channel names
+
+        Yields float32 arrays (batch,channel,lat,lon) and the labels (None if
+        the manifest has none)
+    '''
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    tensor = np.load(os.path.join(os.path.dirname(manifest_file),manifest['file']),mmap_mode = 'r')
+    labels = None if manifest['labels'] is None else np.array(manifest['labels'])
+    channel_index = slice(None) if channels is None else [manifest['channels'].index(name) for name in channels]
+    indices = np.arange(tensor.shape[0]) if sample_indices is None else np.asarray(sample_indices)
+    if shuffle:
+        indices = np.random.default_rng(seed).permutation(indices)
+
+    for bs in range(0,len(indices),batch_size):
+        #sorted reads are faster from a memory map, the order within a batch doesn't matter
+        batch = np.sort(indices[bs:bs+batch_size])
+        features = np.asarray(tensor[batch][:,channel_index])
+        yield features,(None if labels is None else labels[batch])
@@ -0,0 +1,146 @@
+# Smoothed climatologies from the first few annual harmonics. The raw 365
+# day mean of a variable has only ~44 years behind each day, so it is
+# noisy from one day to the next. Here the mean and the first n_harmonics
+# annual harmonics of every grid cell are taken from a real FFT over the
+# day of year axis (for 365 evenly spaced days this is the least squares
+# harmonic fit), which keeps 2n+1 coefficient fields instead of 365 daily
+# fields. The climatology of any day is evaluated from the coefficients
+# when it's needed, and leap years are placed on the annual cycle by their
+# true position in the year instead of folding Feb 29th into March 1st.
+#
+# A HarmonicClimatology can be indexed by day like the (365,lat,lon) daily
+# climatology, so it drops into the existing anomaly code.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import os #path/file management
+from date_tools import to_datetime64,noleap_doy #day of year handling
+import dtype_policy as dp #field dtype of the evaluated climatology
+
+# Paths go here
+root = os.getcwd()
+climatology_path = root + '/DATA/CLIMATOLOGY'
+
+# settings
+n_harmonics = 3
+days_per_year = 365
+
+# Functions/Classes Go Here
+class HarmonicClimatology:
+    '''
+        A climatology stored as harmonic coefficients with shape
+        (2n+1,lat,lon), the mean followed by the cos and sin amplitudes of
+        harmonics 1 to n.
+
+        Indexing with day positions (0 to 364, fractions allowed) evaluates
+        the climatology there in the field dtype, clim[59] gives one
+        (lat,lon) field and clim[days] a (day,lat,lon) array, the same as
+        indexing the daily climatology.
+
+        coefficients (np.ndarray): The (2n+1,...) coefficients
+    '''
+
+    def __init__(self,coefficients:np.ndarray) -> None:
+        self.coefficients = np.asarray(coefficients,dtype = np.float64)
+        if self.coefficients.shape[0] % 2 != 1:
+            raise ValueError('Harmonic coefficients need an odd length first axis (mean, cos and sin pairs).')
+        self.n_harmonics = (self.coefficients.shape[0] - 1) // 2
+        self.shape = (days_per_year,) + self.coefficients.shape[1:]
+
+    @property
+    def nbytes(self) -> int:
+        return self.coefficients.nbytes
+
+    def basis(self,days:np.ndarray) -> np.ndarray:
+        '''
+            The (day,2n+1) matrix of 1, cos(2 pi k d/365), sin(2 pi k d/365)
+        '''
+        angles = 2 * np.pi * np.outer(np.asarray(days,dtype = np.float64),np.arange(1,self.n_harmonics + 1)) / days_per_year
+        basis = np.empty((angles.shape[0],2 * self.n_harmonics + 1))
+        basis[:,0] = 1.0
+        basis[:,1::2] = np.cos(angles)
+        basis[:,2::2] = np.sin(angles)
+
+        return basis
+
+    def __getitem__(self,days) -> np.ndarray:
+        days = np.asarray(days,dtype = np.float64)
+        values = self.basis(np.atleast_1d(days)) @ self.coefficients.reshape(self.coefficients.shape[0],-1)
+        values = values.reshape((-1,) + self.shape[1:]).astype(dp.field_dtype)
+
+        return values[0] if days.ndim == 0 else values
+
+def fit_harmonics(daily_clim:np.ndarray,n:int = n_harmonics) -> HarmonicClimatology:
+    '''
+        Keeps the mean and the first n annual harmonics of a (365,...)
+        daily climatology, all grid cells at once with one real FFT along
+        the day axis. Cells with any NaN day get NaN coefficients.
+    '''
+    daily_clim = np.asarray(daily_clim,dtype = np.float64)
+    if daily_clim.shape[0] != days_per_year:
+        raise ValueError(f'The daily climatology has {daily_clim.shape[0]} days, expected {days_per_year}.')
+    spectrum = np.fft.rfft(daily_clim,axis = 0)[:n + 1] / days_per_year
+    coefficients = np.empty((2 * n + 1,) + daily_clim.shape[1:])
+    coefficients[0] = spectrum[0].real
+    coefficients[1::2] = 2 * spectrum[1:].real
+    coefficients[2::2] = -2 * spectrum[1:].imag
+
+    return HarmonicClimatology(coefficients)
+
+def day_positions(dates:np.ndarray) -> np.ndarray:
+    '''
+        Where each date falls in the 365 day annual cycle (0 to <365). Leap
+        years are spread over the same cycle, so Feb 29th sits between Feb
+        28th and March 1st instead of on March 1st.
+    '''
+    dates = to_datetime64(dates)
+    years = dates.astype('datetime64[Y]')
+    day_of_year = (dates - years.astype('datetime64[D]')).astype(np.int64)
+    year_length = ((years + 1).astype('datetime64[D]') - years.astype('datetime64[D]')).astype(np.int64)
+
+    return day_of_year * (days_per_year / year_length)
+
+def climatology_days(dates:np.ndarray,clim) -> np.ndarray:
+    '''
+        The index of each date into a climatology, the day position for a
+        HarmonicClimatology and the 0-364 noleap day (Feb 29th as March 1st)
+        for a daily one
+    '''
+    if isinstance(clim,HarmonicClimatology):
+        return day_positions(dates)
+
+    return noleap_doy(dates) - 1
+
+def save_harmonics(clim:HarmonicClimatology,file_name:str) -> None:
+    '''
+        Saves the coefficients to a .npz
+    '''
+    np.savez(file_name,coefficients = clim.coefficients)
+
+    return None
+
+def load_harmonics(file_name:str) -> HarmonicClimatology:
+    '''
+        Loads coefficients saved by save_harmonics
+    '''
+    with np.load(file_name) as saved:
+        return HarmonicClimatology(saved['coefficients'])
+
+def cached_harmonics(name:str,source_file:str,make_daily,n:int = n_harmonics) -> HarmonicClimatology:
+    '''
+        The harmonic climatology of a variable from climatology_path, fitted
+        and saved the first time and whenever source_file is newer.
+
+        name (str): Name of the cache, e.g. ERA5_q850_q
+        source_file (str): The .nc file the climatology comes from
+        make_daily: Function returning the (365,lat,lon) daily climatology
+        n (int): Number of harmonics
+    '''
+    cache_file = os.path.join(climatology_path,f'{name}_H{n}.npz')
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(source_file):
+        return load_harmonics(cache_file)
+    clim = fit_harmonics(make_daily(),n)
+    os.makedirs(climatology_path,exist_ok = True)
+    save_harmonics(clim,cache_file)
+
+    return clim
@@ -0,0 +1,215 @@
+# Grid and random hyperparameter search for the TTT classifier. The
+# candidates are spread across a process pool, the workers share the feature
+# arrays read-only through memory mapped .npy files, and the fold splits and
+# the score of every candidate are cached on disk so an interrupted search
+# picks up where it stopped.
+#
+# Usage:
+#   python hyperparameter_search.py --mode grid
+#   python hyperparameter_search.py --mode random --n-iter 200 --workers 8
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import argparse #command line interface
+import hashlib #cache keys
+import json #cached scores and results
+import os #path/file management
+import time #candidate timing
+from concurrent.futures import ProcessPoolExecutor,as_completed #parallel candidates
+from sklearn.model_selection import ParameterGrid,ParameterSampler,StratifiedKFold
+import ttt_classifier as tc #shared data loading, model, and metrics
+import parallel_tools as pt #read-only arrays shared with the workers
+from season_splits import season_folds #season blocked folds
+
+# Paths go here
+search_path = tc.model_path + '/SEARCH'
+
+# the parameters searched over for each model backend
+SEARCH_SPACE = {'n_estimators':[50,100,200,400],
+                'max_depth':[None,5,10,20],
+                'min_samples_split':[2,5,10],
+                'min_samples_leaf':[1,2,4],
+                'criterion':['gini','entropy'],
+                'max_features':['sqrt',0.5,None],
+                'class_weight':[None,'balanced']}
+HGB_SEARCH_SPACE = {'learning_rate':[0.02,0.05,0.1,0.2],
+                    'max_leaf_nodes':[15,31,63],
+                    'min_samples_leaf':[10,20,50],
+                    'l2_regularization':[0.0,0.1,1.0],
+                    'class_weight':[None,'balanced']}
+SEARCH_SPACES = {'random_forest':SEARCH_SPACE,
+                 'hist_gradient_boosting':HGB_SEARCH_SPACE}
+n_folds = 5
+#'season' folds of whole seasons, or 'stratified' shuffled days
+fold_mode = 'season'
+
+# Functions go here
+def cache_key(obj) -> str:
+    '''
+        Short stable hash of anything JSON serialisable
+    '''
+
+    return hashlib.sha1(json.dumps(obj,sort_keys = True).encode()).hexdigest()[:16]
+
+def write_json(file_name:str,obj) -> None:
+    '''
+        Writes JSON atomically so an interrupted search never leaves a
+        half written cache file behind
+    '''
+    with open(file_name + '.tmp','w') as f:
+        json.dump(obj,f,indent = 2)
+    os.replace(file_name + '.tmp',file_name)
+
+    return None
+
+def make_candidates(mode:str,n_iter:int = 100,seed:int = tc.RANDNUM,space:dict = None) -> list:
+    '''
+        The parameter sets to try, every combination for grid or n_iter
+        seeded draws for random
+    '''
+    space = SEARCH_SPACE if space is None else space
+    if mode == 'grid':
+        return list(ParameterGrid(space))
+    elif mode == 'random':
+        return list(ParameterSampler(space,n_iter = n_iter,random_state = seed))
+
+    raise ValueError(f'Unknown search mode {mode}, use grid or random')
+
+def make_folds(labels:np.ndarray,dates:np.ndarray,folds:int,seed:int,cache_dir:str) -> list:
+    '''
+        Fold splits of the training data (season blocked or stratified
+        depending on fold_mode), cached on disk by the labels and settings so
+        every candidate (and a resumed search) uses the same folds.
+
+        Returns a list of (train_indices,validation_indices)
+    '''
+    fold_file = os.path.join(cache_dir,f'folds_{cache_key([labels.tolist(),[str(d) for d in dates],folds,seed,fold_mode])}.npz')
+    if os.path.isfile(fold_file):
+        with np.load(fold_file) as cached:
+            return [(cached[f'train_{i}'],cached[f'valid_{i}']) for i in range(folds)]
+
+    if fold_mode == 'season':
+        fold_list = season_folds(dates,folds)
+    else:
+        splitter = StratifiedKFold(n_splits = folds,shuffle = True,random_state = seed)
+        fold_list = list(splitter.split(np.zeros(len(labels)),labels))
+    arrays = {}
+    for i,(train_ind,valid_ind) in enumerate(fold_list):
+        arrays[f'train_{i}'] = train_ind
+        arrays[f'valid_{i}'] = valid_ind
+    np.savez(fold_file,**arrays)
+
+    return fold_list
+
+def score_candidate(params:dict,fold_list:list,backend:str = None) -> dict:
+    '''
+        Fits the candidate on every fold and scores the validation folds.
+        Returns the mean and std. dev. of each metric and the fit time
+    '''
+    X = pt.shared['X']
+    y = pt.shared['y']
+    fold_scores = []
+    start = time.perf_counter()
+    for train_ind,valid_ind in fold_list:
+        model = tc.make_model(params,n_jobs = 1,backend = backend)
+        model.fit(X[train_ind],y[train_ind])
+        probabilities = model.predict_proba(X[valid_ind])[:,1]
+        fold_scores.append(tc.classification_metrics(y[valid_ind],(probabilities >= 0.5).astype(int),probabilities))
+
+    summary = {'params':params,'seconds':time.perf_counter() - start}
+    for key in ('precision','recall','f1','average_precision','accuracy'):
+        values = [scores[key] for scores in fold_scores if key in scores]
+        summary[key + '_mean'] = float(np.mean(values)) if values else float('nan')
+        summary[key + '_std'] = float(np.std(values)) if values else float('nan')
+
+    return summary
+
+def run_search(name:str,mode:str = 'random',n_iter:int = 100,workers:int = None,folds:int = n_folds,
+               file_name:str = None,space:dict = None,backend:str = None) -> list:
+    '''
+        Runs (or resumes) a search on the training split of the feature
+        table.
+
+        name (str): Name of the search, its cache lives in MODELS/SEARCH/name
+        mode (str): grid or random
+        n_iter (int): Number of candidates for a random search
+        workers (int): Number of processes, all cores if None
+        folds (int): Number of cross validation folds
+        backend (str): The ttt_classifier model backend, its default if None
+
+        Returns the candidate summaries sorted by mean F1 of the TTT class
+    '''
+    backend = tc.model_backend if backend is None else backend
+    space = SEARCH_SPACES[backend] if space is None else space
+    cache_dir = os.path.join(search_path,name)
+    os.makedirs(cache_dir,exist_ok = True)
+    predictors,labels,feature_list,dates = tc.load_dataset(file_name)
+    train_ind,_ = tc.split_indices(labels,dates)
+    train_X = predictors[train_ind]
+    train_y = labels[train_ind]
+    fold_list = make_folds(train_y,dates[train_ind],folds,tc.RANDNUM,cache_dir)
+
+    candidates = make_candidates(mode,n_iter,space = space)
+    #the predictor values are part of the key so a rebuilt table with the same columns isn't reused
+    X_hash = hashlib.sha256(np.ascontiguousarray(train_X).tobytes()).hexdigest()
+    data_key = cache_key([feature_list,train_y.tolist(),X_hash,str(train_X.dtype),list(train_X.shape),
+                          folds,fold_mode,backend])
+    results = []
+    todo = []
+    for params in candidates:
+        score_file = os.path.join(cache_dir,f'candidate_{cache_key([params,data_key])}.json')
+        if os.path.isfile(score_file):
+            with open(score_file) as f:
+                results.append(json.load(f))
+        else:
+            todo.append((params,score_file))
+    print(f'{len(results)} of {len(candidates)} candidates already scored, running {len(todo)}')
+
+    #share the training data with the workers through memory maps
+    with pt.shared_arrays(cache_dir,X = train_X,y = train_y) as shared_files, \
+            ProcessPoolExecutor(max_workers = workers,initializer = pt.init_worker,initargs = (shared_files,)) as pool:
+        futures = {pool.submit(score_candidate,params,fold_list,backend):score_file for params,score_file in todo}
+        for done,future in enumerate(as_completed(futures),1):
+            summary = future.result()
+            write_json(futures[future],summary)
+            results.append(summary)
+            print(f'[{done}/{len(todo)}] f1 {summary["f1_mean"]:.3f} recall {summary["recall_mean"]:.3f} '
+                  f'precision {summary["precision_mean"]:.3f} {summary["params"]}')
+
+    results.sort(key = lambda summary: -np.nan_to_num(summary['f1_mean'],nan = -1))
+    write_json(os.path.join(cache_dir,'results.json'),results)
+
+    return results
+
+def print_results(results:list,top:int = 10) -> None:
+    '''
+        Prints the best candidates
+    '''
+    print(f'{"f1":>13} {"recall":>13} {"precision":>13}  params')
+    for summary in results[:top]:
+        print(f'{summary["f1_mean"]:.3f}±{summary["f1_std"]:.3f}   {summary["recall_mean"]:.3f}±{summary["recall_std"]:.3f}'
+              f'   {summary["precision_mean"]:.3f}±{summary["precision_std"]:.3f}  {summary["params"]}')
+
+    return None
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Hyperparameter search for the TTT classifier.')
+    parser.add_argument('--name',default = 'ttt_rf_search',help = 'name of the search, reusing a name resumes it')
+    parser.add_argument('--mode',choices = ['grid','random'],default = 'random')
+    parser.add_argument('--backend',choices = list(SEARCH_SPACES),default = tc.model_backend)
+    parser.add_argument('--n-iter',type = int,default = 100,help = 'candidates for a random search')
+    parser.add_argument('--workers',type = int,default = None,help = 'processes to use, all cores by default')
+    parser.add_argument('--folds',type = int,default = n_folds)
+    parser.add_argument('--features',default = None,help = 'feature table in the data folder')
+    parser.add_argument('--top',type = int,default = 10,help = 'number of candidates to print')
+    args = parser.parse_args()
+
+    results = run_search(args.name,args.mode,args.n_iter,args.workers,args.folds,args.features,
+                         backend = args.backend)
+    print_results(results,args.top)
+
+    return None
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Rewrites the downloaded .nc files into a local store of compressed
+# NetCDF4 files chunked for how this project reads them. The files as
+# delivered are laid out for reading whole fields, but most reads here are
+# either box time series (every time, a small lat/lon window) or event day
+# maps (a few times, the whole field). The store chunks every
+# (time,lat,lon) variable into short time blocks of lat/lon tiles. A box
+# series only decompresses the tiles under the box (its cost hardly depends
+# on the time block length) and a day map only decompresses chunk_days days
+# of the field instead of the whole time axis.
+#
+# The packed values, fill values, and attributes are copied unchanged, so a
+# stored file reads back exactly like the original. The loaders get their
+# paths from input_file, which returns the stored copy whenever it is at
+# least as new as the original, so nothing else has to change. Everything
+# runs on the local files, nothing is downloaded.
+#
+# Usage:
+#   python ingest.py
+#   python ingest.py ERA5_q850.nc olr.day.mean.nc --chunk-days 4 --force
+
+# IMPORTS GO HERE
+from netCDF4 import Dataset #.nc file handling
+import argparse #command line interface
+import glob #finding the input files
+import os #path/file management
+import chunked #copy blocks sized to the memory budget
+
+# Paths go here
+root = os.getcwd()
+data_path = root + '/DATA'
+store_path = data_path + '/STORE'
+
+# settings
+#chunk shape, times per chunk and lat/lon points per tile side
+chunk_days = 8
+tile_size = 64
+compression_level = 4
+
+# Functions go here
+def input_file(file_name:str,folder:str = data_path) -> str:
+    '''
+        The path a loader should read file_name from, the copy in the store
+        when there is one at least as new as the original, otherwise the
+        original in folder
+    '''
+    stored = os.path.join(store_path,os.path.basename(file_name))
+    original = os.path.join(folder,file_name)
+    if os.path.isfile(stored) and (not os.path.isfile(original) or os.path.getmtime(stored) >= os.path.getmtime(original)):
+        return stored
+
+    return original
+
+def chunk_shape(shape:tuple,days:int = chunk_days,tile:int = tile_size) -> tuple:
+    '''
+        Chunk shape for a (time,lat,lon) variable, days times of a tile by
+        tile window (cut to the size of the variable). On a 0.25 deg ERA5
+        field 8 days of 64 x 64 tiles read a single day about 4x faster than
+        64 day chunks and box series just as fast.
+    '''
+    n_time,n_lat,n_lon = shape
+
+    return (min(days,n_time),min(tile,n_lat),min(tile,n_lon))
+
+def copy_attributes(source,target) -> None:
+    '''
+        Copies the attributes of a dataset or variable, except _FillValue
+        which has to be set when the variable is made
+    '''
+    target.setncatts({name:source.getncattr(name) for name in source.ncattrs() if name != '_FillValue'})
+
+    return None
+
+def ingest_file(file_name:str,folder:str = data_path,days:int = chunk_days,tile:int = tile_size,
+                level:int = compression_level) -> str:
+    '''
+        Writes a chunked, compressed copy of a .nc file to the store. The
+        copy is made under a temporary name and moved into place at the end
+        so a failed ingest never leaves a partial file that looks current.
+
+        Returns the stored file
+    '''
+    os.makedirs(store_path,exist_ok = True)
+    out_file = os.path.join(store_path,os.path.basename(file_name))
+    with Dataset(os.path.join(folder,file_name)) as source,Dataset(out_file + '.tmp','w',format = 'NETCDF4') as target:
+        #copy the stored (packed) values, not the decoded ones
+        source.set_auto_maskandscale(False)
+        copy_attributes(source,target)
+        for name,dimension in source.dimensions.items():
+            target.createDimension(name,None if dimension.isunlimited() else len(dimension))
+        for name,variable in source.variables.items():
+            fill_value = variable.getncattr('_FillValue') if '_FillValue' in variable.ncattrs() else None
+            if variable.ndim == 3:
+                chunks = chunk_shape(variable.shape,days,tile)
+                new_variable = target.createVariable(name,variable.datatype,variable.dimensions,zlib = True,
+                                                     complevel = level,shuffle = True,chunksizes = chunks,
+                                                     fill_value = fill_value)
+            else:
+                new_variable = target.createVariable(name,variable.datatype,variable.dimensions,fill_value = fill_value)
+            new_variable.set_auto_maskandscale(False)
+            copy_attributes(variable,new_variable)
+            if variable.ndim == 3:
+                #copy whole time chunks at a time, as many as fit in the budget
+                n_cells = variable.shape[1] * variable.shape[2]
+                block = chunked.block_length(n_cells,2 * variable.dtype.itemsize,max_length = variable.shape[0])
+                block = max(block // chunks[0],1) * chunks[0]
+                for ts in range(0,variable.shape[0],block):
+                    #an unlimited time dimension grows to the slice stop, so stop at the end of the record
+                    stop = min(ts + block,variable.shape[0])
+                    new_variable[ts:stop] = variable[ts:stop]
+            elif variable.ndim > 0:
+                new_variable[:] = variable[:]
+            else:
+                new_variable.assignValue(variable.getValue())
+    os.replace(out_file + '.tmp',out_file)
+
+    return out_file
+
+def needs_ingest(file_name:str,folder:str = data_path) -> bool:
+    '''
+        Whether the store has no copy of a file or an older one
+    '''
+
+    return input_file(file_name,folder) == os.path.join(folder,file_name)
+
+def ingest_files(file_names:list = None,folder:str = data_path,days:int = chunk_days,tile:int = tile_size,
+                 level:int = compression_level,force:bool = False) -> list:
+    '''
+        Ingests every .nc file in folder (or file_names) that isn't in the
+        store or has changed since it was stored.
+
+        Returns the stored files that were written
+    '''
+    if file_names is None:
+        file_names = sorted(os.path.basename(path) for path in glob.glob(os.path.join(folder,'*.nc')))
+    written = []
+    for file_name in file_names:
+        if not force and not needs_ingest(file_name,folder):
+            print(f'{file_name} is already in the store')
+            continue
+        out_file = ingest_file(file_name,folder,days,tile,level)
+        original_size = os.path.getsize(os.path.join(folder,file_name))
+        with Dataset(out_file) as stored:
+            chunking = {name:variable.chunking() for name,variable in stored.variables.items() if variable.ndim == 3}
+        print(f'{file_name}: {original_size / 2**20:.1f} MB -> {os.path.getsize(out_file) / 2**20:.1f} MB, chunks {chunking}')
+        written.append(out_file)
+
+    return written
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Rewrite the .nc inputs as chunked, compressed NetCDF4 files.')
+    parser.add_argument('files',nargs = '*',help = '.nc files in the data folder, all of them by default')
+    parser.add_argument('--chunk-days',type = int,default = chunk_days,help = 'times per chunk')
+    parser.add_argument('--tile',type = int,default = tile_size,help = 'lat/lon points per chunk side')
+    parser.add_argument('--level',type = int,default = compression_level,help = 'zlib compression level (1-9)')
+    parser.add_argument('--force',action = 'store_true',help = 'rewrite files that are already in the store')
+    args = parser.parse_args()
+
+    ingest_files(args.files or None,data_path,args.chunk_days,args.tile,args.level,args.force)
+
+    return None
+
+if __name__ == "__main__":
+    main()
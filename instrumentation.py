@@ -0,0 +1,266 @@
+# Timing and memory instrumentation for the processing stages. A stage is a
+# block of code wrapped in the stage() context manager or a function wrapped
+# with the @instrumented decorator, and each one records its wall time, CPU
+# time, the process peak RSS, and counters such as the bytes read from the
+# NetCDF files and the rows written. Stages can nest, counters are added to
+# every stage that is open. At the end of a run the records are written as a
+# JSON report (and printed as a table) that can be compared with the report
+# of an earlier run to catch regressions.
+#
+# cProfile is opt-in, with profile_stages = True (or TTT_PROFILE=1 in the
+# environment) every outermost stage dumps a .prof file to profile_path.
+#
+# Usage:
+#   python instrumentation.py REPORTS/make_ml_dataset_20240101_120000.json
+#   python instrumentation.py new_report.json --baseline old_report.json
+
+# IMPORTS GO HERE
+import argparse #command line interface
+import contextlib #stage context manager
+import cProfile #opt-in per stage profiles
+import functools #decorator wrapping
+import inspect #stage labels from arguments
+import itertools #stage start order
+import json #reports
+import os #path/file management
+import platform #run information
+import sys #the running script
+import time #wall and CPU times
+try:
+    import resource #peak RSS, not available on Windows
+except ImportError:
+    resource = None
+
+# Paths go here
+root = os.getcwd()
+report_path = root + '/REPORTS'
+profile_path = root + '/PROFILES'
+
+# settings
+profile_stages = os.environ.get('TTT_PROFILE','0') == '1'
+#ru_maxrss is in kilobytes on Linux and bytes on macOS
+rss_unit = 1 if sys.platform == 'darwin' else 1024
+
+# the finished stage records of this run, the stages that are open, and
+# the start number of the next stage
+records = []
+open_stages = []
+start_order = itertools.count()
+run_start = time.time()
+
+# Functions go here
+def peak_rss() -> int:
+    '''
+        The peak resident set size of the process so far in bytes, None
+        where the resource module isn't available
+    '''
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+
+def io_read_bytes() -> int:
+    '''
+        Bytes the process has read through read calls (rchar of
+        /proc/self/io), None where that isn't available
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+    return None
+
+def count(name:str,amount:int = 1) -> None:
+    '''
+        Adds amount to the counter name of every open stage, e.g.
+        count('netcdf_bytes',data.nbytes) or count('rows_written',len(table))
+    '''
+    for record in open_stages:
+        record['counters'][name] = record['counters'].get(name,0) + int(amount)
+
+    return None
+
+@contextlib.contextmanager
+def stage(name:str):
+    '''
+        Context manager that records a stage, the record is added to records
+        when the block finishes (also when it raises)
+    '''
+    record = {'stage':name,'order':next(start_order),'depth':len(open_stages),'counters':{}}
+    profile = None
+    if profile_stages and not any(r.get('profiled') for r in open_stages):
+        #only one profiler can be active, nested stages show up in the outer profile
+        profile = cProfile.Profile()
+        record['profiled'] = True
+    open_stages.append(record)
+    rss_start = peak_rss()
+    read_start = io_read_bytes()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield record
+    finally:
+        if profile is not None:
+            profile.disable()
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        rss_end = peak_rss()
+        read_end = io_read_bytes()
+        if rss_end is not None:
+            record['peak_rss_mb'] = rss_end / 2**20
+            #how much the stage raised the peak of the process
+            record['peak_rss_growth_mb'] = (rss_end - rss_start) / 2**20
+        if read_end is not None:
+            record['read_bytes'] = read_end - read_start
+        if profile is not None:
+            os.makedirs(profile_path,exist_ok = True)
+            record['profile'] = os.path.join(profile_path,f'{len(records):03d}_{safe_name(name)}.prof')
+            profile.dump_stats(record['profile'])
+        open_stages.remove(record)
+        records.append(record)
+
+def instrumented(name:str = None,label:str = None):
+    '''
+        Decorator that runs the function as a stage.
+
+        name (str): The stage name, the function name if None
+        label (str): Optional argument whose value is added to the stage
+            name, e.g. label = 'file' gives process_era5_data(ERA5_q850.nc)
+    '''
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+        signature = inspect.signature(func)
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            full_name = stage_name
+            if label is not None:
+                bound = signature.bind(*args,**kwargs)
+                bound.apply_defaults()
+                full_name = f'{stage_name}({bound.arguments[label]})'
+            with stage(full_name):
+                return func(*args,**kwargs)
+        return wrapper
+
+    return decorator
+
+def safe_name(name:str) -> str:
+    '''
+        A stage name that can be used in a file name
+    '''
+
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name).strip('_')
+
+def make_report(run_name:str = None) -> dict:
+    '''
+        The report of this run, run information and the stage records in the
+        order the stages finished
+    '''
+    run_name = os.path.splitext(os.path.basename(sys.argv[0]))[0] if run_name is None else run_name
+
+    return {'run':run_name,
+            'started':time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(run_start)),
+            'wall_seconds':time.time() - run_start,
+            'peak_rss_mb':None if peak_rss() is None else peak_rss() / 2**20,
+            'python':platform.python_version(),
+            'host':platform.node(),
+            'stages':[{key:value for key,value in record.items() if key != 'profiled'} for record in records]}
+
+def save_report(run_name:str = None,folder:str = report_path,verbose:bool = True) -> str:
+    '''
+        Writes the report of this run to folder/<run>_<start time>.json and
+        prints it when verbose.
+
+        Returns the report file
+    '''
+    report = make_report(run_name)
+    os.makedirs(folder,exist_ok = True)
+    stamp = time.strftime('%Y%m%d_%H%M%S',time.localtime(run_start))
+    file_name = os.path.join(folder,f'{report["run"]}_{stamp}.json')
+    with open(file_name,'w') as f:
+        json.dump(report,f,indent = 1)
+    if verbose:
+        print_report(report)
+        print(f'Wrote {file_name}')
+
+    return file_name
+
+def load_report(file_name:str) -> dict:
+    '''
+        Loads a saved report
+    '''
+    with open(file_name) as f:
+        return json.load(f)
+
+def format_bytes(n_bytes:int) -> str:
+    '''
+        A byte count in B, KB, MB, or GB
+    '''
+    if n_bytes is None:
+        return '-'
+    for unit in ['B','KB','MB']:
+        if abs(n_bytes) < 1024:
+            return f'{n_bytes:.0f} {unit}' if unit == 'B' else f'{n_bytes:.1f} {unit}'
+        n_bytes /= 1024
+
+    return f'{n_bytes:.2f} GB'
+
+def print_report(report:dict,baseline:dict = None) -> None:
+    '''
+        Prints the stages of a report as a table, nested stages are indented.
+        With a baseline report the wall time of every stage that is in both
+        is shown relative to the baseline.
+    '''
+    base_times = {}
+    if baseline is not None:
+        for record in baseline['stages']:
+            base_times.setdefault(record['stage'],record['wall_seconds'])
+    print(f'{report["run"]} started {report["started"]}, {report["wall_seconds"]:.1f} s, '
+          f'peak RSS {format_bytes(None if report["peak_rss_mb"] is None else report["peak_rss_mb"] * 2**20)}')
+    header = f'{"Stage":<45}{"Wall [s]":>10}{"CPU [s]":>10}{"Peak RSS":>11}{"Read":>11}{"NetCDF":>11}{"Rows":>10}'
+    if baseline is not None:
+        header += f'{"vs base":>9}'
+    print(header)
+    #records are in finishing order, a parent finishes after its children
+    #so print them in starting order
+    for record in ordered_stages(report['stages']):
+        peak = record.get('peak_rss_mb')
+        line = (f'{"  " * record["depth"] + record["stage"]:<45.45}{record["wall_seconds"]:>10.2f}{record["cpu_seconds"]:>10.2f}'
+                f'{format_bytes(None if peak is None else peak * 2**20):>11}{format_bytes(record.get("read_bytes")):>11}'
+                f'{format_bytes(record["counters"].get("netcdf_bytes")):>11}{record["counters"].get("rows_written","-"):>10}')
+        if baseline is not None:
+            base = base_times.get(record['stage'])
+            line += f'{record["wall_seconds"] / base:>8.2f}x' if base else f'{"-":>9}'
+        print(line)
+
+    return None
+
+def ordered_stages(stages:list) -> list:
+    '''
+        The stage records in the order they started (they are saved in the
+        order they finished, so a parent comes after its children). Reports
+        without start numbers are returned in finishing order.
+    '''
+    if not all('order' in record for record in stages):
+        return list(stages)
+
+    return sorted(stages,key = lambda record: record['order'])
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Print a saved stage report.')
+    parser.add_argument('report',help = 'report file')
+    parser.add_argument('--baseline',default = None,help = 'earlier report to compare the wall times with')
+    args = parser.parse_args()
+
+    print_report(load_report(args.report),None if args.baseline is None else load_report(args.baseline))
+
+    return None
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Lag, lead, and rolling mean features for the daily predictors. Each series
+# is put on a gap-free daily calendar first so a lag of 1 is always the
+# previous calendar day, then all of the shifts are read from a strided
+# window view (no copies) and only the rows for the sampled days are gathered.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+from numpy.lib.stride_tricks import sliding_window_view #zero copy shifted views
+from date_tools import to_datetime64,date_lookup #vectorized date handling
+
+# Functions Go Here
+def daily_calendar(dates:np.ndarray,values:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        Puts a series onto a continuous daily calendar running from its first
+        to its last date. Days that the series doesn't have are NaN.
+
+        Returns the calendar dates (datetime64[D]) and the values on them
+    '''
+    dates = to_datetime64(dates)
+    calendar = np.arange(dates.min(),dates.max() + np.timedelta64(1,'D'),dtype = 'datetime64[D]')
+    indices,found = date_lookup(dates,calendar)
+    calendar_values = np.asarray(values,dtype = np.float64)[indices]
+    calendar_values[~found] = np.nan
+
+    return calendar,calendar_values
+
+def lag_feature_name(name:str,offset:int) -> str:
+    '''
+        Column name for a series shifted by offset days, negative offsets are
+        lags (days before the sample day) and positive offsets are leads
+    '''
+    if offset < 0:
+        return f'{name}_LAG{-offset}D'
+
+    return f'{name}_LEAD{offset}D'
+
+def make_lag_features(name:str,dates:np.ndarray,values:np.ndarray,sample_dates:np.ndarray,
+                      lags:list = (),leads:list = (),windows:list = ()) -> dict:
+    '''
+        Makes the lagged, led, and rolling mean versions of a daily series
+        for the sampled days.
+
+        name (str): The name of the series, used to build the column names
+        dates (np.ndarray): The dates of the series
+        values (np.ndarray): The values of the series
+        sample_dates (np.ndarray): The days the features are needed for
+        lags (list): Days before the sample day, a lag of 3 is the value 3
+            calendar days earlier (a precursor)
+        leads (list): Days after the sample day
+        windows (list): Lengths of trailing means ending on the sample day,
+            NaN days within a window are skipped
+
+        Returns column name -> values on sample_dates. Values that fall off
+        the ends of the record or on missing days are NaN.
+    '''
+    if any(lag < 1 for lag in lags) or any(lead < 1 for lead in leads) or any(w < 1 for w in windows):
+        raise ValueError('Lags, leads, and window lengths must be at least 1 day.')
+    calendar,calendar_values = daily_calendar(dates,values)
+    max_back = max(list(lags) + [w - 1 for w in windows] + [0])
+    max_forward = max(list(leads) + [0])
+
+    #pad the ends so every day has a full window, then view the windows
+    padded = np.concatenate((np.full(max_back,np.nan),calendar_values,np.full(max_forward,np.nan)))
+    windowed = sliding_window_view(padded,max_back + max_forward + 1)
+    #column max_back of a window is the day itself
+
+    rows,found = date_lookup(calendar,sample_dates)
+    sample_windows = windowed[rows]
+    sample_windows[~found] = np.nan
+
+    features = {}
+    for lag in lags:
+        features[lag_feature_name(name,-lag)] = sample_windows[:,max_back - lag]
+    for lead in leads:
+        features[lag_feature_name(name,lead)] = sample_windows[:,max_back + lead]
+    for window in windows:
+        window_vals = sample_windows[:,max_back - window + 1:max_back + 1]
+        valid = ~np.isnan(window_vals)
+        counts = valid.sum(axis = 1)
+        with np.errstate(invalid = 'ignore',divide = 'ignore'):
+            means = np.where(valid,window_vals,0.0).sum(axis = 1) / counts
+        means[counts == 0] = np.nan
+        features[f'{name}_MEAN{window}D'] = means
+
+    return features
+
+def make_all_lag_features(series:dict,sample_dates:np.ndarray,lags:list = (),leads:list = (),
+                          windows:list = ()) -> dict:
+    '''
+        Runs make_lag_features for every series with the same lags, leads,
+        and windows.
+
+        series (dict): name -> (dates,values)
+
+        Returns column name -> values on sample_dates for every series
+    '''
+    features = {}
+    for name,(dates,values) in series.items():
+        features.update(make_lag_features(name,dates,values,sample_dates,lags,leads,windows))
+
+    return features
@@ -4,14 +4,26 @@
 
 # IMPORTS GO HERE
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 from netCDF4 import Dataset
 import os
 from PIL import Image
 import datetime as dt
-import numpy.ma as ma
 from urllib.request import urlretrieve
 import os
+from grid_tools import get_grid_index,box_weight_matrix,weighted_box_means
+from mjo_tools import omi_phase,load_mjo_index
+from date_tools import to_datetime64,align_series,date_lookup,date_months,noleap_doy,austral_summer_mask,ymd_to_datetime64
+from feature_table import make_feature_table,write_feature_table
+from lag_features import make_lag_features,make_all_lag_features
+from gridded_export import export_gridded_features
+from sampling import sample_negative_days
+from instrumentation import instrumented,count,save_report
+import chunked
+from ingest import input_file
+import dtype_policy as dp
+import harmonics as hc
 
 # Paths go here
 root = os.getcwd()
@@ -28,6 +40,46 @@ v850_box2 = [30,-45,40,-30]
 surfp_box1 = [40,-45,55,-35]
 surfp_box2 = [10,-45,30,-35]
 w500_box = [25,-30,40,-20]
+#whether the box means weight each grid cell by cos(latitude), off by
+#default so the index and features match the unweighted box means
+area_weight_boxes = False
+#'memory' reads each ERA5 variable whole, 'chunked' streams it in time blocks
+#sized to chunked.memory_budget_mb (same results, for grids that don't fit)
+processing_backend = 'memory'
+#'daily' removes the raw 365 day mean, 'harmonic' a climatology smoothed to
+#its first n_harmonics annual harmonics (cached as coefficients in DATA/CLIMATOLOGY)
+climatology_mode = 'daily'
+n_harmonics = 3
+#OMI amplitude below which a day is given phase 0 (weak MJO), None keeps every day
+mjo_weak_threshold = None
+
+# settings for drawing the non-TTT (negative) days
+random_seed = 144
+negatives_per_event = 10
+#days either side of an event that can't be drawn as a negative
+negative_buffer_days = 0
+#None, 'month', or 'mjo_phase', stratified draws follow the distribution of the events
+negative_strata = None
+
+# output files, the feature table is always written, the CSV only if export_csv
+feature_file = 'TTT_CLASSIFY.parquet'
+csv_file = 'TTT_CLASSIFY.csv'
+export_csv = False
+#also write the full-domain anomaly fields of the sampled days for spatial models
+export_gridded = False
+gridded_file = 'TTT_GRIDDED.npy'
+#also write the features of every austral summer day (not just the sampled
+#ones) for running the trained classifier over the whole record
+export_daily = False
+daily_file = 'TTT_DAILY.parquet'
+
+# lag/lead features, every series in lag_predictors gets a column for each
+#lag (days before the sample day), lead (days after), and trailing mean length
+lag_days = []
+lead_days = []
+rolling_days = []
+lag_predictors = ['OMI_AMP','OMI_PHASE','Q850','Z200_B1','Z200_B2','U850','V850_B1',
+                  'V850_B2','SURF_PRES_B1','SURF_PRES_B2','W500']
 
 # Download the OMI data in case it doesn't already exist
 os.chdir(data_path)
@@ -44,19 +96,10 @@ def doy_calc(dates:np.ndarray) -> np.ndarray:
         the maximum DOY will be 365
     '''
 
-    #make an array to hold the DOYs
-    doy_array = np.zeros(len(dates))
-    ref_date = dt.datetime(2001,1,1)
-    for i in range(len(dates)):
-        if dates[i].month == 2 and dates[i].day == 29:
-            use_date = dt.datetime(2001,3,1)
-        else:
-            use_date = dt.datetime(2001,dates[i].month,dates[i].day)
-        doy_array[i] = ((use_date - ref_date).days)+1
-
-    return doy_array
+    return noleap_doy(dates).astype(np.float64)
 
 #functions for ERA5 data
+@instrumented(label = 'file')
 def make_era5_climatology(file:str,key:str) -> np.ndarray:
     '''
         Makes a daily climatology of ERA5 data for Austral Summer for
@@ -66,7 +109,8 @@ def make_era5_climatology(file:str,key:str) -> np.ndarray:
         key (str): The key needed to access the data within the 
             specified .nc file
 
-        returns the climatology as a numpy array
+        returns the climatology as a numpy array in the field dtype, the
+        sums are kept in the accumulator dtype
     '''
     #ref date to convert from time to date
     ref_date = dt.datetime(1900,1,1)
@@ -76,15 +120,19 @@ def make_era5_climatology(file:str,key:str) -> np.ndarray:
     climatology_start_date = dt.datetime(2001,1,1)
     climatology_dates = np.array([climatology_start_date + dt.timedelta(days = dd) for dd in range(365)])
 
-    climatology_array = np.zeros((len(climatology_dates),201,321))
-    climatology_count = np.zeros((len(climatology_dates),201,321))
     #now I want to open up the .nc file and pull an element one at a time and put it
     #in the appropriate slot for the climatology
     os.chdir(data_path)
-    file_time = Dataset(file).variables['time'][:]
+    nc_file = input_file(file)
+    file_time = Dataset(nc_file).variables['time'][:]
+    grid_shape = Dataset(nc_file).variables[key].shape[1:]
+    climatology_array = np.zeros((len(climatology_dates),) + grid_shape,dtype = dp.accumulator_dtype)
+    #every cell has the same number of days so one count per day is enough
+    climatology_count = np.zeros(len(climatology_dates))
     file_dates = np.array([ref_date + dt.timedelta(hours = int(hr)) for hr in file_time])
     for i in range(len(file_dates)):
-        daily_data = Dataset(file).variables[key][i,:,:]
+        daily_data = Dataset(nc_file).variables[key][i,:,:]
+        count('netcdf_bytes',daily_data.nbytes)
         if file_dates[i].month == 2 and file_dates[i].day == 29:
             use_date = dt.datetime(2001,3,1)
         else:
@@ -93,8 +141,9 @@ def make_era5_climatology(file:str,key:str) -> np.ndarray:
         climatology_count[np.where(climatology_dates == use_date)[0][0]] += 1
     os.chdir(root)
     
-    return climatology_array/climatology_count
+    return (climatology_array/climatology_count[:,None,None]).astype(dp.field_dtype)
 
+@instrumented()
 def get_ERA5_anomalies(era5_data:np.ndarray,era5_clim:np.ndarray,era5_dates:np.ndarray) -> np.ndarray:
     '''
         Calculate the OLR anomalies relative to the 1981-2010 mean and return
@@ -109,7 +158,13 @@ def get_ERA5_anomalies(era5_data:np.ndarray,era5_clim:np.ndarray,era5_dates:np.n
     climatology_dates = np.array([climatology_start_date + dt.timedelta(days = dd) for dd in range(365)])
 
     #calculate the anomalies based on the correct day
-    era5_anoms = np.empty(era5_data.shape)
+    era5_anoms = np.empty(era5_data.shape,dtype = dp.field_dtype)
+    if isinstance(era5_clim,hc.HarmonicClimatology):
+        #evaluate the harmonics a year of days at a time, leap days in place
+        days = hc.day_positions(era5_dates)
+        for ts in range(0,len(era5_dates),365):
+            era5_anoms[ts:ts+365] = era5_data[ts:ts+365] - era5_clim[days[ts:ts+365]]
+        return era5_anoms
     for i in range(len(era5_dates)):
         if era5_dates[i].month == 2 and era5_dates[i].day == 29:
             use_date = dt.datetime(2001,3,1)
@@ -124,53 +179,102 @@ def make_era5_box(era5_anoms:np.ndarray,era5_lats:np.ndarray,era5_lons:np.ndarra
         Uses a defined box to get the ERA5 data within the box and returns the
         spatial mean as a function of time.
     '''
-    #boxes are left,bottom,right,top
-    #get the indices that correspond to the box
-    lat_si = np.where(era5_lats == box[3])[0][0]
-    lat_ei = np.where(era5_lats == box[1])[0][0]
-    lon_si = np.where(era5_lons == box[0])[0][0]
-    lon_ei = np.where(era5_lons == box[2])[0][0]
 
-    box_anoms = era5_anoms[:,lat_si:lat_ei,lon_si:lon_ei]
+    return make_era5_boxes(era5_anoms,era5_lats,era5_lons,[box])[:,0]
+
+@instrumented()
+def make_era5_boxes(era5_anoms:np.ndarray,era5_lats:np.ndarray,era5_lons:np.ndarray,boxes:list) -> np.ndarray:
+    '''
+        Gets the spatial mean of the ERA5 data within every box as a function
+        of time. All of the boxes are reduced together with one matrix product
+        per time chunk, weighted by cos(latitude) when area_weight_boxes is True.
+
+        Returns the box means with shape (time,box)
+    '''
+    #boxes are left,bottom,right,top
+    #get the weights that correspond to the boxes
+    weights = box_weight_matrix(get_grid_index(era5_lats,era5_lons),boxes,weighted = area_weight_boxes)
 
-    return np.nanmean(box_anoms,axis = (1,2))
+    return weighted_box_means(era5_anoms,weights)
 
-def process_era5_data(file:str,key:str,box:list) -> tuple[np.ndarray,np.ndarray]:
+@instrumented(label = 'file')
+def process_era5_data(file:str,key:str,boxes:list) -> tuple[np.ndarray,np.ndarray]:
     '''
         Open up an ERA5 file, compute the climatology and calculate anomalies
-        then get the values of the anomalies within the box
+        then get the values of the anomalies within each of the boxes
 
         file (str): The name of the .nc file containing the ERA5 data
         key (str): The key needed to access the data within the 
             specified .nc file
-        box (list): The box outlining the area of interest within the ERA5 data
-            specifies the left,bottom,right,and top boundaries in that order
+        boxes (list): The boxes outlining the areas of interest within the ERA5
+            data, each specifies the left,bottom,right,and top boundaries in
+            that order
+
+        Returns the box values with shape (box,time) and the dates
     '''
-    
+    if processing_backend == 'chunked':
+        return process_era5_data_chunked(file,key,boxes)
+
     #navigate to the data path and open the ERA5 data
     os.chdir(data_path)
-    e5_data = ma.getdata(Dataset(file).variables[key][:])
-    e5_lats = Dataset(file).variables['latitude'][:]
-    e5_lons = Dataset(file).variables['longitude'][:]
-    e5_time = Dataset(file).variables['time'][:]
+    e5_data = dp.as_field(Dataset(input_file(file)).variables[key][:])
+    count('netcdf_bytes',e5_data.nbytes)
+    e5_lats = Dataset(input_file(file)).variables['latitude'][:]
+    e5_lons = Dataset(input_file(file)).variables['longitude'][:]
+    e5_time = Dataset(input_file(file)).variables['time'][:]
     os.chdir(root)
     #convert the time to dates
     e5_dates = np.array([dt.datetime(1900,1,1) + dt.timedelta(hours = int(hr)-12) for hr in e5_time])
     #get the climatology
-    e5_clim = make_era5_climatology(file,key)
+    if climatology_mode == 'harmonic':
+        e5_clim = hc.cached_harmonics(f'{os.path.splitext(file)[0]}_{key}',input_file(file),
+                                      lambda: make_era5_climatology(file,key),n_harmonics)
+    else:
+        e5_clim = make_era5_climatology(file,key)
     #get the anomalies
     e5_anoms = get_ERA5_anomalies(e5_data,e5_clim,e5_dates)
-    #refine to just the box
-    e5_box = make_era5_box(e5_anoms,e5_lats,e5_lons,box)
+    #refine to just the boxes
+    e5_boxes = make_era5_boxes(e5_anoms,e5_lats,e5_lons,boxes).T
+
+    return e5_boxes,e5_dates
+
+@instrumented(label = 'file')
+def process_era5_data_chunked(file:str,key:str,boxes:list) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        process_era5_data with the chunked backend, the climatology and then
+        the anomalies and box values come from passes over the file in time
+        blocks so the whole variable is never in memory
+
+        Returns the box values with shape (box,time) and the dates
+    '''
+    os.chdir(data_path)
+    with Dataset(input_file(file)) as nc_data:
+        e5_lats = nc_data.variables['latitude'][:]
+        e5_lons = nc_data.variables['longitude'][:]
+        e5_time = nc_data.variables['time'][:]
+        e5_dates = np.array([dt.datetime(1900,1,1) + dt.timedelta(hours = int(hr)-12) for hr in e5_time])
+        #the climatology days as make_era5_climatology finds them
+        clim_doys = noleap_doy(np.array([dt.datetime(1900,1,1) + dt.timedelta(hours = int(hr)) for hr in e5_time])) - 1
+        if climatology_mode == 'harmonic':
+            e5_clim = hc.cached_harmonics(f'{os.path.splitext(file)[0]}_{key}',input_file(file),
+                                          lambda: chunked.climatology(nc_data.variables[key],clim_doys),n_harmonics)
+        else:
+            e5_clim = chunked.climatology(nc_data.variables[key],clim_doys)
+        weights = box_weight_matrix(get_grid_index(e5_lats,e5_lons),boxes,weighted = area_weight_boxes)
+        e5_boxes = chunked.box_anomalies(nc_data.variables[key],hc.climatology_days(e5_dates,e5_clim),e5_clim,weights).T
+    os.chdir(root)
 
-    return e5_box,e5_dates
+    return e5_boxes,e5_dates
 
 #functions for the TTT Index
-def open_ttt_index() -> tuple[np.ndarray]:
+@instrumented()
+def open_ttt_index(summer_only:bool = True) -> tuple[np.ndarray]:
     '''
         Opens up the TTT Index that I made and returns the dates and
         the value of the TTT Index as well as whether or not the day
         was a TTT day
+
+        summer_only (bool): Whether to limit to austral summer (Oct - May)
     '''
 
     #navigate to the data directory and open up the file
@@ -185,6 +289,8 @@ def open_ttt_index() -> tuple[np.ndarray]:
     ttt_day_bool = ttt_index_file[:,4]
     #convert the year,month,day into the actual date
     ttt_dates = np.array([dt.datetime(int(year[i]),int(month[i]),int(day[i])) for i in range(len(year))])
+    if not summer_only:
+        return ttt_dates,index_val,ttt_day_bool
     #limit to just austral summer Oct - May
     index_val_summer = []
     ttt_day_bool_summer = []
@@ -228,93 +334,103 @@ def get_ttt_index_climatology(ttt_dates:np.ndarray,ttt_index_values:np.ndarray)
 #functions for the MJO Index
 #first a function to determine the phase of the MJO based on the OMI
 # index values so I can classify by phase in case it is helpful
-def omi_phase_check(omi1:np.ndarray,omi2:np.ndarray) -> np.ndarray:
+def omi_phase_check(omi1:np.ndarray,omi2:np.ndarray,omi_amp:np.ndarray = None) -> np.ndarray:
     '''
         Calculates the phase of the MJO based on the values of the PCs in the
-        omi index.
+        omi index. Days with an amplitude below mjo_weak_threshold are phase 0.
     '''
 
-    #array to hold the phases
-    omi_phase = np.zeros(len(omi1))
-    #now use if statements to do it
-    for i in range(len(omi_phase)):
-        if omi2[i] < 0:
-            #this means it is either phase 1,2,7,8
-            if -omi1[i] <= 0:
-                #this means it is either phase 1 or 2
-                if omi2[i] == -omi1[i] :
-                    omi_phase[i] = 2
-                elif omi2[i] < -omi1[i]:
-                    omi_phase[i]  = 1
-                elif omi2[i] > -omi1[i]:
-                    omi_phase[i] = 2
-            elif -omi1[i] > 0:
-                if -omi2[i] == -omi1[i]:
-                    omi_phase[i] = 8
-                elif -omi2[i] < -omi1[i]:
-                    omi_phase[i] = 7
-                elif -omi2[i] > -omi1[i]:
-                    omi_phase[i] = 8
-        elif omi2[i] >= 0:
-            #it is either phase 3,4,5,6
-            if -omi1[i] < 0:
-                if -omi2[i] > -omi1[i]:
-                    omi_phase[i] = 3
-                elif -omi2[i] == -omi1[i]:
-                    omi_phase[i] = 4
-                elif -omi2[i] < -omi1[i]:
-                    omi_phase[i] = 4
-            elif -omi1[i] >= 0:
-                if omi2[i] > -omi1[i]:
-                    omi_phase[i] = 5
-                if omi2[i] == -omi1[i]:
-                    omi_phase[i] = 6
-                if omi2[i] < -omi1[i]:
-                    omi_phase[i] = 6
-
-    return omi_phase
+    return omi_phase(omi1,omi2,amplitude = omi_amp,weak_threshold = mjo_weak_threshold)
 
+@instrumented()
 def open_mjo_index() -> tuple[np.ndarray]:
     '''
-        Opens up the MJO OMI Index file and returns the date, the amplitude,
-        and the phase of the MJO from 1979 - Present
+        Opens up the MJO OMI Index file and returns the date (datetime64),
+        the amplitude, and the phase of the MJO from 1979 - Present
     '''
 
-    #navigate to the data directory and open up the file
-    os.chdir(data_path)
-    omi_index_file = np.loadtxt('MJO_OMI.txt')
-    os.chdir(root)
-    #now portion out the file
-    year = omi_index_file[:,0]
-    month = omi_index_file[:,1]
-    day = omi_index_file[:,2]
-    omi1 = omi_index_file[:,4]
-    omi2 = omi_index_file[:,5]
-    omi_amp = omi_index_file[:,6]
+    #the text file is only parsed the first time, after that the cache is used
+    omi_index = load_mjo_index(data_path + '/MJO_OMI.txt')
     #get the phase of the MJO
-    omi_phase = omi_phase_check(omi1,omi2)
-    #get the dates
-    omi_dates = np.array([dt.datetime(int(year[i]),int(month[i]),int(day[i])) for i in range(len(year))])
+    omi_phase = omi_phase_check(omi_index['pc1'],omi_index['pc2'],omi_index['amp'])
 
-    return omi_dates,omi_amp,omi_phase
+    return omi_index['dates'],omi_index['amp'],omi_phase
 
-#now let's make a function to make my csv
-def csv_writer(file_name:str,doys:np.ndarray,dates:np.ndarray,ttt_index_vals:np.ndarray,ttt_clim:np.ndarray,ttt_day_bool:np.ndarray,
-               omi_amp:np.ndarray,omi_phase:np.ndarray,q850:np.ndarray,z200_b1:np.ndarray,
-               z200_b2:np.ndarray,u850:np.ndarray,v850_b1:np.ndarray,v850_b2:np.ndarray,
-               surfp_b1:np.ndarray,surfp_b2:np.ndarray,w500:np.ndarray,random_var:np.ndarray) -> None:
+#now let's make a function to make the feature table
+@instrumented()
+def feature_writer(dates:np.ndarray,ttt_clim:np.ndarray,aligned:dict,lagged:dict,file_name:str = None) -> pd.DataFrame:
     '''
-        Makes the CSV file I will use as the input for my random forest model
+        Makes the feature table I will use as the input for my random forest
+        model and writes it to file_name (feature_file, and csv_file if
+        export_csv, when None).
+
+        dates (np.ndarray): The sampled dates
+        ttt_clim (np.ndarray): The daily climatology of the TTT index
+        aligned (dict): The series aligned onto dates, keyed by column name
+        lagged (dict): The lag/lead/rolling features on dates, must include
+            TTT_INDEX_VAL_LAG1D
+        file_name (str): The file to write the table to
+
+        Rows are kept where the TTT index, q850, OMI, TTT climatology, and
+        every lag/lead/rolling feature are all available and the day is in
+        austral summer. The lag features are NaN where their window reaches
+        outside the record or onto a missing day, and the random forest
+        can't take NaN inputs, so those days are dropped.
+
+        Returns the feature table
     '''
+    dates = to_datetime64(dates)
+    doys = noleap_doy(dates)
+    clim_vals = ttt_clim[doys-1]
+    ttt_index_vals = aligned['TTT_INDEX_VAL']
+    #value of the index on the previous calendar day
+    ttt_index_prev = lagged['TTT_INDEX_VAL_LAG1D']
+    keep = (~np.isnan(ttt_index_vals) & ~np.isnan(aligned['Q850']) & ~np.isnan(clim_vals)
+            & ~np.isnan(aligned['OMI_AMP']) & austral_summer_mask(dates))
+    for values in lagged.values():
+        keep &= ~np.isnan(values)
+
+    years = dates.astype('datetime64[Y]')
+    columns = {'DOY':doys,
+               'YEAR':years.astype(np.int64) + 1970,
+               'MONTH':date_months(dates),
+               'DAY':(dates - dates.astype('datetime64[M]')).astype(np.int64) + 1,
+               'TTT_INDEX_VAL':ttt_index_vals,
+               'TTT_INDEX_VAL_1D':ttt_index_prev,
+               'TTT_INDEX_CLIM':clim_vals}
+    columns.update(aligned)
+    columns.update({name:values for name,values in lagged.items() if name != 'TTT_INDEX_VAL_LAG1D'})
+    columns = {name:np.asarray(values)[keep] for name,values in columns.items()}
+    table = make_feature_table(columns)
+
     os.chdir(data_path)
-    f = open(file_name,'w')
-    f.write('DOY,YEAR,MONTH,DAY,TTT_INDEX_VAL,TTT_INDEX_VAL_1D,TTT_INDEX_CLIM,TTT_DAY_BOOL,OMI_AMP,OMI_PHASE,Q850,Z200_B1,Z200_B2,U850,V850_B1,V850_B2,SURF_PRES_B1,SURF_PRES_B2,W500,RAND_VAR\n')
-    for i in range(len(doys)):
-        if not np.isnan(ttt_index_vals[i]) and not np.isnan(q850[i]) and not np.isnan(ttt_clim[int(doys[i])-1]) and (dates[i].month >= 10 or dates[i].month <= 5):
-            f.write(f'{doys[i]},{dates[i].year},{dates[i].month},{dates[i].day},{ttt_index_vals[i]},{ttt_index_vals[i-1]},{ttt_clim[int(doys[i])-1]},{ttt_day_bool[i]},{omi_amp[i]},{omi_phase[i]},{q850[i]},{z200_b1[i]},{z200_b2[i]},{u850[i]},{v850_b1[i]},{v850_b2[i]},{surfp_b1[i]},{surfp_b2[i]},{w500[i]},{random_var[i]}\n')
-    f.close()
+    if file_name is not None:
+        write_feature_table(table,file_name)
+    else:
+        write_feature_table(table,feature_file)
+        if export_csv:
+            write_feature_table(table,csv_file)
+    os.chdir(root)
 
-    return None
+    return table
+
+@instrumented()
+def sample_features(sample_dates:np.ndarray,daily_series:dict,ttt_all_dates:np.ndarray,
+                    ttt_all_values:np.ndarray) -> tuple[dict,dict]:
+    '''
+        Aligns every daily series onto the sample dates and makes the lag
+        features for them.
+
+        Returns the aligned series and the lag features
+    '''
+    #join every series onto the sampled dates by date rather than by position
+    aligned,_ = align_series(sample_dates,daily_series)
+    #lags come from the full daily record, not just austral summer or the sampled days
+    lagged = make_lag_features('TTT_INDEX_VAL',ttt_all_dates,ttt_all_values,sample_dates,lags = [1])
+    lagged.update(make_all_lag_features({name:daily_series[name] for name in lag_predictors},sample_dates,
+                                        lags = lag_days,leads = lead_days,windows = rolling_days))
+
+    return aligned,lagged
 
 #main function
 def main() -> None:
@@ -323,53 +439,75 @@ def main() -> None:
     ttt_dates,ttt_index_values,ttt_event_bool = open_ttt_index()
     ttt_clim = get_ttt_index_climatology(ttt_dates,ttt_index_values)
     print('Processing OMI Data')
-    _,omi_amp,omi_phase = open_mjo_index()
+    omi_dates,omi_amp,omi_phase = open_mjo_index()
     #now let's do the various era5 boxes
     print('Processing q850 Data')
-    q850,e5_dates = process_era5_data('ERA5_q850.nc','q',q850_box)
-    print('Processing z200 B1 Data')
-    z200_b1,_ = process_era5_data('ERA5_z200.nc','z',z200_box1)
-    print('Processing z200 B2 Data')
-    z200_b2,_ = process_era5_data('ERA5_z200.nc','z',z200_box2)
+    (q850,),e5_dates = process_era5_data('ERA5_q850.nc','q',[q850_box])
+    print('Processing z200 Data')
+    (z200_b1,z200_b2),_ = process_era5_data('ERA5_z200.nc','z',[z200_box1,z200_box2])
     print('Processing u850 Data')
-    u850,_ = process_era5_data('ERA5_u850.nc','u',u850_box)
-    print('Processing v850 B1 Data')
-    v850_b1,_ = process_era5_data('ERA5_v850.nc','v',v850_box1)
-    print('Processing v850 B2 Data')
-    v850_b2,_ = process_era5_data('ERA5_v850.nc','v',v850_box2)
-    print('Processing surface pressure B1 Data')
-    surfp_b1,_ = process_era5_data('ERA5_surfP.nc','sp',surfp_box1)
-    print('Processing surface pressure B2 Data')
-    surfp_b2,_ = process_era5_data('ERA5_surfP.nc','sp',surfp_box2)
+    (u850,),_ = process_era5_data('ERA5_u850.nc','u',[u850_box])
+    print('Processing v850 Data')
+    (v850_b1,v850_b2),_ = process_era5_data('ERA5_v850.nc','v',[v850_box1,v850_box2])
+    print('Processing surface pressure Data')
+    (surfp_b1,surfp_b2),_ = process_era5_data('ERA5_surfP.nc','sp',[surfp_box1,surfp_box2])
     print('Processing w500 Data')
-    w500,_ = process_era5_data('ERA5_w500.nc','w',w500_box)
-    #get the doy data
-    doys = doy_calc(e5_dates)
+    (w500,),_ = process_era5_data('ERA5_w500.nc','w',[w500_box])
     #make a random uniform variable of the same length
-    rand_var = np.random.randint(0,100,len(doys))
+    rng = np.random.default_rng(random_seed)
+    rand_var = rng.integers(0,100,len(e5_dates))
 
-    print('Writing to TTT_CLASSIFY.csv')
     #now limit to just days where TTT_BOOL is 1 and a few other random days in the winter
+    ttt_dates = to_datetime64(ttt_dates)
     ev_dates = ttt_dates[np.where(ttt_event_bool == 1)]
-    random_dates = []
-    while(1):
-        ran_date = dt.datetime(1979,1,2) + dt.timedelta(days = np.random.randint(0,16071))
-        if (ran_date.month <= 5 or ran_date.month >= 10) and ran_date not in ev_dates:
-            random_dates.append(ran_date)
-        if len(random_dates) == len(ev_dates)*10:
-            break
-    #get the indices matching the dates
-    for i in range(len(ev_dates)):
-        random_dates.append(ev_dates[i])
-    random_dates = np.array(random_dates)
-    ifrd = []
-    for i in range(len(random_dates)):
-        matching_ind = np.where(ttt_dates == random_dates[i])[0][0]
-        ifrd.append(matching_ind)
-    ifrd = np.array(ifrd)
-
-
-    csv_writer('TTT_CLASSIFY.csv',doys[ifrd],ttt_dates[ifrd],ttt_index_values[ifrd],ttt_clim,ttt_event_bool[ifrd],omi_amp[ifrd],omi_phase[ifrd],q850[ifrd],z200_b1[ifrd],z200_b2[ifrd],u850[ifrd],v850_b1[ifrd],v850_b2[ifrd],surfp_b1[ifrd],surfp_b2[ifrd],w500[ifrd],rand_var[ifrd])
+    #negatives can only be days that the ERA5 and OMI data both cover
+    covered = date_lookup(e5_dates,ttt_dates)[1] & date_lookup(omi_dates,ttt_dates)[1]
+    if negative_strata == 'month':
+        strata = date_months(ttt_dates)
+    elif negative_strata == 'mjo_phase':
+        strata,_ = align_series(ttt_dates,{'OMI_PHASE':(omi_dates,omi_phase)},verbose = False)
+        strata = np.nan_to_num(strata['OMI_PHASE'],nan = -1).astype(np.int64)
+    else:
+        strata = None
+    strata_weights = None
+    if strata is not None:
+        labels,counts = np.unique(strata[ttt_event_bool == 1],return_counts = True)
+        strata_weights = dict(zip(labels.tolist(),counts.tolist()))
+    random_dates = sample_negative_days(ttt_dates,ttt_event_bool,len(ev_dates)*negatives_per_event,
+                                        buffer_days = negative_buffer_days,eligible = covered,
+                                        strata = strata,strata_weights = strata_weights,seed = random_seed)
+    sample_dates = np.concatenate((random_dates,ev_dates))
+
+    #every daily series that goes into the feature table
+    daily_series = {
+        'TTT_INDEX_VAL':(ttt_dates,ttt_index_values),
+        'TTT_DAY_BOOL':(ttt_dates,ttt_event_bool),
+        'OMI_AMP':(omi_dates,omi_amp),
+        'OMI_PHASE':(omi_dates,omi_phase),
+        'Q850':(e5_dates,q850),
+        'Z200_B1':(e5_dates,z200_b1),
+        'Z200_B2':(e5_dates,z200_b2),
+        'U850':(e5_dates,u850),
+        'V850_B1':(e5_dates,v850_b1),
+        'V850_B2':(e5_dates,v850_b2),
+        'SURF_PRES_B1':(e5_dates,surfp_b1),
+        'SURF_PRES_B2':(e5_dates,surfp_b2),
+        'W500':(e5_dates,w500),
+        'RAND_VAR':(e5_dates,rand_var)}
+    ttt_all_dates,ttt_all_values,_ = open_ttt_index(summer_only = False)
+    aligned,lagged = sample_features(sample_dates,daily_series,ttt_all_dates,ttt_all_values)
+    print(f'Writing to {feature_file}')
+    table = feature_writer(sample_dates,ttt_clim,aligned,lagged)
+    if export_daily:
+        print(f'Writing to {daily_file}')
+        aligned,lagged = sample_features(ttt_dates[covered],daily_series,ttt_all_dates,ttt_all_values)
+        feature_writer(ttt_dates[covered],ttt_clim,aligned,lagged,file_name = daily_file)
+    if export_gridded:
+        print(f'Writing to {gridded_file}')
+        table_dates = ymd_to_datetime64(table['YEAR'],table['MONTH'],table['DAY'])
+        export_gridded_features(table_dates,gridded_file,labels = table['TTT_DAY_BOOL'].to_numpy())
+    #where the time and memory went
+    save_report()
 
     return None
 
@@ -0,0 +1,95 @@
+# Tools for the MJO indices. Phases are classified for every day at once by
+# binning the phase angle into octants, and the index text files are parsed
+# a single time into a binary cache.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import os #path/file management
+from date_tools import ymd_to_datetime64 #vectorized date creation
+
+# Functions Go Here
+'''
+    Phase classification. Both the OMI and the RMM index are classified by
+    placing the index in a phase space and splitting the phase angle into
+    eight 45 degree octants. Phase 1 starts at 180 degrees and the phases
+    increase counter-clockwise.
+'''
+def mjo_phase(x:np.ndarray,y:np.ndarray,amplitude:np.ndarray = None,weak_threshold:float = None) -> np.ndarray:
+    '''
+        Classifies the MJO phase (1-8) from the x and y components of the
+        phase space. Angles exactly on an octant boundary go to the higher
+        phase (the octant counter-clockwise of the boundary).
+
+        x (np.ndarray): The x axis of the phase space (RMM1, or PC2 for OMI)
+        y (np.ndarray): The y axis of the phase space (RMM2, or -PC1 for OMI)
+        amplitude (np.ndarray): The amplitude of the MJO, calculated from x
+            and y if not given
+        weak_threshold (float): Days with an amplitude below this are
+            classified as phase 0 (weak MJO). If None no days are weak.
+
+        Returns the phases as an integer array
+    '''
+    x = np.asarray(x,dtype = np.float64)
+    y = np.asarray(y,dtype = np.float64)
+    #adding 0.0 turns -0.0 into 0.0 so arctan2 doesn't jump across the branch cut
+    angle = np.arctan2(y + 0.0,x + 0.0) + np.pi
+    phase = np.floor(angle / (np.pi / 4)).astype(np.int8) + 1
+    #an angle of exactly 180 degrees wraps back into phase 8
+    phase[phase > 8] = 8
+
+    if weak_threshold is not None:
+        if amplitude is None:
+            amplitude = np.hypot(x,y)
+        phase[np.asarray(amplitude) < weak_threshold] = 0
+
+    return phase
+
+def omi_phase(omi1:np.ndarray,omi2:np.ndarray,amplitude:np.ndarray = None,weak_threshold:float = None) -> np.ndarray:
+    '''
+        Calculates the phase of the MJO based on the values of the PCs in the
+        OMI index. The OMI phase space has PC2 on the x axis and -PC1 on the
+        y axis (Kiladis et al. 2014).
+    '''
+
+    return mjo_phase(omi2,-omi1,amplitude = amplitude,weak_threshold = weak_threshold)
+
+def rmm_phase(rmm1:np.ndarray,rmm2:np.ndarray,amplitude:np.ndarray = None,weak_threshold:float = None) -> np.ndarray:
+    '''
+        Calculates the phase of the MJO based on the RMM index (Wheeler and
+        Hendon 2004), where RMM1 is the x axis and RMM2 is the y axis.
+    '''
+
+    return mjo_phase(rmm1,rmm2,amplitude = amplitude,weak_threshold = weak_threshold)
+
+'''
+    Loading the index files. The text file is parsed once and cached next to
+    it as a .npz, the cache is rebuilt whenever the text file is newer.
+'''
+def load_mjo_index(file:str,columns:tuple = (4,5,6)) -> dict:
+    '''
+        Loads an MJO index text file whose first three columns are year,
+        month, and day.
+
+        file (str): The path to the index text file
+        columns (tuple): The columns holding the two components and the
+            amplitude, (4,5,6) for the NOAA PSL OMI file
+
+        Returns a dictionary with 'dates' (datetime64[D]), 'pc1', 'pc2', and
+        'amp'
+    '''
+    if not os.path.isfile(file):
+        raise FileNotFoundError(f'The MJO index file {file} was not found.')
+    cache_file = os.path.splitext(file)[0] + '.npz'
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(file):
+        with np.load(cache_file) as cached:
+            if tuple(cached['columns']) == tuple(columns):
+                return {key:cached[key] for key in ('dates','pc1','pc2','amp')}
+
+    index_file = np.loadtxt(file,usecols = (0,1,2) + tuple(columns))
+    index_data = {'dates':ymd_to_datetime64(index_file[:,0],index_file[:,1],index_file[:,2]),
+                  'pc1':index_file[:,3],
+                  'pc2':index_file[:,4],
+                  'amp':index_file[:,5]}
+    np.savez(cache_file,columns = np.array(columns),**index_data)
+
+    return index_data
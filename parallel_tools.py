@@ -0,0 +1,57 @@
+# Helpers for sharing read-only arrays with process pool workers. The arrays
+# are saved once as .npy files and every worker memory maps them when it
+# starts, so tasks only pass indices and parameters instead of pickling the
+# feature arrays for every task. shared_arrays saves them to a directory of
+# their own for each run, so runs at the same time never overwrite each
+# other's arrays, and removes it when the run is done.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import contextlib #shared_arrays context manager
+import os #path/file management
+import shutil #removing the shared arrays
+import tempfile #a directory per run
+
+# the arrays a worker has mapped, name -> memory mapped array
+shared = {}
+
+# Functions go here
+def share_arrays(folder:str,**arrays) -> dict:
+    '''
+        Saves the arrays as .npy files in folder.
+
+        Returns name -> file, pass it to init_worker through the pool's
+        initargs
+    '''
+    os.makedirs(folder,exist_ok = True)
+    files = {}
+    for name,array in arrays.items():
+        files[name] = os.path.join(folder,f'shared_{name}.npy')
+        np.save(files[name],np.ascontiguousarray(array))
+
+    return files
+
+@contextlib.contextmanager
+def shared_arrays(folder:str,**arrays):
+    '''
+        Context manager that saves the arrays in a new directory under
+        folder and removes it when the block finishes (also when it raises).
+
+        Yields name -> file, pass it to init_worker through the pool's
+        initargs
+    '''
+    os.makedirs(folder,exist_ok = True)
+    run_folder = tempfile.mkdtemp(prefix = 'shared_',dir = folder)
+    try:
+        yield share_arrays(run_folder,**arrays)
+    finally:
+        shutil.rmtree(run_folder,ignore_errors = True)
+
+def init_worker(files:dict) -> None:
+    '''
+        Pool initializer, memory maps the shared arrays into shared
+    '''
+    for name,file in files.items():
+        shared[name] = np.load(file,mmap_mode = 'r')
+
+    return None
@@ -0,0 +1,201 @@
+# Permutation importance for a saved TTT classifier. Every (feature group,
+# repeat) pair is an independent task run across a process pool; the workers
+# memory map the feature arrays and load the model once, and the baseline
+# predictions are cached on disk so only the permuted predictions are made.
+#
+# Related columns can be permuted together (with the same shuffled rows) so
+# correlated predictors such as Z200_B1 and Z200_B2 don't hide each other's
+# importance.
+#
+# Usage:
+#   python permutation_importance.py --model ttt_rf --repeats 100
+#   python permutation_importance.py --set train --group-by variable --scoring f1
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import argparse #command line interface
+import hashlib #baseline cache keys
+import os #path/file management
+import re #column name groups
+from concurrent.futures import ProcessPoolExecutor #parallel repeats
+from sklearn import metrics
+import ttt_classifier as tc #shared data loading, model, and metrics
+import parallel_tools as pt #read-only arrays shared with the workers
+from hyperparameter_search import cache_key,write_json #cache helpers
+
+# Paths go here
+importance_path = tc.model_path + '/IMPORTANCE'
+
+# default settings, the notebook used 10 repeats and random_state = 42
+n_repeats = 100
+RANDNUM = 42
+#tasks are (group,block of repeats) so each task is big enough to be worth sending
+repeats_per_task = 10
+SCORERS = {'accuracy':lambda y,p: metrics.accuracy_score(y,p >= 0.5),
+           'f1':lambda y,p: metrics.f1_score(y,p >= 0.5,zero_division = 0),
+           'recall':lambda y,p: metrics.recall_score(y,p >= 0.5,zero_division = 0),
+           'precision':lambda y,p: metrics.precision_score(y,p >= 0.5,zero_division = 0),
+           'average_precision':metrics.average_precision_score}
+
+# the model loaded by each worker
+worker_model = None
+
+# Functions go here
+def feature_groups(feature_list:list,group_by:str = 'feature',groups:dict = None) -> dict:
+    '''
+        The columns permuted together.
+
+        feature_list (list): The predictor columns
+        group_by (str): 'feature' for every column on its own, 'variable' to
+            group the boxes, lags, and rolling means of a variable (Z200_B1,
+            Z200_B2, Z200_B1_LAG3D -> Z200)
+        groups (dict): Explicit group name -> columns, columns that aren't in
+            any group are kept on their own
+
+        Returns group name -> column indices
+    '''
+    if groups is not None:
+        grouped = {name:[feature_list.index(column) for column in columns] for name,columns in groups.items()}
+        used = {i for indices in grouped.values() for i in indices}
+        grouped.update({name:[i] for i,name in enumerate(feature_list) if i not in used})
+        return grouped
+    if group_by == 'feature':
+        return {name:[i] for i,name in enumerate(feature_list)}
+    elif group_by == 'variable':
+        grouped = {}
+        for i,name in enumerate(feature_list):
+            variable = re.sub(r'(_B\d+)?(_(LAG|LEAD|MEAN)\d+D)?$','',name)
+            grouped.setdefault(variable,[]).append(i)
+        return grouped
+
+    raise ValueError(f'Unknown grouping {group_by}, use feature or variable')
+
+def baseline_probabilities(model,metadata:dict,predictors:np.ndarray,cache_dir:str) -> np.ndarray:
+    '''
+        The model's TTT probabilities on the unpermuted predictors, cached by
+        the model and the data so repeated runs don't predict them again
+    '''
+    data_hash = hashlib.sha1(np.ascontiguousarray(predictors).tobytes()).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir,f'baseline_{cache_key([metadata["name"],metadata["created"],data_hash])}.npy')
+    if os.path.isfile(cache_file):
+        return np.load(cache_file)
+    probabilities = model.predict_proba(predictors)[:,1]
+    np.save(cache_file,probabilities)
+
+    return probabilities
+
+def init_importance_worker(files:dict,model_name:str) -> None:
+    '''
+        Pool initializer, maps the shared arrays and loads the model once
+    '''
+    global worker_model
+    pt.init_worker(files)
+    worker_model,_ = tc.load_model(model_name)
+    #the pool is already parallel, so each prediction runs on one core
+    if 'n_jobs' in worker_model.get_params():
+        worker_model.set_params(n_jobs = 1)
+
+    return None
+
+def permuted_scores(columns:list,group_number:int,repeats:list,scoring:str,seed:int) -> np.ndarray:
+    '''
+        Scores the model with the group's columns shuffled (runs in a
+        worker). Every repeat draws its own row order from (seed,group,
+        repeat) so the results don't depend on how the tasks are scheduled.
+
+        Returns the score for each repeat
+    '''
+    X = pt.shared['X']
+    y = pt.shared['y']
+    #one writable copy per task, each repeat overwrites the same columns
+    permuted = np.array(X)
+    columns = np.asarray(columns)
+    scores = np.empty(len(repeats))
+    for i,repeat in enumerate(repeats):
+        order = np.random.default_rng([seed,group_number,repeat]).permutation(len(y))
+        permuted[:,columns] = X[order[:,None],columns]
+        scores[i] = SCORERS[scoring](y,worker_model.predict_proba(permuted)[:,1])
+
+    return scores
+
+def permutation_importance(model_name:str,data_set:str = 'test',repeats:int = n_repeats,scoring:str = 'accuracy',
+                           group_by:str = 'feature',groups:dict = None,workers:int = None,
+                           file_name:str = None,seed:int = RANDNUM) -> dict:
+    '''
+        Permutation importance of a saved model.
+
+        model_name (str): Name of the saved model
+        data_set (str): 'test' or 'train' days of the model (tc.model_split)
+        repeats (int): Number of permutations of each group
+        scoring (str): One of SCORERS
+        group_by (str): How to group the columns, see feature_groups
+        groups (dict): Explicit column groups, see feature_groups
+        workers (int): Number of processes, all cores if None
+
+        Returns the baseline score and, for each group, its columns and the
+        drop in score for every repeat
+    '''
+    model,metadata = tc.load_model(model_name)
+    predictors,labels,feature_list,dates = tc.load_dataset(file_name)
+    if feature_list != metadata['feature_list']:
+        raise ValueError(f'The feature table columns do not match the ones {model_name} was trained on.')
+    train_ind,test_ind = tc.model_split(model_name,metadata,labels,dates)
+    rows = test_ind if data_set == 'test' else train_ind
+    X = predictors[rows]
+    y = labels[rows]
+
+    cache_dir = os.path.join(importance_path,model_name)
+    os.makedirs(cache_dir,exist_ok = True)
+    baseline = SCORERS[scoring](y,baseline_probabilities(model,metadata,X,cache_dir))
+    grouped = feature_groups(feature_list,group_by,groups)
+
+    repeat_blocks = [list(block) for block in np.array_split(np.arange(repeats),max(1,repeats // repeats_per_task))]
+    with pt.shared_arrays(cache_dir,X = X,y = y) as shared_files, \
+            ProcessPoolExecutor(max_workers = workers,initializer = init_importance_worker,
+                                initargs = (shared_files,model_name)) as pool:
+        futures = {name:[pool.submit(permuted_scores,columns,number,block,scoring,seed) for block in repeat_blocks]
+                   for number,(name,columns) in enumerate(grouped.items())}
+        importances = {name:{'columns':[feature_list[i] for i in grouped[name]],
+                             'importances':(baseline - np.concatenate([f.result() for f in tasks])).tolist()}
+                       for name,tasks in futures.items()}
+    for values in importances.values():
+        values['mean'] = float(np.mean(values['importances']))
+        values['std'] = float(np.std(values['importances']))
+
+    return {'model':model_name,'set':data_set,'scoring':scoring,'repeats':repeats,
+            'baseline':float(baseline),'groups':importances}
+
+def print_importances(report:dict,top:int = None) -> None:
+    '''
+        Prints the groups from most to least important
+    '''
+    print(f'{report["set"].capitalize()} Data, {report["repeats"]} repeats, '
+          f'baseline {report["scoring"]} {report["baseline"]:.3f}')
+    ranked = sorted(report['groups'].items(),key = lambda item: -item[1]['mean'])
+    for name,values in ranked[:top]:
+        print(f'Variable: {name:20} Importance: {values["mean"]:.4f} ± {values["std"]:.4f}')
+
+    return None
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Permutation importance of a saved TTT classifier.')
+    parser.add_argument('--model',default = 'ttt_rf',help = 'name of the saved model')
+    parser.add_argument('--set',choices = ['test','train'],default = 'test')
+    parser.add_argument('--repeats',type = int,default = n_repeats)
+    parser.add_argument('--scoring',choices = list(SCORERS),default = 'accuracy')
+    parser.add_argument('--group-by',choices = ['feature','variable'],default = 'feature')
+    parser.add_argument('--workers',type = int,default = None,help = 'processes to use, all cores by default')
+    parser.add_argument('--features',default = None,help = 'feature table in the data folder')
+    parser.add_argument('--top',type = int,default = None,help = 'number of groups to print')
+    args = parser.parse_args()
+
+    report = permutation_importance(args.model,args.set,args.repeats,args.scoring,args.group_by,
+                                    workers = args.workers,file_name = args.features)
+    write_json(os.path.join(importance_path,args.model,f'{args.set}_{args.scoring}_{args.group_by}.json'),report)
+    print_importances(report,args.top)
+
+    return None
+
+if __name__ == "__main__":
+    main()
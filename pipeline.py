@@ -0,0 +1,419 @@
+# A make-style runner for the whole workflow (downloads -> TTT index -> ML
+# dataset -> classifier, and composites -> figures). Every stage declares
+# the data files it reads and the files it writes. Its script and every
+# local module the script imports (followed through their imports, found
+# with ast) are inputs too, so changing a box in make_ml_dataset.py or the
+# code in grid_tools.py counts as a changed input. After a stage runs, the
+# size, mtime, and sha256 of its inputs are saved in pipeline_state.json,
+# and the next run skips every stage whose outputs exist and whose inputs
+# haven't changed. Content hashes are only recomputed for files whose size
+# or mtime moved, so the large NetCDF files are hashed once. Data files are
+# stamped where the scripts actually read them, the chunked copy in
+# DATA/STORE once ingest.py has made one (ingest.input_file), so
+# re-ingesting an input reruns its stages. Stages that don't depend on each
+# other run at the same time, each as its own process with its output in
+# LOGS/.
+#
+# Usage:
+#   python pipeline.py --list
+#   python pipeline.py --dry-run
+#   python pipeline.py figures --jobs 2
+#   python pipeline.py train --force
+
+# IMPORTS GO HERE
+import argparse #command line interface
+import ast #local imports of the stage scripts
+import hashlib #content hashes
+import json #saved stage state
+import os #path/file management
+import subprocess #running the stage scripts
+import sys #the current python interpreter
+import time #stage run times
+from ingest import input_file #the stored copies the scripts read
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED #concurrent stages
+
+# Paths go here
+root = os.getcwd()
+log_path = root + '/LOGS'
+state_file = root + '/pipeline_state.json'
+
+# the files the stages pass along
+ERA5_FILES = ['DATA/ERA5_u850.nc','DATA/ERA5_v850.nc','DATA/ERA5_u500.nc','DATA/ERA5_v500.nc',
+              'DATA/ERA5_w500.nc','DATA/ERA5_z200.nc','DATA/ERA5_q850.nc','DATA/ERA5_surfP.nc']
+OLR_FILES = ['DATA/olr.day.mean.nc','DATA/olr.day.ltm.1981-2010.nc']
+MJO_INDEX = 'DATA/MJO_OMI.txt'
+TTT_INDEX = 'DATA/TTT_Index.csv'
+TTT_CLASSIFY = 'DATA/TTT_CLASSIFY.parquet'
+LAG_COMPOSITES = 'DATA/TTT_LAG_COMPOSITES.npz'
+#the lag 0 composite figures (figures.FIGURE_STYLES file names)
+COMPOSITE_FIGURES = ['FIGURES/TTT_OLR_COMP.png','FIGURES/TTT_Q850_COMP.png','FIGURES/TTT_Z200_COMP.png',
+                     'FIGURES/TTT_U850_COMP.png','FIGURES/TTT_V850_COMP.png','FIGURES/TTT_SURFP_COMP.png',
+                     'FIGURES/TTT_500_WIND_ANOMALIES.png']
+
+# the stages, command is the script and its arguments, inputs the data files
+# it reads (the scripts are added by stage_inputs), paths are relative to root
+STAGES = [
+    {'name':'download_olr',
+     'command':['NOAA_OLR_Download_Script.py'],
+     'inputs':[],
+     'outputs':OLR_FILES},
+    {'name':'download_era5',
+     'command':['ERA5_Download_Script.py'],
+     'inputs':[],
+     'outputs':ERA5_FILES},
+    {'name':'ttt_index',
+     'command':['TTT_index.py'],
+     'inputs':OLR_FILES,
+     'outputs':[TTT_INDEX]},
+    {'name':'ml_dataset',
+     'command':['make_ml_dataset.py'],
+     'inputs':[TTT_INDEX,MJO_INDEX] + ERA5_FILES,
+     'outputs':[TTT_CLASSIFY]},
+    {'name':'train',
+     'command':['ttt_classifier.py','train'],
+     'inputs':[TTT_CLASSIFY],
+     'outputs':['MODELS/ttt_rf.joblib','MODELS/ttt_rf.json','MODELS/ttt_rf_split.npz']},
+    {'name':'composites',
+     'command':['composites.py'],
+     'inputs':[TTT_INDEX,MJO_INDEX] + OLR_FILES + ERA5_FILES,
+     'outputs':[LAG_COMPOSITES]},
+    {'name':'figures',
+     'command':['figures.py','--lag','0'],
+     'inputs':[LAG_COMPOSITES],
+     'outputs':COMPOSITE_FIGURES},
+]
+
+# default settings
+#'hash' compares content hashes of inputs whose size or mtime changed,
+#'mtime' treats any size or mtime change as a changed input
+change_check = 'hash'
+hash_block_size = 2**20
+
+# Functions go here
+def read_path(path:str) -> str:
+    '''
+        The file the scripts read for path, its copy in DATA/STORE when
+        ingest.input_file picks that, otherwise path itself
+    '''
+    folder,file_name = os.path.split(path)
+    if folder != 'DATA' or not file_name.endswith('.nc'):
+        return path
+
+    return os.path.relpath(input_file(file_name,os.path.join(root,folder)),root)
+
+def file_stamp(path:str,previous:dict = None,check:str = change_check) -> dict:
+    '''
+        The file read for path (read_path), its size, mtime, and (for
+        check = 'hash') sha256. The hash in previous is reused when the
+        file, size, and mtime are unchanged.
+
+        Returns the stamp as a dict, None if the file doesn't exist
+    '''
+    file = read_path(path)
+    full_path = os.path.join(root,file)
+    if not os.path.isfile(full_path):
+        return None
+    info = os.stat(full_path)
+    stamp = {'file':file,'size':info.st_size,'mtime':info.st_mtime_ns}
+    if check != 'hash':
+        return stamp
+    if previous is not None and previous.get('sha256') is not None and previous.get('file') == file and \
+            previous['size'] == stamp['size'] and previous['mtime'] == stamp['mtime']:
+        stamp['sha256'] = previous['sha256']
+        return stamp
+    digest = hashlib.sha256()
+    with open(full_path,'rb') as f:
+        for block in iter(lambda: f.read(hash_block_size),b''):
+            digest.update(block)
+    stamp['sha256'] = digest.hexdigest()
+
+    return stamp
+
+def stamps_match(stamp:dict,previous:dict,check:str = change_check) -> bool:
+    '''
+        Whether a file is unchanged since previous was taken
+    '''
+    if stamp is None or previous is None or stamp['file'] != previous.get('file'):
+        return False
+    if check == 'hash' and previous.get('sha256') is not None:
+        return stamp['sha256'] == previous['sha256']
+
+    return stamp['size'] == previous['size'] and stamp['mtime'] == previous['mtime']
+
+def load_state(file_name:str = state_file) -> dict:
+    '''
+        The saved stage records, stage name -> {'command','inputs','finished'}
+    '''
+    if not os.path.isfile(file_name):
+        return {}
+    with open(file_name) as f:
+        return json.load(f)
+
+def save_state(state:dict,file_name:str = state_file) -> None:
+    '''
+        Saves the stage records, written to a temporary file first so an
+        interrupted run can't leave a broken state file
+    '''
+    with open(file_name + '.tmp','w') as f:
+        json.dump(state,f,indent = 1)
+    os.replace(file_name + '.tmp',file_name)
+
+    return None
+
+def local_imports(script:str) -> list:
+    '''
+        The script and the modules in root it imports, directly or through
+        the modules it imports. Every import in the script counts (also the
+        ones inside functions), in the modules only the module level ones,
+        the ones that run when the module is imported (dtype_policy's check
+        imports whole stage scripts inside a function).
+
+        Returns the .py files relative to root, sorted
+    '''
+    found = set()
+    todo = [script]
+    while todo:
+        path = todo.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(os.path.join(root,path)) as f:
+            tree = ast.parse(f.read(),filename = path)
+        nodes = ast.walk(tree) if path == script else module_level(tree.body)
+        for node in nodes:
+            if isinstance(node,ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node,ast.ImportFrom) and node.level == 0 and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = name.split('.')[0] + '.py'
+                if os.path.isfile(os.path.join(root,module)):
+                    todo.append(module)
+
+    return sorted(found)
+
+def module_level(body:list):
+    '''
+        The statements of a module body that run on import, going into
+        if/try/with blocks but not into functions or classes
+    '''
+    for node in body:
+        if isinstance(node,(ast.FunctionDef,ast.AsyncFunctionDef,ast.ClassDef)):
+            continue
+        yield node
+        for field in ['body','orelse','finalbody','handlers']:
+            yield from module_level(getattr(node,field,[]))
+
+def stage_inputs(stage:dict) -> list:
+    '''
+        Every file a stage reads, its script with the local modules it
+        imports and its data files
+    '''
+
+    return local_imports(stage['command'][0]) + list(stage['inputs'])
+
+def stage_dependencies(stages:list) -> dict:
+    '''
+        The stages each stage depends on, i.e. the ones writing its inputs.
+
+        Returns stage name -> list of stage names
+    '''
+    producers = {}
+    for stage in stages:
+        for output in stage['outputs']:
+            if output in producers:
+                raise ValueError(f'{output} is written by both {producers[output]} and {stage["name"]}.')
+            producers[output] = stage['name']
+    upstream = {stage['name']:sorted({producers[path] for path in stage_inputs(stage) if path in producers} - {stage['name']})
+                for stage in stages}
+    #a depth first walk to catch cycles
+    visiting,visited = set(),set()
+    def visit(name):
+        if name in visiting:
+            raise ValueError(f'The stages have a dependency cycle through {name}.')
+        if name not in visited:
+            visiting.add(name)
+            for up in upstream[name]:
+                visit(up)
+            visiting.remove(name)
+            visited.add(name)
+    for name in upstream:
+        visit(name)
+
+    return upstream
+
+def select_stages(stages:list,targets:list = None) -> list:
+    '''
+        The target stages and every stage upstream of them, all of the stages
+        if targets is None
+    '''
+    if not targets:
+        return list(stages)
+    names = [stage['name'] for stage in stages]
+    unknown = [target for target in targets if target not in names]
+    if unknown:
+        raise ValueError(f'Unknown stages {unknown}, the stages are {names}.')
+    upstream = stage_dependencies(stages)
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(upstream[name])
+
+    return [stage for stage in stages if stage['name'] in needed]
+
+def stage_status(stage:dict,record:dict,check:str = change_check) -> tuple[bool,str,dict]:
+    '''
+        Whether a stage has to run.
+
+        Returns (stale,reason,stamps) with the current stamps of the inputs
+    '''
+    previous = {} if record is None else record.get('inputs',{})
+    stamps = {path:file_stamp(path,previous.get(path),check) for path in stage_inputs(stage)}
+    missing_inputs = [path for path,stamp in stamps.items() if stamp is None]
+    if missing_inputs:
+        return True,f'missing inputs {missing_inputs}',stamps
+    missing_outputs = [path for path in stage['outputs'] if not os.path.isfile(os.path.join(root,path))]
+    if missing_outputs:
+        return True,f'missing outputs {missing_outputs}',stamps
+    if record is None:
+        return True,'never run by the pipeline',stamps
+    if record.get('command') != stage['command']:
+        return True,'command changed',stamps
+    changed = [path for path,stamp in stamps.items() if not stamps_match(stamp,previous.get(path),check)]
+    if changed:
+        return True,f'changed inputs {changed}',stamps
+
+    return False,'up to date',stamps
+
+def run_stage(stage:dict) -> tuple[int,float]:
+    '''
+        Runs a stage's command with the current interpreter from root, the
+        output goes to LOGS/<stage>.log (runs in a thread)
+
+        Returns the exit code and the run time in seconds
+    '''
+    os.makedirs(log_path,exist_ok = True)
+    start = time.perf_counter()
+    with open(os.path.join(log_path,stage['name'] + '.log'),'w') as log:
+        result = subprocess.run([sys.executable] + stage['command'],cwd = root,stdout = log,stderr = subprocess.STDOUT)
+
+    return result.returncode,time.perf_counter() - start
+
+def run_pipeline(stages:list = STAGES,targets:list = None,jobs:int = None,force:bool = False,
+                 dry_run:bool = False,check:str = change_check) -> dict:
+    '''
+        Runs the out of date stages in dependency order. A stage is only
+        checked once everything upstream of it has finished, and stages are
+        run as soon as they're ready, up to jobs at a time.
+
+        targets (list): Stage names to bring up to date (with everything
+            upstream of them), all of the stages if None
+        jobs (int): Number of stages run at the same time, one per stage if None
+        force (bool): Run the selected stages even when they're up to date
+        dry_run (bool): Only report what would run
+        check (str): 'hash' or 'mtime', how inputs are compared
+
+        Returns stage name -> 'ran', 'skipped', 'failed', 'blocked', or
+        'would run'
+    '''
+    stages = select_stages(stages,targets)
+    upstream = stage_dependencies(stages)
+    state = load_state()
+    pending = {stage['name']:stage for stage in stages}
+    status = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers = jobs or len(stages)) as pool:
+        while pending or running:
+            #start (or skip) everything whose upstream stages are done
+            ready = [name for name in pending if all(up in status for up in upstream[name])]
+            for name in ready:
+                stage = pending.pop(name)
+                if any(status[up] in ('failed','blocked') for up in upstream[name]):
+                    status[name] = 'blocked'
+                    print(f'{name:<15} blocked by a failed upstream stage')
+                    continue
+                stale,reason,stamps = stage_status(stage,state.get(name),check)
+                if dry_run and any(status[up] == 'would run' for up in upstream[name]):
+                    stale,reason = True,'an upstream stage would run'
+                if not stale and not force:
+                    if not dry_run and stamps != state[name]['inputs']:
+                        #touched but unchanged files, keep their new mtimes so they aren't hashed again
+                        state[name]['inputs'] = stamps
+                        save_state(state)
+                    status[name] = 'skipped'
+                    print(f'{name:<15} up to date')
+                    continue
+                if dry_run:
+                    status[name] = 'would run'
+                    print(f'{name:<15} would run ({reason})')
+                    continue
+                print(f'{name:<15} running ({"forced" if not stale else reason})')
+                running[pool.submit(run_stage,stage)] = (stage,stamps)
+            if ready and not running:
+                #skips can make more stages ready
+                continue
+            if not running:
+                break
+            finished,_ = wait(running,return_when = FIRST_COMPLETED)
+            for task in finished:
+                stage,stamps = running.pop(task)
+                name = stage['name']
+                code,seconds = task.result()
+                if code != 0:
+                    status[name] = 'failed'
+                    print(f'{name:<15} failed with exit code {code} after {seconds:.1f} s, see {log_path}/{name}.log')
+                    continue
+                missing_outputs = [path for path in stage['outputs'] if not os.path.isfile(os.path.join(root,path))]
+                if missing_outputs:
+                    status[name] = 'failed'
+                    print(f'{name:<15} finished but did not write {missing_outputs}')
+                    continue
+                #the inputs as they were when the stage started
+                state[name] = {'command':stage['command'],'inputs':stamps,'finished':time.strftime('%Y-%m-%d %H:%M:%S')}
+                save_state(state)
+                status[name] = 'ran'
+                print(f'{name:<15} finished in {seconds:.1f} s')
+
+    return status
+
+def print_stages(stages:list = STAGES) -> None:
+    '''
+        Prints every stage with the stages it depends on, its code, and its
+        outputs
+    '''
+    upstream = stage_dependencies(stages)
+    for stage in stages:
+        after = ', '.join(upstream[stage['name']]) if upstream[stage['name']] else '-'
+        print(f'{stage["name"]:<15} after: {after}')
+        print(f'{"":<15} code: {", ".join(local_imports(stage["command"][0]))}')
+        print(f'{"":<15} writes: {", ".join(stage["outputs"])}')
+
+    return None
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Run the out of date stages of the TTT workflow.')
+    parser.add_argument('targets',nargs = '*',help = 'stages to bring up to date, all of them by default')
+    parser.add_argument('--jobs',type = int,default = None,help = 'stages run at the same time')
+    parser.add_argument('--force',action = 'store_true',help = 'run the selected stages even if they are up to date')
+    parser.add_argument('--dry-run',action = 'store_true',help = 'only show what would run')
+    parser.add_argument('--check',choices = ['hash','mtime'],default = change_check,help = 'how inputs are compared')
+    parser.add_argument('--list',action = 'store_true',help = 'list the stages and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        print_stages()
+        return None
+    status = run_pipeline(STAGES,args.targets,args.jobs,args.force,args.dry_run,args.check)
+    if any(result in ('failed','blocked') for result in status.values()):
+        sys.exit(1)
+
+    return None
+
+if __name__ == "__main__":
+    main()
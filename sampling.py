@@ -0,0 +1,106 @@
+# Sampling of the non-TTT (negative) days that go alongside the TTT events in
+# the machine learning dataset. The eligible days are worked out once as a
+# mask and all of the samples are drawn together with a seeded generator so
+# the dataset can be rebuilt exactly.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+from date_tools import to_datetime64,austral_summer_mask #vectorized date handling
+
+# Functions Go Here
+def eligible_negative_days(dates:np.ndarray,event_bool:np.ndarray,buffer_days:int = 0,
+                           eligible:np.ndarray = None) -> np.ndarray:
+    '''
+        Makes the mask of days that can be drawn as negatives: austral summer
+        days that aren't within buffer_days of an event (the event days
+        themselves are always excluded).
+
+        dates (np.ndarray): The daily dates of the record
+        event_bool (np.ndarray): 1 on event days, 0 otherwise
+        buffer_days (int): Number of days either side of an event to exclude
+        eligible (np.ndarray): Optional extra mask, e.g. the days every data
+            source covers
+
+        Returns a boolean mask with the same length as dates
+    '''
+    dates = to_datetime64(dates)
+    day_numbers = dates.astype(np.int64)
+    event_days = day_numbers[np.asarray(event_bool) == 1]
+    #every day within the buffer of any event
+    offsets = np.arange(-buffer_days,buffer_days+1)
+    excluded_days = np.unique((event_days[:,np.newaxis] + offsets[np.newaxis,:]).ravel())
+
+    mask = austral_summer_mask(dates) & ~np.isin(day_numbers,excluded_days)
+    if eligible is not None:
+        mask &= np.asarray(eligible,dtype = bool)
+
+    return mask
+
+def stratum_quotas(strata:np.ndarray,n_samples:int,weights:dict = None) -> dict:
+    '''
+        Splits n_samples across the strata. With weights (stratum -> weight,
+        e.g. the number of events in each month) the samples follow the
+        weights, otherwise every stratum present gets an equal share.
+        Leftover samples from rounding go to the largest remainders.
+    '''
+    labels = np.unique(strata)
+    if weights is None:
+        share = np.ones(len(labels))
+    else:
+        share = np.array([weights.get(label,0) for label in labels],dtype = np.float64)
+    if share.sum() == 0:
+        raise ValueError('None of the strata have a weight.')
+    exact = n_samples * share / share.sum()
+    quotas = np.floor(exact).astype(np.int64)
+    leftover = n_samples - quotas.sum()
+    quotas[np.argsort(-(exact - quotas),kind = 'stable')[:leftover]] += 1
+
+    return dict(zip(labels.tolist(),quotas.tolist()))
+
+def sample_negative_days(dates:np.ndarray,event_bool:np.ndarray,n_samples:int|None,buffer_days:int = 0,
+                         eligible:np.ndarray = None,strata:np.ndarray = None,strata_weights:dict = None,
+                         seed:int = 144) -> np.ndarray:
+    '''
+        Draws n_samples negative days without replacement.
+
+        dates (np.ndarray): The daily dates of the record
+        event_bool (np.ndarray): 1 on event days, 0 otherwise
+        n_samples (int): The number of negative days to draw, None takes
+            every eligible day
+        buffer_days (int): Number of days either side of an event to exclude
+        eligible (np.ndarray): Optional extra mask of days that can be drawn
+        strata (np.ndarray): Optional integer label for each day (e.g. the
+            month or the MJO phase) to stratify the draw by
+        strata_weights (dict): stratum -> weight used to split the samples
+            between strata, equal shares if None
+        seed (int): The seed for the random generator
+
+        Returns the sampled dates (datetime64[D]) in date order
+    '''
+    dates = to_datetime64(dates)
+    rng = np.random.default_rng(seed)
+    candidates = np.flatnonzero(eligible_negative_days(dates,event_bool,buffer_days,eligible))
+    if n_samples is None:
+        return dates[candidates]
+
+    if strata is None:
+        if n_samples > len(candidates):
+            raise ValueError(f'Asked for {n_samples} negative days but only {len(candidates)} are eligible.')
+        chosen = rng.choice(candidates,size = n_samples,replace = False)
+    else:
+        candidate_strata = np.asarray(strata)[candidates]
+        quotas = stratum_quotas(candidate_strata,n_samples,strata_weights)
+        #shuffle with random keys then take the first quota of each stratum
+        order = np.lexsort((rng.random(len(candidates)),candidate_strata))
+        sorted_strata = candidate_strata[order]
+        group_start = np.searchsorted(sorted_strata,sorted_strata,side = 'left')
+        rank = np.arange(len(order)) - group_start
+        labels,available = np.unique(candidate_strata,return_counts = True)
+        label_quotas = np.array([quotas[label] for label in labels.tolist()],dtype = np.int64)
+        if np.any(label_quotas > available):
+            short = labels[np.argmax(label_quotas > available)]
+            raise ValueError(f'Stratum {short} needs more negative days than are eligible.')
+        quota = label_quotas[np.searchsorted(labels,sorted_strata)]
+        chosen = candidates[order[rank < quota]]
+
+    return dates[np.sort(chosen)]
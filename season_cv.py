@@ -0,0 +1,139 @@
+# Cross validation for the TTT classifier with folds made of whole austral
+# summer seasons (Oct - May), so adjacent days and lag features can't leak
+# between the training and testing data. Training days within an optional
+# gap of any test day are dropped as well. Folds run in parallel and the
+# metrics are summarised with confidence intervals.
+#
+# Usage:
+#   python season_cv.py --folds 5 --gap-days 10
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import argparse #command line interface
+import json #reports
+import os #path/file management
+from concurrent.futures import ProcessPoolExecutor #parallel folds
+from scipy import stats #confidence intervals
+from date_tools import austral_season #season labels
+from season_splits import season_folds,n_folds,gap_days #season blocked folds
+import ttt_classifier as tc #shared data loading, model, and metrics
+import parallel_tools as pt #read-only arrays shared with the workers
+
+# Paths go here
+cv_path = tc.model_path + '/CV'
+
+# default settings
+confidence_level = 0.95
+REPORT_METRICS = ('precision','recall','f1','average_precision','accuracy')
+
+# Functions go here
+def confidence_interval(values:np.ndarray,level:float = confidence_level) -> tuple[float,float]:
+    '''
+        Student t confidence interval for the mean of the fold scores
+    '''
+    values = np.asarray(values,dtype = np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) < 2:
+        return float('nan'),float('nan')
+    half_width = stats.t.ppf(0.5 + level/2,len(values) - 1) * values.std(ddof = 1) / np.sqrt(len(values))
+
+    return float(values.mean() - half_width),float(values.mean() + half_width)
+
+def score_fold(params:dict,train_ind:np.ndarray,test_ind:np.ndarray,n_jobs:int = 1,backend:str = None) -> dict:
+    '''
+        Fits on one fold and scores its test seasons (runs in a worker)
+    '''
+    X = pt.shared['X']
+    y = pt.shared['y']
+    model = tc.make_model(params,n_jobs = n_jobs,backend = backend)
+    model.fit(X[train_ind],y[train_ind])
+    scores,_ = tc.evaluate_model(model,X[test_ind],y[test_ind])
+    scores['n_train'] = int(len(train_ind))
+    scores['n_test'] = int(len(test_ind))
+    scores['n_test_events'] = int(y[test_ind].sum())
+
+    return scores
+
+def summarise_folds(fold_scores:list,level:float = confidence_level) -> dict:
+    '''
+        Mean, std. dev., and confidence interval of each metric over folds
+    '''
+    summary = {}
+    for key in REPORT_METRICS:
+        values = np.array([scores.get(key,np.nan) for scores in fold_scores],dtype = np.float64)
+        low,high = confidence_interval(values,level)
+        summary[key] = {'mean':float(np.nanmean(values)),'std':float(np.nanstd(values,ddof = 1)) if len(values) > 1 else float('nan'),
+                        'ci_low':low,'ci_high':high}
+
+    return summary
+
+def cross_validate(predictors:np.ndarray,labels:np.ndarray,dates:np.ndarray,params:dict = None,
+                   folds:int = n_folds,gap:int = gap_days,workers:int = None,level:float = confidence_level,
+                   backend:str = None) -> dict:
+    '''
+        Season blocked cross validation with the folds run in parallel.
+
+        predictors (np.ndarray): The predictors
+        labels (np.ndarray): The labels
+        dates (np.ndarray): The date of each sample
+        params (dict): The model parameters, the ttt_classifier defaults if None
+        folds (int): Number of folds of consecutive seasons
+        gap (int): Training days within this many days of a test day are dropped
+        workers (int): Number of processes, one per fold if None
+        backend (str): The ttt_classifier model backend, its default if None
+
+        Returns the per fold scores and their summary
+    '''
+    fold_list = season_folds(dates,folds,gap)
+    workers = min(folds,os.cpu_count() or 1) if workers is None else workers
+    with pt.shared_arrays(cv_path,X = predictors,y = labels) as shared_files, \
+            ProcessPoolExecutor(max_workers = workers,initializer = pt.init_worker,initargs = (shared_files,)) as pool:
+        fold_scores = list(pool.map(score_fold,[params]*len(fold_list),*zip(*fold_list),
+                                    [1]*len(fold_list),[backend]*len(fold_list)))
+    seasons = austral_season(dates)
+    for scores,(_,test_ind) in zip(fold_scores,fold_list):
+        scores['seasons'] = [int(seasons[test_ind].min()),int(seasons[test_ind].max())]
+
+    return {'folds':fold_scores,'summary':summarise_folds(fold_scores,level),
+            'settings':{'folds':folds,'gap_days':gap,'confidence_level':level,
+                        'backend':tc.model_backend if backend is None else backend}}
+
+def print_cv_report(report:dict) -> None:
+    '''
+        Prints the cross validation summary
+    '''
+    level = report['settings']['confidence_level']
+    print(f'Season blocked CV, {report["settings"]["folds"]} folds, {report["settings"]["gap_days"]} gap days')
+    for scores in report['folds']:
+        print(f'    seasons {scores["seasons"][0]}-{scores["seasons"][1]}: f1 {scores["f1"]:.3f} '
+              f'recall {scores["recall"]:.3f} precision {scores["precision"]:.3f} ({scores["n_test_events"]} events)')
+    for key,values in report['summary'].items():
+        print(f'{key:20} {values["mean"]:.3f} ({level:.0%} CI {values["ci_low"]:.3f} - {values["ci_high"]:.3f})')
+
+    return None
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Season blocked cross validation of the TTT random forest.')
+    parser.add_argument('--folds',type = int,default = n_folds)
+    parser.add_argument('--gap-days',type = int,default = gap_days)
+    parser.add_argument('--workers',type = int,default = None)
+    parser.add_argument('--backend',choices = list(tc.MODEL_BACKENDS),default = tc.model_backend)
+    parser.add_argument('--params',default = None,help = 'JSON string of model parameters')
+    parser.add_argument('--features',default = None,help = 'feature table in the data folder')
+    parser.add_argument('--out',default = None,help = 'file to write the JSON report to')
+    args = parser.parse_args()
+
+    predictors,labels,_,dates = tc.load_dataset(args.features)
+    params = None if args.params is None else json.loads(args.params)
+    report = cross_validate(predictors,labels,dates,params,args.folds,args.gap_days,args.workers,
+                            backend = args.backend)
+    print_cv_report(report)
+    if args.out is not None:
+        with open(args.out,'w') as f:
+            json.dump(report,f,indent = 2)
+
+    return None
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Train/test splits made of whole austral summer seasons (Oct - May). Days
+# within a season are strongly correlated (and share lag features) so the
+# seasons are kept together, and training days within an optional gap of
+# any test day are dropped.
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+from date_tools import to_datetime64,austral_season #season labels
+
+# default settings
+n_folds = 5
+gap_days = 0
+
+# Functions go here
+def purge_gap(dates:np.ndarray,train_ind:np.ndarray,test_ind:np.ndarray,gap:int) -> np.ndarray:
+    '''
+        Drops the training days within gap days of any test day
+    '''
+    if gap <= 0 or len(test_ind) == 0:
+        return train_ind
+    day_numbers = to_datetime64(dates).astype(np.int64)
+    test_days = np.sort(day_numbers[test_ind])
+    train_days = day_numbers[train_ind]
+    #distance to the nearest test day from a binary search
+    pos = np.searchsorted(test_days,train_days)
+    before = np.abs(train_days - test_days[np.clip(pos - 1,0,len(test_days) - 1)])
+    after = np.abs(test_days[np.clip(pos,0,len(test_days) - 1)] - train_days)
+
+    return train_ind[np.minimum(before,after) > gap]
+
+def season_folds(dates:np.ndarray,folds:int = n_folds,gap:int = gap_days) -> list:
+    '''
+        Splits the samples into folds of consecutive whole seasons.
+
+        Returns a list of (train_indices,test_indices)
+    '''
+    seasons = austral_season(dates)
+    unique_seasons = np.unique(seasons)
+    if folds > len(unique_seasons):
+        raise ValueError(f'Asked for {folds} folds but there are only {len(unique_seasons)} seasons.')
+    fold_list = []
+    for test_seasons in np.array_split(unique_seasons,folds):
+        is_test = np.isin(seasons,test_seasons)
+        test_ind = np.flatnonzero(is_test)
+        train_ind = purge_gap(dates,np.flatnonzero(~is_test),test_ind,gap)
+        fold_list.append((train_ind,test_ind))
+
+    return fold_list
+
+def season_holdout(dates:np.ndarray,test_fraction:float = 0.2,gap:int = gap_days) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        Holds out the last test_fraction of the seasons as the test set.
+
+        Returns the train and test indices
+    '''
+    seasons = austral_season(dates)
+    unique_seasons = np.unique(seasons)
+    n_test = max(1,int(round(len(unique_seasons) * test_fraction)))
+    is_test = np.isin(seasons,unique_seasons[-n_test:])
+    test_ind = np.flatnonzero(is_test)
+
+    return purge_gap(dates,np.flatnonzero(~is_test),test_ind,gap),test_ind
@@ -0,0 +1,207 @@
+# Monte Carlo significance testing of the TTT composites. Random date sets
+# with the same number of days in each month as the events make a null
+# distribution of composites for every grid cell. The null members are made
+# in batches, each batch a sparse (member,time) selection matrix applied to
+# the anomaly cube a time chunk at a time (composites.accumulate), and the
+# batches are spread across a process pool. Workers only return how often
+# the null composites reach the observed one, so memory doesn't grow with
+# the number of members. Each batch holds a sum and a count per member, lag,
+# and grid cell, so the batch size is set from the memory budget
+# (chunked.memory_budget_mb, --memory-mb) shared by the workers.
+#
+# Field significance uses the false discovery rate (Benjamini and Hochberg
+# 1995) with alpha_FDR = 2 alpha as recommended by Wilks (2016).
+#
+# Usage:
+#   python significance.py --members 1000 --workers 8
+#   python significance.py --variables olr q850 --lags -5 0
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import argparse #command line interface
+import os #path/file management
+from concurrent.futures import ProcessPoolExecutor #parallel batches
+from date_tools import date_months,austral_summer_mask #same-season sampling
+import composites as cp #anomaly streaming and selection matrices
+import chunked #memory budget of the batches
+
+# Paths go here
+significance_file = 'TTT_COMPOSITE_SIGNIFICANCE.npz'
+
+# default settings
+n_members = 1000
+#random date sets per task, sized to the memory budget if None
+batch_size = None
+#rough bytes per member, lag, and grid cell a batch needs (the sums, the
+#counts, the null composites, and the temporaries of the comparison)
+null_bytes_per_cell = 48
+alpha = 0.05
+#FDR control level, Wilks (2016) recommends twice the local test level
+alpha_fdr = 2 * alpha
+RANDNUM = 144
+
+# Functions go here
+def random_date_sets(event_dates:np.ndarray,pool_dates:np.ndarray,members:int,seed:int = RANDNUM) -> np.ndarray:
+    '''
+        Draws random sets of days from pool_dates with as many days in each
+        calendar month as there are events in that month, so the null sets
+        have the same seasonality as the events. Days within a set don't
+        repeat.
+
+        Returns the date sets with shape (member,event)
+    '''
+    event_dates = np.asarray(event_dates,dtype = 'datetime64[D]')
+    pool_dates = np.asarray(pool_dates,dtype = 'datetime64[D]')
+    rng = np.random.default_rng(seed)
+    event_months = date_months(event_dates)
+    pool_months = date_months(pool_dates)
+    date_sets = np.empty((members,len(event_dates)),dtype = 'datetime64[D]')
+    for month in np.unique(event_months):
+        slots = np.flatnonzero(event_months == month)
+        month_pool = pool_dates[pool_months == month]
+        if len(month_pool) < len(slots):
+            raise ValueError(f'Only {len(month_pool)} days to draw from in month {month} '
+                             f'but there are {len(slots)} events.')
+        #a random key per pool day, the smallest keys of each member are its draws
+        keys = rng.random((members,len(month_pool)))
+        picks = np.argpartition(keys,len(slots) - 1,axis = 1)[:,:len(slots)]
+        date_sets[:,slots] = month_pool[picks]
+
+    return date_sets
+
+def null_batch_size(n_cells:int,n_lags:int,members:int,workers:int = None) -> int:
+    '''
+        Random date sets per task so the batches all workers hold at once
+        fit in half of chunked.memory_budget_mb, the other half is left for
+        the anomaly chunks
+    '''
+    workers = (os.cpu_count() or 1) if workers is None else workers
+
+    return chunked.block_length(n_cells * n_lags,null_bytes_per_cell,
+                                budget_mb = chunked.memory_budget_mb / (2 * workers),max_length = members)
+
+def null_exceedances(name:str,observed:np.ndarray,date_sets:np.ndarray,lags:np.ndarray,
+                     chunk_size:int = cp.time_chunk) -> np.ndarray:
+    '''
+        Makes the null composites of one batch of date sets (runs in a
+        worker) and counts how often they are at least as far from zero as
+        the observed composite.
+
+        observed (np.ndarray): The observed mean composite (lag,lat,lon)
+        date_sets (np.ndarray): The batch of random date sets (member,event)
+
+        Returns the counts with shape (lag,lat,lon)
+    '''
+    file_dates = cp.variable_grid(name)[0]
+    #rows are member-major, lag-minor
+    sets = [members_dates + np.timedelta64(int(lag),'D') for members_dates in date_sets for lag in lags]
+    #the null only needs the means, so no sums of squares
+    sums = cp.accumulate(name,cp.selection_matrix(file_dates,sets),chunk_size,squares = False)
+    null = sums['sum']
+    with np.errstate(invalid = 'ignore',divide = 'ignore'):
+        np.divide(null,sums['count'],out = null)
+    np.abs(null,out = null)
+    null = null.reshape((len(date_sets),len(lags)) + observed.shape[1:])
+
+    return (null >= np.abs(observed)[None]).sum(axis = 0)
+
+def fdr_mask(p_values:np.ndarray,level:float = alpha_fdr) -> np.ndarray:
+    '''
+        Benjamini-Hochberg field significance. Cells are significant when
+        their p-value is at or below the largest p(i) with
+        p(i) <= (i/N) level, NaN cells are never significant.
+
+        Returns a boolean mask with the shape of p_values
+    '''
+    valid = ~np.isnan(p_values)
+    sorted_p = np.sort(p_values[valid])
+    if len(sorted_p) == 0:
+        return np.zeros(p_values.shape,dtype = bool)
+    passing = np.flatnonzero(sorted_p <= level * np.arange(1,len(sorted_p) + 1) / len(sorted_p))
+    if len(passing) == 0:
+        return np.zeros(p_values.shape,dtype = bool)
+
+    return valid & (np.nan_to_num(p_values,nan = 1.0) <= sorted_p[passing[-1]])
+
+def composite_significance(event_dates:np.ndarray,lags:list = (0,),variables:list = None,members:int = n_members,
+                           batch:int = batch_size,workers:int = None,seed:int = RANDNUM,
+                           chunk_size:int = cp.time_chunk) -> dict:
+    '''
+        Monte Carlo significance of the lagged composites.
+
+        event_dates (np.ndarray): The event days (lag 0)
+        lags (list): Days relative to the events
+        variables (list): Names from composites.COMPOSITE_VARIABLES, all of
+            them if None
+        members (int): Number of random date sets
+        batch (int): Number of date sets per task, sized to the memory
+            budget if None
+        workers (int): Number of processes, all cores if None
+
+        Returns the lags and, for each variable, the mean composite, the
+        p-values, the local (p <= alpha) and FDR masks with shape
+        (lag,lat,lon), and its lats and lons
+    '''
+    lags = np.asarray(list(lags))
+    variables = list(cp.COMPOSITE_VARIABLES) if variables is None else list(variables)
+    event_dates = np.asarray(event_dates,dtype = 'datetime64[D]')
+    results = {'lags':lags}
+    for name in variables:
+        print(f'Testing {name} with {members} random date sets')
+        file_dates = cp.variable_grid(name)[0]
+        #only events the file covers at every lag, so the null sets are the same size
+        covered = np.all([cp.date_lookup(file_dates,event_dates + np.timedelta64(int(lag),'D'))[1] for lag in lags],axis = 0)
+        events = event_dates[covered]
+        if cp.cache_anomalies:
+            #build the cache once here rather than in every worker
+            cp.anomaly_cube(name,chunk_size)
+        selection = cp.selection_matrix(file_dates,[events + np.timedelta64(int(lag),'D') for lag in lags])
+        observed = cp.composite_stats(cp.accumulate(name,selection,chunk_size))
+        #null days come from the austral summer days of the file
+        pool_dates = file_dates[austral_summer_mask(file_dates)]
+        date_sets = random_date_sets(events,pool_dates,members,seed)
+        n_cells = len(observed['lats']) * len(observed['lons'])
+        sets_per_task = null_batch_size(n_cells,len(lags),members,workers) if batch is None else batch
+        batches = [date_sets[bs:bs+sets_per_task] for bs in range(0,members,sets_per_task)]
+        exceed = np.zeros(observed['mean'].shape)
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            tasks = [pool.submit(null_exceedances,name,observed['mean'],sets,lags,chunk_size) for sets in batches]
+            for task in tasks:
+                exceed += task.result()
+        p_values = (exceed + 1) / (members + 1)
+        p_values[np.isnan(observed['mean'])] = np.nan
+        results[name] = {'mean':observed['mean'],
+                         'n_events':len(events),
+                         'p_value':p_values.astype(np.float32),
+                         'local_mask':np.nan_to_num(p_values,nan = 1.0) <= alpha,
+                         'fdr_mask':np.stack([fdr_mask(p_lag) for p_lag in p_values]),
+                         'lats':observed['lats'],
+                         'lons':observed['lons']}
+        print(f'    {results[name]["local_mask"].mean():.1%} of cells locally significant, '
+              f'{results[name]["fdr_mask"].mean():.1%} field significant')
+
+    return results
+
+# main function
+def main() -> None:
+    parser = argparse.ArgumentParser(description = 'Monte Carlo significance of the TTT composites.')
+    parser.add_argument('--lags',type = int,nargs = 2,default = [0,0],help = 'first and last lag in days')
+    parser.add_argument('--variables',nargs = '+',choices = list(cp.COMPOSITE_VARIABLES),default = None)
+    parser.add_argument('--members',type = int,default = n_members)
+    parser.add_argument('--batch',type = int,default = batch_size,help = 'random date sets per task, sized to the memory budget by default')
+    parser.add_argument('--workers',type = int,default = None,help = 'processes to use, all cores by default')
+    parser.add_argument('--memory-mb',type = float,default = None,help = 'memory budget shared by the workers')
+    parser.add_argument('--out',default = significance_file,help = 'file in the data folder to write to')
+    args = parser.parse_args()
+
+    if args.memory_mb is not None:
+        chunked.memory_budget_mb = args.memory_mb
+    event_dates = cp.load_event_dates()
+    results = composite_significance(event_dates,range(args.lags[0],args.lags[1] + 1),args.variables,
+                                     args.members,args.batch,args.workers)
+    cp.save_composites(results,os.path.join(cp.data_path,args.out))
+
+    return None
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Checks that the float32 field policy gives the same box means, TTT index,
+# event days, and ERA5 box features as float64 fields, on synthetic OLR like
+# data and a synthetic ERA5 file so it runs without the downloads
+# (dtype_policy.py checks the real files).
+#
+# Usage:
+#   python -m pytest test_dtype_policy.py
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import datetime as dt #date management
+import importlib #importing make_ml_dataset from a scratch folder
+import os #path/file management
+import pytest #test runner
+from netCDF4 import Dataset #synthetic ERA5 file
+import dtype_policy as dp #the policy under test
+import TTT_index as ti #index steps
+from grid_tools import get_grid_index,box_weight_matrix,weighted_box_means #box handling
+
+# settings
+n_years = 6
+lats = np.arange(10,-40.1,-2.5)
+lons = np.arange(0,80.1,2.5)
+era5_file = 'ERA5_synthetic.nc'
+era5_years = 3
+
+# Functions go here
+def synthetic_olr(seed:int = 0) -> tuple[np.ndarray,np.ndarray,np.ndarray]:
+    '''
+        Daily OLR like values (~240 W/m^2 with an annual cycle, ~20 W/m^2
+        noise, and a few missing cells) on the TTT_index domain with the
+        matching 365 day climatology
+
+        Returns dates,olr,clim in float64
+    '''
+    rng = np.random.default_rng(seed)
+    dates = np.array([dt.datetime(2001,1,1) + dt.timedelta(days = d) for d in range(365 * n_years)])
+    day = np.arange(365)
+    clim = 240 + 15 * np.cos(2 * np.pi * day / 365)[:,None,None] + rng.normal(0,5,(1,len(lats),len(lons)))
+    clim = np.broadcast_to(clim,(365,len(lats),len(lons))).copy()
+    doys = np.array([min(d.timetuple().tm_yday,365) - 1 for d in dates])
+    olr = clim[doys] + rng.normal(0,20,(len(dates),len(lats),len(lons)))
+    olr[rng.random(olr.shape) < 0.001] = np.nan
+
+    return dates,olr,clim
+
+def index_outputs(dates:np.ndarray,olr:np.ndarray,clim:np.ndarray) -> dict:
+    '''
+        The box means, TTT index, and event days with the current field_dtype
+    '''
+    anoms = ti.get_OLR_anomalies(dp.as_field(olr).copy(),dp.as_field(clim),dates)
+    E1,E2,W1,W2 = ti.get_box_values(anoms,lats,lons,[ti.E1_box,ti.E2_box,ti.W1_box,ti.W2_box])
+    index = ti.calculate_index(E1,E2,W1,W2)
+
+    return {'boxes':np.stack([E1,E2,W1,W2]),'index':index,'days':ti.determine_ttt_days(index,dates)}
+
+def write_synthetic_era5(file_name:str,seed:int = 0) -> None:
+    '''
+        An ERA5 like .nc file (time in hours since 1900-01-01, descending
+        latitude) of a z200 like float32 field, ~1.2e5 with an annual cycle
+        and noise, the case where float32 rounding matters most
+    '''
+    rng = np.random.default_rng(seed)
+    e5_lats = np.arange(0,-50.1,-1.0)
+    e5_lons = np.arange(0,60.1,1.0)
+    days = (np.datetime64('2000-01-01') - np.datetime64('1900-01-01')).astype(int) + np.arange(365 * era5_years)
+    cycle = 800 * np.cos(2 * np.pi * np.arange(len(days)) / 365.25)
+    field = 1.2e5 + cycle[:,None,None] + rng.normal(0,300,(len(days),len(e5_lats),len(e5_lons)))
+    with Dataset(file_name,'w') as nc_data:
+        nc_data.createDimension('time',None)
+        nc_data.createDimension('latitude',len(e5_lats))
+        nc_data.createDimension('longitude',len(e5_lons))
+        nc_data.createVariable('time','i4',('time',))[:] = days * 24 + 12
+        nc_data.createVariable('latitude','f4',('latitude',))[:] = e5_lats
+        nc_data.createVariable('longitude','f4',('longitude',))[:] = e5_lons
+        nc_data.createVariable('z','f4',('time','latitude','longitude'))[:] = field
+
+    return None
+
+@pytest.fixture(scope = 'module')
+def ml_dataset(tmp_path_factory):
+    '''
+        make_ml_dataset imported from a scratch folder (it changes into
+        DATA and fetches the OMI file when imported) with a synthetic ERA5
+        file in its data folder
+    '''
+    folder = tmp_path_factory.mktemp('ml_dataset')
+    os.makedirs(folder / 'DATA')
+    (folder / 'DATA' / 'MJO_OMI.txt').touch()
+    write_synthetic_era5(str(folder / 'DATA' / era5_file))
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        mm = importlib.import_module('make_ml_dataset')
+    finally:
+        os.chdir(cwd)
+    saved = mm.data_path,mm.root,mm.input_file
+    mm.data_path = str(folder / 'DATA')
+    mm.root = cwd
+    mm.input_file = lambda file_name: os.path.join(mm.data_path,file_name)
+    yield mm
+    mm.data_path,mm.root,mm.input_file = saved
+
+@pytest.fixture
+def field_dtype(monkeypatch):
+    '''
+        Sets dp.field_dtype for one test and puts it back afterwards
+    '''
+    def set_dtype(dtype):
+        monkeypatch.setattr(dp,'field_dtype',dtype)
+
+    return set_dtype
+
+def test_as_field_keeps_matching_arrays(field_dtype) -> None:
+    field_dtype(np.float32)
+    data = np.ones((3,4),dtype = np.float32)
+    assert dp.as_field(data) is data
+    assert dp.as_field(np.ma.masked_array(data.astype(np.float64))).dtype == np.float32
+    assert dp.as_accumulator(data).dtype == dp.accumulator_dtype
+
+def test_box_means_float32_matches_float64() -> None:
+    _,olr,_ = synthetic_olr()
+    weights = box_weight_matrix(get_grid_index(lats,lons),[ti.E1_box,ti.W1_box,ti.W2_box],weighted = False)
+    reference = weighted_box_means(olr,weights)
+    candidate = weighted_box_means(olr.astype(np.float32),weights)
+    result = dp.compare_series(reference,candidate,dp.check_rtol)
+    assert result['passed'],result
+
+def test_index_float32_matches_float64(field_dtype) -> None:
+    dates,olr,clim = synthetic_olr()
+    field_dtype(np.float64)
+    reference = index_outputs(dates,olr,clim)
+    field_dtype(np.float32)
+    candidate = index_outputs(dates,olr,clim)
+    for name in ['boxes','index']:
+        result = dp.compare_series(reference[name],candidate[name],dp.check_rtol)
+        assert result['passed'],(name,result)
+    assert np.array_equal(reference['days'],candidate['days'])
+    assert reference['days'].sum() > 0
+
+@pytest.mark.parametrize('backend',['memory','chunked'])
+def test_era5_features_float32_match_float64(ml_dataset,field_dtype,monkeypatch,backend) -> None:
+    monkeypatch.setattr(ml_dataset,'processing_backend',backend)
+    boxes = [ml_dataset.z200_box1,ml_dataset.z200_box2,ml_dataset.q850_box]
+    field_dtype(np.float64)
+    reference,reference_dates = ml_dataset.process_era5_data(era5_file,'z',boxes)
+    field_dtype(np.float32)
+    candidate,candidate_dates = ml_dataset.process_era5_data(era5_file,'z',boxes)
+    assert np.array_equal(reference_dates,candidate_dates)
+    for b in range(len(boxes)):
+        result = dp.compare_series(reference[b],candidate[b],dp.check_rtol)
+        assert result['passed'],(boxes[b],result)
@@ -0,0 +1,408 @@
+# Training and evaluation of the TTT random forest classifier outside of the
+# notebook so it can run headless. The fitted model is saved with joblib
+# alongside a JSON file holding the feature list, parameters, metrics, and
+# timings so later evaluations can reuse it instead of refitting.
+#
+# The model backend is pluggable, the random forest from the notebook or a
+# histogram binned gradient boosting classifier that is much faster to fit
+# on large feature tables. Both go through the same train/evaluate/persist
+# functions.
+#
+# Usage:
+#   python ttt_classifier.py train [--n-trees 50 ...]
+#   python ttt_classifier.py train --backend hist_gradient_boosting [--params '{"learning_rate":0.05}']
+#   python ttt_classifier.py evaluate [--model ttt_rf]
+#   python ttt_classifier.py predict [--model ttt_rf --chunk-size 50000]
+
+# IMPORTS GO HERE
+import numpy as np #array functionality and mathmatical operators
+import argparse #command line interface
+import json #model metadata
+import os #path/file management
+import time #fit/predict timing
+import datetime as dt #date management
+import joblib #model persistence
+from sklearn.ensemble import RandomForestClassifier,HistGradientBoostingClassifier
+from sklearn.model_selection import train_test_split
+from sklearn import metrics
+from feature_table import load_feature_table,iter_feature_table #reading TTT_CLASSIFY
+from date_tools import ymd_to_datetime64,date_lookup #sample dates
+from season_splits import season_holdout #season blocked test split
+
+# Paths go here
+root = os.getcwd()
+data_path = root + '/DATA'
+model_path = root + '/MODELS'
+
+# settings shared with the notebook
+feature_file = 'TTT_CLASSIFY.parquet'
+TARGET_VAR = 'TTT_DAY_BOOL'
+THRESHOLD_VAL = 1
+#columns that are never used as predictors
+DROP_COLUMNS = ['TTT_DAY_BOOL','TTT_INDEX_VAL','YEAR','DAY','DOY']
+split_size = 0.2
+#'season' holds out the last seasons as the test set, 'random' shuffles days like the notebook
+split_mode = 'season'
+#training days within this many days of a test day are dropped (season split only)
+split_gap_days = 0
+RANDNUM = 144
+#batch inference over every austral summer day (make_ml_dataset export_daily)
+daily_file = 'TTT_DAILY.parquet'
+ttt_index_file = 'TTT_Index.csv'
+probability_file = 'TTT_PROBABILITY.csv'
+predict_chunk_size = 50000
+DEFAULT_PARAMS = {'n_estimators':50,
+                  'max_depth':None,
+                  'min_samples_split':5,
+                  'min_samples_leaf':2,
+                  'criterion':'gini'}
+#gradient boosting on 255 bin histograms of each feature, early stopping
+#holds out validation_fraction of the training rows and class_weight
+#up-weights the rare TTT days
+HGB_PARAMS = {'learning_rate':0.1,
+              'max_iter':500,
+              'max_leaf_nodes':31,
+              'min_samples_leaf':20,
+              'l2_regularization':0.0,
+              'early_stopping':True,
+              'validation_fraction':0.1,
+              'n_iter_no_change':20,
+              'class_weight':'balanced'}
+#backend name -> (model class,default parameters)
+MODEL_BACKENDS = {'random_forest':(RandomForestClassifier,DEFAULT_PARAMS),
+                  'hist_gradient_boosting':(HistGradientBoostingClassifier,HGB_PARAMS)}
+model_backend = 'random_forest'
+
+# Functions go here
+def prepare_features(features) -> tuple[np.ndarray,np.ndarray,list,np.ndarray]:
+    '''
+        Splits the feature table into the predictors and labels the same way
+        the notebook does.
+
+        Returns the predictors (float32), the labels, the feature list, and
+        the date of each sample
+    '''
+    dates = ymd_to_datetime64(features['YEAR'],features['MONTH'],features['DAY'])
+    labels = np.array(features[TARGET_VAR] == THRESHOLD_VAL).astype(int)
+    predictors = features.drop(columns = [name for name in DROP_COLUMNS if name in features.columns])
+    feature_list = list(predictors.columns)
+
+    return np.ascontiguousarray(predictors.to_numpy(dtype = np.float32)),labels,feature_list,dates
+
+def load_dataset(file_name:str = None) -> tuple[np.ndarray,np.ndarray,list,np.ndarray]:
+    '''
+        Loads the feature table from the data folder and prepares it
+    '''
+    file_name = feature_file if file_name is None else file_name
+
+    return prepare_features(load_feature_table(os.path.join(data_path,file_name)))
+
+def split_settings() -> dict:
+    '''
+        The current split settings, as saved in a model's metadata
+    '''
+
+    return {'mode':split_mode,'size':split_size,'gap_days':split_gap_days,'seed':RANDNUM}
+
+def split_indices(labels:np.ndarray,dates:np.ndarray,split:dict = None) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        The train/test split used for training as train and test indices
+
+        split (dict): Split settings as saved in a model's metadata, the
+            current settings if None
+    '''
+    split = split_settings() if split is None else split
+    if split['mode'] == 'season':
+        return season_holdout(dates,split['size'],split['gap_days'])
+
+    return train_test_split(np.arange(len(labels)),test_size = split['size'],random_state = split.get('seed',RANDNUM))
+
+def make_model(params:dict = None,n_jobs:int = -1,backend:str = None):
+    '''
+        Makes the classifier for backend (model_backend if None). The random
+        forest fits with every core by default, the gradient boosting is
+        threaded by OpenMP so n_jobs doesn't apply to it.
+    '''
+    backend = model_backend if backend is None else backend
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f'Unknown model backend {backend}, use one of {list(MODEL_BACKENDS)}')
+    model_class,defaults = MODEL_BACKENDS[backend]
+    model_params = dict(defaults)
+    if params is not None:
+        model_params.update(params)
+    if 'n_jobs' in model_class().get_params():
+        model_params['n_jobs'] = n_jobs
+
+    return model_class(random_state = RANDNUM,**model_params)
+
+def classification_metrics(labels:np.ndarray,predictions:np.ndarray,probabilities:np.ndarray = None) -> dict:
+    '''
+        The metrics reported for the TTT class (class 1)
+    '''
+    scores = {'accuracy':metrics.accuracy_score(labels,predictions),
+              'precision':metrics.precision_score(labels,predictions,zero_division = 0),
+              'recall':metrics.recall_score(labels,predictions,zero_division = 0),
+              'f1':metrics.f1_score(labels,predictions,zero_division = 0),
+              'confusion_matrix':metrics.confusion_matrix(labels,predictions,labels = [0,1]).tolist()}
+    if probabilities is not None and len(np.unique(labels)) == 2:
+        scores['average_precision'] = metrics.average_precision_score(labels,probabilities)
+
+    return {key:(float(value) if np.isscalar(value) else value) for key,value in scores.items()}
+
+def evaluate_model(model,predictors:np.ndarray,labels:np.ndarray) -> tuple[dict,float]:
+    '''
+        Predicts with the model and scores it.
+
+        Returns the metrics and the time the prediction took in seconds
+    '''
+    start = time.perf_counter()
+    probabilities = model.predict_proba(predictors)[:,1]
+    predict_time = time.perf_counter() - start
+    predictions = (probabilities >= 0.5).astype(int)
+
+    return classification_metrics(labels,predictions,probabilities),predict_time
+
+def save_model(model,name:str,metadata:dict) -> str:
+    '''
+        Saves the model and its metadata to the model folder.
+
+        Returns the path to the saved model
+    '''
+    if not os.path.exists(model_path):
+        os.mkdir(model_path)
+    model_file = os.path.join(model_path,name + '.joblib')
+    joblib.dump(model,model_file)
+    with open(os.path.join(model_path,name + '.json'),'w') as f:
+        json.dump(metadata,f,indent = 2)
+
+    return model_file
+
+def load_model(name:str) -> tuple[object,dict]:
+    '''
+        Loads a saved model and its metadata from the model folder
+    '''
+    model_file = os.path.join(model_path,name + '.joblib')
+    if not os.path.isfile(model_file):
+        raise FileNotFoundError(f'No saved model called {name} in {model_path}')
+    with open(os.path.join(model_path,name + '.json')) as f:
+        metadata = json.load(f)
+
+    return joblib.load(model_file),metadata
+
+def save_split(name:str,train_dates:np.ndarray,test_dates:np.ndarray) -> str:
+    '''
+        Saves the dates a model was trained and tested on next to it
+
+        Returns the path to the split file
+    '''
+    split_file = os.path.join(model_path,name + '_split.npz')
+    np.savez(split_file,train_dates = train_dates,test_dates = test_dates)
+
+    return split_file
+
+def model_split(name:str,metadata:dict,labels:np.ndarray,dates:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+    '''
+        The train and test indices of the days a saved model was trained and
+        tested on, whatever the split settings are now. The dates saved with
+        the model are looked up in dates. A model saved without them has its
+        split rebuilt from metadata['split'], which has to give the number
+        of train and test days it was saved with.
+
+        Raises ValueError when the split can't be reproduced
+    '''
+    split_file = os.path.join(model_path,name + '_split.npz')
+    if os.path.isfile(split_file):
+        with np.load(split_file) as saved:
+            train_ind,train_found = date_lookup(dates,saved['train_dates'])
+            test_ind,test_found = date_lookup(dates,saved['test_dates'])
+        if not (train_found.all() and test_found.all()):
+            raise ValueError(f'The feature table is missing {int((~train_found).sum())} train and '
+                             f'{int((~test_found).sum())} test days of {name}, its split can not be reproduced.')
+        return train_ind,test_ind
+    if 'split' not in metadata:
+        raise ValueError(f'{name} was saved without its train/test split, retrain it to evaluate it.')
+    train_ind,test_ind = split_indices(labels,dates,metadata['split'])
+    if len(train_ind) != metadata['n_train'] or len(test_ind) != metadata['n_test']:
+        raise ValueError(f'The split saved with {name} gives {len(train_ind)} train and {len(test_ind)} test days '
+                         f'instead of {metadata["n_train"]} and {metadata["n_test"]}, retrain it to evaluate it.')
+
+    return train_ind,test_ind
+
+def train(name:str,params:dict = None,n_jobs:int = -1,file_name:str = None,cv_folds:int = 0,
+          backend:str = None) -> dict:
+    '''
+        Fits the classifier on the training split, scores it on both splits,
+        and saves it with its metadata. With cv_folds > 0 a season blocked
+        cross validation of the same parameters is stored with it too.
+
+        Returns the metadata
+    '''
+    predictors,labels,feature_list,dates = load_dataset(file_name)
+    train_ind,test_ind = split_indices(labels,dates)
+    train_X,test_X,train_y,test_y = predictors[train_ind],predictors[test_ind],labels[train_ind],labels[test_ind]
+
+    backend = model_backend if backend is None else backend
+    model = make_model(params,n_jobs,backend)
+    start = time.perf_counter()
+    model.fit(train_X,train_y)
+    fit_time = time.perf_counter() - start
+    train_scores,_ = evaluate_model(model,train_X,train_y)
+    test_scores,predict_time = evaluate_model(model,test_X,test_y)
+
+    metadata = {'name':name,
+                'created':dt.datetime.now().isoformat(timespec = 'seconds'),
+                'feature_file':feature_file if file_name is None else file_name,
+                'feature_list':feature_list,
+                'backend':backend,
+                'params':model.get_params(),
+                'n_train':int(len(train_y)),
+                'n_test':int(len(test_y)),
+                'split':split_settings(),
+                'metrics':{'train':train_scores,'test':test_scores},
+                'timing':{'fit_seconds':fit_time,'predict_seconds':predict_time}}
+    if hasattr(model,'n_iter_'):
+        #boosting iterations actually used after early stopping
+        metadata['n_iter'] = int(model.n_iter_)
+    if cv_folds > 0:
+        #imported here since season_cv builds on this module
+        from season_cv import cross_validate
+        cv_report = cross_validate(predictors,labels,dates,params,folds = cv_folds,gap = split_gap_days,
+                                   backend = backend)
+        metadata['cross_validation'] = cv_report['summary']
+    save_model(model,name,metadata)
+    #the exact days, so evaluations don't depend on the split settings at the time
+    save_split(name,dates[train_ind],dates[test_ind])
+
+    return metadata
+
+def evaluate(name:str,file_name:str = None) -> dict:
+    '''
+        Scores a saved model on the days it was tested on when it was
+        trained, without refitting it
+    '''
+    model,metadata = load_model(name)
+    predictors,labels,feature_list,dates = load_dataset(file_name)
+    if feature_list != metadata['feature_list']:
+        raise ValueError(f'The feature table columns do not match the ones {name} was trained on.')
+    _,test_ind = model_split(name,metadata,labels,dates)
+    test_scores,predict_time = evaluate_model(model,predictors[test_ind],labels[test_ind])
+
+    return {'name':name,'metrics':{'test':test_scores},'timing':{'predict_seconds':predict_time}}
+
+def predict_daily(name:str,file_name:str = None,out_file:str = None,chunk_size:int = predict_chunk_size,
+                  n_jobs:int = -1) -> dict:
+    '''
+        Runs a saved model over the daily feature table chunk_size rows at a
+        time, so memory stays bounded however long the record is, and
+        writes the TTT probability of every day next to the rows of
+        TTT_Index.csv. Days that weren't predicted (austral winter, missing
+        data) are NaN.
+
+        name (str): Name of the saved model
+        file_name (str): Daily feature table in the data folder
+        out_file (str): File the probabilities are written to in the data folder
+        chunk_size (int): Rows predicted at a time
+        n_jobs (int): Cores the trees are spread over, -1 uses all of them
+
+        Returns the number of days predicted and the timing
+    '''
+    model,metadata = load_model(name)
+    if 'n_jobs' in model.get_params():
+        model.set_params(n_jobs = n_jobs)
+    file_name = daily_file if file_name is None else file_name
+    out_file = probability_file if out_file is None else out_file
+
+    start = time.perf_counter()
+    dates = []
+    probabilities = []
+    for chunk in iter_feature_table(os.path.join(data_path,file_name),chunk_size):
+        predictors,_,feature_list,chunk_dates = prepare_features(chunk)
+        if feature_list != metadata['feature_list']:
+            raise ValueError(f'The daily feature table columns do not match the ones {name} was trained on.')
+        probabilities.append(model.predict_proba(predictors)[:,1].astype(np.float32))
+        dates.append(chunk_dates)
+    predict_time = time.perf_counter() - start
+    dates = np.concatenate(dates)
+    probabilities = np.concatenate(probabilities)
+
+    #line the probabilities up with the index file
+    index_file = np.loadtxt(os.path.join(data_path,ttt_index_file),delimiter = ',',skiprows = 1,ndmin = 2)
+    index_dates = ymd_to_datetime64(index_file[:,0],index_file[:,1],index_file[:,2])
+    rows,found = date_lookup(dates,index_dates)
+    daily_probability = np.where(found,probabilities[rows],np.nan)
+    np.savetxt(os.path.join(data_path,out_file),np.column_stack((index_file[:,:5],daily_probability)),
+               fmt = ['%d','%d','%d','%.3f','%.1f','%.4f'],delimiter = ',',
+               header = 'Year, Month, Day, Index Value, Event Day, TTT Probability')
+
+    return {'name':name,'days':int(found.sum()),'out_file':out_file,
+            'timing':{'predict_seconds':predict_time}}
+
+def print_report(report:dict) -> None:
+    '''
+        Prints the metrics and timings in a readable form
+    '''
+    for split,scores in report['metrics'].items():
+        print(f'{split.capitalize()} Data')
+        for key,value in scores.items():
+            if key != 'confusion_matrix':
+                print(f'    {key:20} {value:.3f}')
+        print(f'    {"confusion_matrix":20} {scores["confusion_matrix"]}')
+    for key,value in report['timing'].items():
+        print(f'{key:24} {value:.3f}')
+    for key,values in report.get('cross_validation',{}).items():
+        print(f'CV {key:21} {values["mean"]:.3f} (CI {values["ci_low"]:.3f} - {values["ci_high"]:.3f})')
+
+    return None
+
+# main function
+def main() -> None:
+    '''
+        main function. Parses the command line and trains or evaluates
+    '''
+    parser = argparse.ArgumentParser(description = 'Train or evaluate the TTT random forest classifier.')
+    subparsers = parser.add_subparsers(dest = 'command',required = True)
+    train_parser = subparsers.add_parser('train',help = 'fit and save a model')
+    train_parser.add_argument('--backend',choices = list(MODEL_BACKENDS),default = model_backend)
+    train_parser.add_argument('--params',default = None,help = 'JSON string of model parameters, overrides the other options')
+    #the options below are for the random forest
+    train_parser.add_argument('--n-trees',type = int,default = DEFAULT_PARAMS['n_estimators'])
+    train_parser.add_argument('--max-depth',type = int,default = DEFAULT_PARAMS['max_depth'])
+    train_parser.add_argument('--min-samples-split',type = int,default = DEFAULT_PARAMS['min_samples_split'])
+    train_parser.add_argument('--min-samples-leaf',type = int,default = DEFAULT_PARAMS['min_samples_leaf'])
+    train_parser.add_argument('--criterion',default = DEFAULT_PARAMS['criterion'])
+    train_parser.add_argument('--n-jobs',type = int,default = -1,help = 'cores to fit with, -1 uses all of them')
+    train_parser.add_argument('--cv',type = int,default = 0,help = 'number of season blocked CV folds to run, 0 for none')
+    eval_parser = subparsers.add_parser('evaluate',help = 'score a saved model without refitting')
+    predict_parser = subparsers.add_parser('predict',help = 'daily TTT probabilities over the whole record')
+    predict_parser.add_argument('--chunk-size',type = int,default = predict_chunk_size,help = 'rows predicted at a time')
+    predict_parser.add_argument('--out',default = None,help = 'file the probabilities are written to')
+    predict_parser.add_argument('--n-jobs',type = int,default = -1,help = 'cores to predict with, -1 uses all of them')
+    for sub in (train_parser,eval_parser,predict_parser):
+        sub.add_argument('--model',default = 'ttt_rf',help = 'name of the saved model')
+        sub.add_argument('--features',default = None,help = 'feature table in the data folder')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        params = {}
+        if args.backend == 'random_forest':
+            params = {'n_estimators':args.n_trees,
+                      'max_depth':args.max_depth,
+                      'min_samples_split':args.min_samples_split,
+                      'min_samples_leaf':args.min_samples_leaf,
+                      'criterion':args.criterion}
+        if args.params is not None:
+            params.update(json.loads(args.params))
+        report = train(args.model,params,args.n_jobs,args.features,args.cv,args.backend)
+    elif args.command == 'predict':
+        report = predict_daily(args.model,args.features,args.out,args.chunk_size,args.n_jobs)
+        print(f'Wrote the TTT probability of {report["days"]} days to {report["out_file"]} '
+              f'in {report["timing"]["predict_seconds"]:.2f} s')
+        return None
+    else:
+        report = evaluate(args.model,args.features)
+    print_report(report)
+
+    return None
+
+if __name__ == "__main__":
+    main()